@@ -0,0 +1,245 @@
+import json
+import os
+import re
+import struct
+import threading
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from money import MONEY_FORMAT, from_legacy, is_current
+from shared.fileio import atomic_write_json
+
+# Import env variables
+from env import logger
+
+
+# Index record: timestamp of the entry (float64) and byte offset of its line in the segment (uint64)
+INDEX_RECORD = struct.Struct('<dQ')
+
+# (segment number, entry number within the segment)
+Position = Tuple[int, int]
+
+
+class ActivityLog:
+    """
+    Append-only JSON lines log of the financial activity, split into segments.
+
+    Every segment (name.000001.jsonl, name.000002.jsonl, ...) has a sidecar index
+    (name.000001.idx) made of fixed-width records holding the timestamp and the byte
+    offset of each entry. Entry i of a segment is found by reading index record i,
+    and the entries of a time range by a binary search over the index records, so
+    reads seek directly to the entries instead of scanning the segments.
+
+    A new segment is started once the current one exceeds `segment_size` bytes and
+    only the newest `max_segments` segments are kept. Entries are appended in
+    chronological order (FinanceProcessor calls its listeners in commit order); should
+    the clock go back, the index records the timestamp of the previous entry instead,
+    so the binary search stays valid.
+
+    The 'amounts' of the entries are in cents. The entries of a log written before
+    (in dollars) are left as they are: name.format.json records the timestamp of the
+    last of them, and they are converted when read.
+    """
+    def __init__(self, base_path: str, segment_size: int = 32 * 1024 * 1024, max_segments: int = 20):
+        """
+        Args:
+            base_path (str): Path of the log without the segment suffix, e.g. logs/financial_activity.
+            segment_size (int): Size in bytes after which a new segment is started.
+            max_segments (int): Number of segments kept.
+        """
+        self.base_path = base_path
+        self.segment_size = segment_size
+        self.max_segments = max(1, max_segments)
+        self._lock = threading.Lock()
+        self._segments = self._list_segments()
+        if not self._segments:
+            self._segments = [1]
+        # Timestamp of the newest index record, the index never goes back in time
+        self._last_timestamp = 0.0
+        self._repair(self._segments[-1])
+        # Entries up to this timestamp hold dollars
+        self.legacy_until: Optional[float] = self._load_format()
+
+    def append(self, entries: List[Dict[str, Any]]):
+        """
+        Append entries to the log, starting new segments as needed.
+
+        Args:
+            entries (List[Dict[str, Any]]): JSON serializable entries with a 'ts' (UNIX timestamp) key.
+        """
+        lines = [(entry['ts'], (json.dumps(entry, ensure_ascii=False) + '\n').encode('utf-8')) for entry in entries]
+        with self._lock:
+            while lines:
+                lines = self._write(lines)
+
+    def _write(self, lines: List[Tuple[float, bytes]]) -> List[Tuple[float, bytes]]:
+        """Writes (timestamp, line) pairs to the current segment until it is full, returns the ones left."""
+        segment = self._segments[-1]
+        records = []
+        with open(self._data_path(segment), 'ab') as data:
+            offset = data.tell()
+            for timestamp, line in lines:
+                data.write(line)
+                self._last_timestamp = max(self._last_timestamp, timestamp)
+                records.append(INDEX_RECORD.pack(self._last_timestamp, offset))
+                offset += len(line)
+                if offset >= self.segment_size:
+                    break
+        # The entries are written first: a crash in between leaves entries the index is missing, which _repair() adds back
+        with open(self._index_path(segment), 'ab') as index:
+            index.write(b''.join(records))
+
+        if offset >= self.segment_size:
+            self._segments.append(segment + 1)
+            for old in self._segments[:-self.max_segments]:
+                for path in (self._data_path(old), self._index_path(old)):
+                    if os.path.exists(path):
+                        os.remove(path)
+            self._segments = self._segments[-self.max_segments:]
+        return lines[len(records):]
+
+    def read_range(self, start: float, end: float) -> Iterator[Dict[str, Any]]:
+        """
+        Yield the entries with start <= ts <= end, oldest first.
+
+        Args:
+            start (float): First timestamp of the range.
+            end (float): Last timestamp of the range.
+        """
+        for segment in list(self._segments):
+            count = self._count(segment)
+            if count == 0 or self._index_record(segment, count - 1)[0] < start:
+                continue
+            if self._index_record(segment, 0)[0] > end:
+                return
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                if self._index_record(segment, middle)[0] < start:
+                    low = middle + 1
+                else:
+                    high = middle
+            with open(self._data_path(segment), 'rb') as data, open(self._index_path(segment), 'rb') as index:
+                index.seek(low * INDEX_RECORD.size)
+                data.seek(self._index_record(segment, low)[1])
+                # The entries of the index records are consecutive lines
+                for _ in range(low, count):
+                    timestamp, _ = INDEX_RECORD.unpack(index.read(INDEX_RECORD.size))
+                    if timestamp > end:
+                        return
+                    yield self._upgrade(json.loads(data.readline()))
+
+    def read_before(self, position: Optional[Position], n: int) -> Tuple[List[Dict[str, Any]], Optional[Position]]:
+        """
+        Read up to n entries preceding a position, newest first.
+
+        Args:
+            position (Optional[Position]): Position returned by a previous call, None to start from the newest entry.
+            n (int): Maximum number of entries.
+
+        Returns:
+            Tuple[List[Dict[str, Any]], Optional[Position]]: The entries and the position to continue from, None if there are no older entries.
+        """
+        segments = list(self._segments)
+        if position is None:
+            position = (segments[-1], self._count(segments[-1]))
+        segment, number = position
+        entries = []
+        while len(entries) < n:
+            if number == 0:
+                older = [s for s in segments if s < segment]
+                if not older:
+                    return entries, None
+                segment = older[-1]
+                number = self._count(segment)
+                continue
+            number -= 1
+            entries.append(self._read_entry(segment, number))
+        if number == 0 and not any(s < segment and self._count(s) for s in segments):
+            return entries, None
+        return entries, (segment, number)
+
+    def _read_entry(self, segment: int, number: int) -> Dict[str, Any]:
+        with open(self._data_path(segment), 'rb') as data:
+            data.seek(self._index_record(segment, number)[1])
+            return self._upgrade(json.loads(data.readline()))
+
+    def _upgrade(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        if self.legacy_until is not None and entry['ts'] <= self.legacy_until and 'amounts' in entry:
+            entry['amounts'] = {participant: from_legacy(amount) for participant, amount in entry['amounts'].items()}
+        return entry
+
+    def _load_format(self) -> Optional[float]:
+        """Reads name.format.json, creating it with the timestamp of the newest entry of a log without it."""
+        path = f'{self.base_path}.format.json'
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                document = json.load(f)
+            if is_current(document):
+                return document['legacy_until']
+        legacy_until = None
+        for segment in reversed(self._segments):
+            count = self._count(segment)
+            if count:
+                legacy_until = self._index_record(segment, count - 1)[0]
+                break
+        atomic_write_json(path, {'format': MONEY_FORMAT, 'legacy_until': legacy_until})
+        if legacy_until is not None:
+            logger.info(f'activity_log.py:_load_format(). Entries of {self.base_path} up to {legacy_until} are read as dollars')
+        return legacy_until
+
+    def _index_record(self, segment: int, number: int) -> Tuple[float, int]:
+        with open(self._index_path(segment), 'rb') as index:
+            index.seek(number * INDEX_RECORD.size)
+            return INDEX_RECORD.unpack(index.read(INDEX_RECORD.size))
+
+    def _count(self, segment: int) -> int:
+        try:
+            return os.path.getsize(self._index_path(segment)) // INDEX_RECORD.size
+        except FileNotFoundError:
+            return 0
+
+    def _repair(self, segment: int):
+        """Makes the index of a segment match its entries after a crash."""
+        data_path, index_path = self._data_path(segment), self._index_path(segment)
+        if not os.path.exists(data_path):
+            open(data_path, 'ab').close()
+        data_size = os.path.getsize(data_path)
+        count = self._count(segment)
+        # Drop torn index records and records pointing past the end of the data
+        while count and self._index_record(segment, count - 1)[1] >= data_size:
+            count -= 1
+        with open(index_path, 'ab') as index:
+            index.truncate(count * INDEX_RECORD.size)
+
+        offset = 0
+        if count:
+            with open(data_path, 'rb') as data:
+                self._last_timestamp, offset = self._index_record(segment, count - 1)
+                data.seek(offset)
+                offset += len(data.readline())
+        with open(data_path, 'r+b') as data, open(index_path, 'ab') as index:
+            data.seek(offset)
+            for line in iter(data.readline, b''):
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('no line end')
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning(f'activity_log.py:_repair(). Discarding a torn entry at the end of {data_path}')
+                    data.truncate(offset)
+                    break
+                self._last_timestamp = max(self._last_timestamp, entry['ts'])
+                index.write(INDEX_RECORD.pack(self._last_timestamp, offset))
+                offset += len(line)
+
+    def _list_segments(self) -> List[int]:
+        directory, name = os.path.split(os.path.abspath(self.base_path))
+        pattern = re.compile(re.escape(name) + r'\.(\d{6})\.jsonl$')
+        os.makedirs(directory, exist_ok=True)
+        return sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(directory)) if match)
+
+    def _data_path(self, segment: int) -> str:
+        return f'{self.base_path}.{segment:06d}.jsonl'
+
+    def _index_path(self, segment: int) -> str:
+        return f'{self.base_path}.{segment:06d}.idx'
@@ -0,0 +1,233 @@
+import html
+import json
+import os
+import queue
+import re
+import threading
+import time
+import telegram
+
+from typing import List
+from shared import metrics
+from shared.fileio import atomic_write_json
+from shared.outbound import PRIORITY_AUDIT, send_priority
+
+# Import env variables
+from env import logger
+
+
+SEND_FAILURES = metrics.counter('audit_send_failures_total', 'Failed sends of audit entries to the log channel.', ('error',))
+SPILLED_ENTRIES = metrics.counter('audit_entries_spilled_total', 'Audit entries written to the overflow file because the queue was full.')
+DROPPED_ENTRIES = metrics.counter('audit_entries_dropped_total', 'Audit entries dropped because Telegram rejected them.')
+HTML_TAG_PATTERN = re.compile(r'<[^>]*>')
+
+class AuditDispatcher:
+    """
+    Background sender of audit entries to the finance logs channel.
+
+    Handlers only enqueue entries. A worker thread coalesces the entries queued within
+    `batch_window` seconds (up to `max_batch_chars` characters) into one channel message
+    and retries failed sends with exponential backoff.
+
+    Entries that have been taken from the queue but not delivered yet are kept in a
+    spool file, and entries that don't fit in the bounded queue are appended to an
+    overflow file, so nothing is lost across restarts.
+    """
+    SEPARATOR = '\n\n'
+    MAX_MESSAGE_LENGTH = 4096
+
+    def __init__(self, bot: telegram.Bot, chat_id: int, spool_path: str, max_queue_size: int = 1000,
+                 batch_window: float = 1.0, max_batch_chars: int = 3500, max_backoff: float = 60.0):
+        """
+        Args:
+            bot (telegram.Bot): Bot used to send the messages.
+            chat_id (int): The audit channel.
+            spool_path (str): File keeping undelivered entries.
+            max_queue_size (int): Capacity of the in-memory queue.
+            batch_window (float): Seconds to wait for more entries after the first one of a batch.
+            max_batch_chars (int): Maximum length of a coalesced message.
+            max_backoff (float): Upper bound of the delay between retries in seconds.
+        """
+        self.bot = bot
+        self.chat_id = chat_id
+        self.spool_path = spool_path
+        self.overflow_path = os.path.splitext(spool_path)[0] + '.overflow.jsonl'
+        self.batch_window = batch_window
+        self.max_batch_chars = min(max_batch_chars, self.MAX_MESSAGE_LENGTH)
+        self.max_backoff = max_backoff
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._overflow_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='audit-dispatcher', daemon=True)
+        self._pending: List[str] = self._load_spool()
+        metrics.gauge('audit_queue_size', 'Audit entries waiting in the in-memory queue.').set_function(self._queue.qsize)
+        metrics.gauge('audit_pending_entries', 'Audit entries taken from the queue but not delivered yet.').set_function(lambda: len(self._pending))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Stop the worker and persist everything that hasn't been delivered.
+
+        Args:
+            timeout (float): Seconds to wait for the worker to finish its current send.
+        """
+        self._stop_event.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            # The worker still owns the pending entries and keeps the spool up to date itself
+            logger.warning('audit_dispatcher.py:stop(). Audit worker is still sending, spilling the queued entries to disk')
+            self._spill_queue()
+            return
+        self._drain_queue()
+        self._save_spool()
+
+    def submit(self, text: str):
+        """
+        Queue an entry for the audit channel. Never blocks.
+
+        Args:
+            text (str): HTML formatted entry.
+        """
+        try:
+            self._queue.put_nowait(text)
+        except queue.Full:
+            logger.warning('audit_dispatcher.py:submit(). Audit queue is full, spilling entry to disk')
+            SPILLED_ENTRIES.inc()
+            self._write_overflow([text])
+
+    def _write_overflow(self, entries: List[str]):
+        with self._overflow_lock, open(self.overflow_path, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(entry) + '\n' for entry in entries)
+
+    def _run(self):
+        backoff = 1.0
+        while not self._stop_event.is_set():
+            if not self._pending:
+                self._collect_batch()
+                if not self._pending:
+                    continue
+                self._save_spool()
+
+            batch, size = self._next_batch()
+            try:
+                with send_priority(PRIORITY_AUDIT):
+                    self.bot.send_message(chat_id=self.chat_id, text=batch, parse_mode='HTML')
+            except telegram.error.RetryAfter as e:
+                SEND_FAILURES.inc(error=type(e).__name__)
+                self._stop_event.wait(e.retry_after)
+                continue
+            except telegram.error.BadRequest as e:
+                # The entries themselves are invalid, retrying would block the channel forever
+                logger.error(f'audit_dispatcher.py:_run(). Dropping audit entries rejected by Telegram: {e}\n{batch}')
+                SEND_FAILURES.inc(error=type(e).__name__)
+                DROPPED_ENTRIES.inc(size)
+            except telegram.error.TelegramError as e:
+                SEND_FAILURES.inc(error=type(e).__name__)
+                logger.error(f'audit_dispatcher.py:_run(). Exception sending log info to log channel: {e}. Retrying in {backoff:.0f}s')
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            backoff = 1.0
+            del self._pending[:size]
+            self._save_spool()
+
+    def _collect_batch(self):
+        try:
+            self._pending.append(self._queue.get(timeout=1.0))
+        except queue.Empty:
+            self._load_overflow()
+            return
+
+        deadline = time.monotonic() + self.batch_window
+        length = len(self._pending[-1])
+        while length < self.max_batch_chars:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            self._pending.append(entry)
+            length += len(entry) + len(self.SEPARATOR)
+
+    def _next_batch(self):
+        """Returns the text of the longest prefix of pending entries that fits in one message and its size."""
+        size, length = 0, 0
+        for entry in self._pending:
+            length += len(entry) + (len(self.SEPARATOR) if size else 0)
+            if size and length > self.max_batch_chars:
+                break
+            size += 1
+        text = self.SEPARATOR.join(self._pending[:size])
+        if len(text) > self.MAX_MESSAGE_LENGTH:
+            self._pending[0] = text = self._truncate(text)
+        return text, size
+
+    def _truncate(self, entry: str) -> str:
+        """
+        Shortens an entry that doesn't fit in one message.
+
+        Cutting the HTML could split a tag or leave one open, so the entry is reduced to its
+        text, escaped and cut between entities.
+
+        Args:
+            entry (str): HTML formatted entry longer than MAX_MESSAGE_LENGTH.
+
+        Returns:
+            str: Valid HTML of at most MAX_MESSAGE_LENGTH characters.
+        """
+        text = html.escape(html.unescape(HTML_TAG_PATTERN.sub('', entry)), quote=False)
+        if len(text) <= self.MAX_MESSAGE_LENGTH:
+            return text
+        text = text[:self.MAX_MESSAGE_LENGTH - 1]
+        amp = text.rfind('&')
+        if amp != -1 and ';' not in text[amp:]:
+            text = text[:amp]
+        return text + '…'
+
+    def _drain_queue(self):
+        while True:
+            try:
+                self._pending.append(self._queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def _spill_queue(self):
+        entries = []
+        while True:
+            try:
+                entries.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if entries:
+            SPILLED_ENTRIES.inc(len(entries))
+            self._write_overflow(entries)
+
+    def _load_overflow(self):
+        with self._overflow_lock:
+            if not os.path.exists(self.overflow_path):
+                return
+            with open(self.overflow_path, 'r', encoding='utf-8') as f:
+                self._pending.extend(json.loads(line) for line in f if line.strip())
+            self._save_spool()
+            os.remove(self.overflow_path)
+
+    def _load_spool(self) -> List[str]:
+        try:
+            with open(self.spool_path, 'r', encoding='utf-8') as f:
+                pending = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return []
+        if pending:
+            logger.info(f'audit_dispatcher.py:_load_spool(). Resending {len(pending)} undelivered audit entries')
+        return pending
+
+    def _save_spool(self):
+        try:
+            atomic_write_json(self.spool_path, self._pending)
+        except OSError as e:
+            logger.error(f'audit_dispatcher.py:_save_spool(). Failed to persist audit entries: {e}')
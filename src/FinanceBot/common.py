@@ -1,50 +1,28 @@
 from functools import wraps
 from telegram import Update
 from telegram.ext import CallbackContext
-from env import ALLOWED_USERS_FINANCE_BOT, logger
+from shared.profiling import SlowUpdateProfiler
+from users import UserRegistry
+from env import ALLOWED_USERS_FINANCE_BOT, FINANCE_BOT_ADMINS, PROFILES_DIR, PROFILING_SAMPLE_RATE, PROFILING_THRESHOLD, PROFILING_MAX_PROFILES,\
+    PROFILING_RECENT_UPDATES, USERS_FILE, FINANCE_CHANGE_DETECTION, logger
 
 
-def format_numbers(number: int) -> str:
-    """
-    Formats a number by splitting it into tuples of three digits and placing spaces between them.
-    
-    Args:
-        number (int): The number to be formatted.
-        
-    Returns:
-        str: The formatted number.
-    """
-    number = int(number)
-    if number == 0:
-        return str(number)
-
-    # Convert the number to a string and remove any leading '+' or '-'
-    number_str = str(number).lstrip('+-')
+# Opt-in profiling of the update handlers, see SlowUpdateProfiler
+profiler = SlowUpdateProfiler(PROFILES_DIR, logger, sample_rate=PROFILING_SAMPLE_RATE, threshold=PROFILING_THRESHOLD,
+                              max_profiles=PROFILING_MAX_PROFILES, recent=PROFILING_RECENT_UPDATES)
 
-    # Split the number into groups of three digits from the right
-    groups = []
-    while number_str:
-        groups.append(number_str[-3:])
-        number_str = number_str[:-3]
-
-    # Reverse the groups and join them with spaces
-    formatted_number = ' '.join(groups[::-1])
-
-    # Add the leading '+' or '-' sign if applicable
-    if number < 0:
-        formatted_number = '-' + formatted_number
-
-    return formatted_number
+# Users allowed to use the bot, reloaded when USERS_FILE changes
+users = UserRegistry(USERS_FILE, ALLOWED_USERS_FINANCE_BOT, FINANCE_BOT_ADMINS, use_inotify=FINANCE_CHANGE_DETECTION == 'inotify')
 
 
 def restricted(func):
     """
-    A decorator to restrict access to certain bot functions based on username.
+    A decorator to restrict access to certain bot functions to the users of the registry.
 
     This decorator wraps a bot function so that it only processes updates from 
-    users whose usernames are in the ALLOWED_USERS_FINANCE_BOT list. If the user 
-    is not in the list, a warning is logged and the function returns None. If the 
-    user is in the list, the original function is called as normal.
+    users in the UserRegistry (USERS_FILE, looked up by Telegram user ID). If the user 
+    is not in the registry, a warning is logged and the function returns None. If the 
+    user is in the registry, the original function is called as normal.
 
     Args:
         func (Callable): The bot function to be wrapped.
@@ -58,8 +36,43 @@ def restricted(func):
     def wrapped(self, update: Update, context: CallbackContext, *args, **kwargs):
         user = update.effective_user
         chat_id = update.effective_chat.id
-        if user.username not in ALLOWED_USERS_FINANCE_BOT:
+        if not users.is_allowed(user):
             logger.warning(f'Unauthorized access denied from User: username=@{user.username}, id={chat_id}')
             return
         return func(self, update, context, *args, **kwargs)
     return wrapped
+
+
+def admin_only(func):
+    """
+    A decorator to restrict bot functions to the admins of the user registry.
+
+    Args:
+        func (Callable): The bot function to be wrapped.
+
+    Returns:
+        Callable: The wrapped function, which ignores updates from other users.
+    """
+    @wraps(func)
+    def wrapped(self, update: Update, context: CallbackContext, *args, **kwargs):
+        user = update.effective_user
+        if not users.is_admin(user):
+            logger.warning(f'Admin command denied to User: username=@{user.username}, id={update.effective_chat.id}')
+            return
+        return func(self, update, context, *args, **kwargs)
+    return wrapped
+
+
+def profiled(func):
+    """
+    A decorator that times and samples the calls of a bot function with the profiler.
+
+    When profiling is disabled (PROFILING_SAMPLE_RATE=0) the function is returned unchanged.
+
+    Args:
+        func (Callable): The bot function to be wrapped.
+
+    Returns:
+        Callable: The wrapped function.
+    """
+    return profiler.wrap(func)
@@ -0,0 +1,177 @@
+import heapq
+import json
+import os
+import zlib
+
+from typing import Dict, Iterable, List, Optional, Tuple
+from money import from_legacy, is_current, split_evenly
+
+# Import env variables
+from env import logger
+
+
+# (debtor, creditor, amount in cents)
+Transfer = Tuple[str, str, int]
+# {debtor: {creditor: amount in cents}}, netted per pair: a pair has a debt in one direction at most
+Debts = Dict[str, Dict[str, int]]
+
+
+def split_amount(amount: int, participants: List[str]) -> Dict[str, int]:
+    """
+    Split an amount into integer shares that add up to the amount.
+
+    The remainder of the division is distributed one cent at a time over the first participants.
+
+    Args:
+        amount (int): The amount to split, in cents.
+        participants (List[str]): Participants sharing the amount.
+
+    Returns:
+        Dict[str, int]: The share of every participant.
+    """
+    return dict(zip(participants, split_evenly(amount, len(participants))))
+
+
+def minimal_transfers(balances: Dict[str, int]) -> List[Transfer]:
+    """
+    Compute transfers that bring every balance to zero.
+
+    The largest debtor repeatedly pays the largest creditor as much as possible. Every
+    transfer settles at least one participant completely, so there are at most n - 1
+    transfers for n participants with a non-zero balance, and the two heaps make it
+    O(n log n).
+
+    Args:
+        balances (Dict[str, int]): Net balance per participant, positive if they are owed money. Must sum up to zero.
+
+    Returns:
+        List[Transfer]: The transfers, largest first.
+    """
+    creditors = [(-balance, participant) for participant, balance in balances.items() if balance > 0]
+    debtors = [(balance, participant) for participant, balance in balances.items() if balance < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        transfers.append((debtor, creditor, amount))
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, creditor))
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, debtor))
+    return transfers
+
+
+def net_loans(debts: Debts, loans: Iterable[Tuple[str, str, int]]) -> Debts:
+    """
+    Compute the changes of the debts made by loans.
+
+    A loan in the opposite direction of an existing debt reduces it first. The changes
+    hold the resulting amount of every pair the loans touch, 0 if the pair is settled, so
+    applying them again (e.g. when a journal is replayed) is harmless.
+
+    Args:
+        debts (Debts): The current debts, not modified.
+        loans (Iterable[Tuple[str, str, int]]): (lender, borrower, amount) of every loan.
+
+    Returns:
+        Debts: The changed pairs, to be applied with apply_debts().
+    """
+    changes: Debts = {}
+
+    def get(debtor: str, creditor: str) -> int:
+        if creditor in changes.get(debtor, {}):
+            return changes[debtor][creditor]
+        return debts.get(debtor, {}).get(creditor, 0)
+
+    for lender, borrower, amount in loans:
+        if amount <= 0 or lender == borrower:
+            continue
+        net = get(borrower, lender) + amount - get(lender, borrower)
+        changes.setdefault(lender, {})[borrower] = max(0, -net)
+        changes.setdefault(borrower, {})[lender] = max(0, net)
+    return changes
+
+
+def split_loans(payer: str, shares: Dict[str, int]) -> List[Tuple[str, str, int]]:
+    """
+    Args:
+        payer (str): The participant who paid an expense.
+        shares (Dict[str, int]): The share of the expense of every participant (the payer's own share is ignored).
+
+    Returns:
+        List[Tuple[str, str, int]]: The expense as loans of the payer to the other participants.
+    """
+    return [(payer, participant, share) for participant, share in shares.items() if participant != payer]
+
+
+def settle_all(debts: Debts) -> Debts:
+    """
+    Returns:
+        Debts: The changes clearing every debt.
+    """
+    return {debtor: {creditor: 0 for creditor in creditors} for debtor, creditors in debts.items()}
+
+
+def apply_debts(debts: Debts, changes: Debts):
+    """
+    Apply changes computed by net_loans() or settle_all() in place.
+
+    Args:
+        debts (Debts): The debts to change.
+        changes (Debts): Resulting amount per pair, 0 removes the pair.
+    """
+    for debtor, creditors in changes.items():
+        for creditor, amount in creditors.items():
+            if amount:
+                debts.setdefault(debtor, {})[creditor] = amount
+            elif creditor in debts.get(debtor, {}):
+                del debts[debtor][creditor]
+                if not debts[debtor]:
+                    del debts[debtor]
+
+
+def debt_balances(debts: Debts) -> Dict[str, int]:
+    """
+    Returns:
+        Dict[str, int]: Net balance of every participant with open debts, positive if they are owed money.
+    """
+    balances: Dict[str, int] = {}
+    for debtor, creditors in debts.items():
+        for creditor, amount in creditors.items():
+            balances[debtor] = balances.get(debtor, 0) - amount
+            balances[creditor] = balances.get(creditor, 0) + amount
+    return balances
+
+
+def plan_id(debts: Debts) -> int:
+    """
+    Identify the state of the debts a settlement plan was made for, the same in every process.
+
+    Returns:
+        int: Checksum of the debts.
+    """
+    return zlib.crc32(json.dumps(debts, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+
+
+def load_debts_file(debts_path: str) -> Optional[Debts]:
+    """
+    Read a debts.json file written before the debts were kept in the finance storage.
+
+    Args:
+        debts_path (str): Path to the file of the form {"format": 2, "debts": {...}} or {debtor: {creditor: dollars}}.
+
+    Returns:
+        Optional[Debts]: The debts in cents, None if the file doesn't exist.
+    """
+    if not os.path.exists(debts_path):
+        return None
+    with open(debts_path, 'r') as f:
+        document = json.load(f)
+    if is_current(document):
+        return document['debts']
+    logger.info(f'debts.py:load_debts_file(). Converting the debts of {debts_path} to cents')
+    return {debtor: {creditor: from_legacy(amount) for creditor, amount in creditors.items()} for debtor, creditors in document.items()}
@@ -9,6 +9,55 @@ from shared.shared_env import *
 FINANCE_INFO_FILE: str = os.path.join(BASE_DIR, 'data/finance_info.json')
 LOG_FILE_PATH: str = os.path.join(BASE_DIR, 'logs/finance_bot.log')
 FINANCIAL_ACTIVITY_LOG_FILE_PATH: str = os.path.join(BASE_DIR, 'logs/financial_activity.log')
+# Base path of the JSON lines activity log segments (financial_activity.000001.jsonl + .idx, ...)
+ACTIVITY_LOG_PATH: str = os.path.join(BASE_DIR, 'logs/financial_activity')
+FINANCE_DB_FILE: str = os.path.join(BASE_DIR, 'data/finance.db')
+# Directory of the per-group ledgers (one subdirectory per chat id)
+LEDGERS_DIR: str = os.path.join(BASE_DIR, 'data/ledgers')
+AUDIT_SPOOL_FILE: str = os.path.join(BASE_DIR, 'data/audit_spool.json')
+# Debts file of older versions, imported into the finance storage on startup
+DEBTS_FILE: str = os.path.join(BASE_DIR, 'data/debts.json')
+HISTORY_INDEX_FILE: str = os.path.join(BASE_DIR, 'data/history_index.json')
+# Users allowed to use the bot, keyed by Telegram user ID (created from ALLOWED_USERS_FINANCE_BOT and FINANCE_BOT_ADMINS)
+USERS_FILE: str = os.path.join(BASE_DIR, 'data/users.json')
+# ID of the last update processed, polling resumes after it on restart
+UPDATE_CHECKPOINT_FILE: str = os.path.join(BASE_DIR, 'data/update_checkpoint.json')
+# Profiles of slow updates (see PROFILING_SAMPLE_RATE)
+PROFILES_DIR: str = os.path.join(BASE_DIR, 'logs/profiles')
+
+# Storage backend used by FinanceProcessor: 'ledger' (JSON snapshot + journal) or 'sqlite'
+FINANCE_STORAGE_BACKEND: str = os.environ.get('FINANCE_STORAGE_BACKEND', 'ledger').lower()
+
+# How the ledger backend notices changes made by other processes: 'inotify', 'stat' or 'lock' (reload under the lock on every read)
+FINANCE_CHANGE_DETECTION: str = os.environ.get('FINANCE_CHANGE_DETECTION', 'inotify').lower()
+
+# Audit channel delivery: capacity of the in-memory queue and how long (s) entries are coalesced into one message
+AUDIT_QUEUE_SIZE: int = int(os.environ.get('AUDIT_QUEUE_SIZE', 1000))
+AUDIT_BATCH_WINDOW: float = float(os.environ.get('AUDIT_BATCH_WINDOW', 1.0))
+
+# Maximum size (bytes) of one part of a log export, Telegram bots can upload documents up to 50 MB
+LOG_EXPORT_PART_SIZE: int = int(os.environ.get('LOG_EXPORT_PART_SIZE', 45 * 1024 * 1024))
+
+# Give every group chat its own ledger (private chats always share the default one), how many idle group
+# ledgers are kept in memory and after how many seconds of inactivity a group ledger is unloaded
+MULTI_LEDGER: bool = os.environ.get('MULTI_LEDGER', 'false').lower() in ('1', 'true', 'yes')
+LEDGER_CACHE_SIZE: int = int(os.environ.get('LEDGER_CACHE_SIZE', 100))
+LEDGER_IDLE_TTL: float = float(os.environ.get('LEDGER_IDLE_TTL', 1800))
+
+# Maximum number of rows of a bulk import
+IMPORT_MAX_ROWS: int = int(os.environ.get('IMPORT_MAX_ROWS', 100000))
+
+# Number of participant buttons per row of the inline keyboards
+PARTICIPANT_KEYBOARD_COLUMNS: int = int(os.environ.get('PARTICIPANT_KEYBOARD_COLUMNS', 3))
+
+# Maximum number of transactions shown by /history for a period, keeps the reply below Telegram's message length limit
+HISTORY_PERIOD_LIMIT: int = 20
+
+# Number of journal records after which FinanceProcessor (and the history index) writes a compacted snapshot
+FINANCE_SNAPSHOT_INTERVAL: int = int(os.environ.get('FINANCE_SNAPSHOT_INTERVAL', 500))
+
+# Number of recent update IDs a ledger remembers to reject updates that are delivered again
+FINANCE_APPLIED_UPDATES: int = int(os.environ.get('FINANCE_APPLIED_UPDATES', 10000))
 
 
 SUCCESS_TEXT: str = '✅ Done!'
@@ -21,18 +70,69 @@ BALANCE_CHANGE_TEXT: str = '🦍 New income/expenditure'
 GET_LOGS_TEXT: str = '⬆️ Download logs'
 REQUEST_BALANCE_CHANGE_TEXT: str = '🔥 Enter balance change:'
 REQUEST_BALANCE_CHANGE_COMMENT_TEXT: str = '✉️ Enter explanation:'
-LOAN_NOT_IMPLEMENTED_ERROR_TEXT: str = '😢 Bot can only handle 2 users for now...'
+NOT_ENOUGH_PARTICIPANTS_TEXT: str = '😢 Loans need at least 2 users, add them with /participants'
+PARTICIPANTS_TEXT: str = '👥 Participants: %s'
+WRONG_PARTICIPANT_NAME_TEXT: str = '💩 Participant names can only contain letters, digits, _ . and - (up to 32 characters)'
 CHOOSE_LOAN_LENDER_TEXT: str = '🥸 Choose a user to be a lender:'
+CHOOSE_LOAN_BORROWER_TEXT: str = '🤲 Choose a user to be a borrower:'
+NOTHING_TO_SETTLE_TEXT: str = '🤝 Nobody owes anything.'
+SETTLEMENT_TEXT: str = '<b>Transfers to settle all debts:</b>'
+SETTLED_BUTTON_TEXT: str = '✅ Mark as settled'
+SETTLEMENT_OUTDATED_TEXT: str = '🔄 The debts have changed, run /settle again.'
 WRONG_LOAN_AMMOUNT_TEXT: str = '💸 Loan amount can\'t be less than $5!'
 ENTER_LOAN_AMOUNT_TEXT: str = '🤔 How much do you want to lend? <i>(min $5)</i>'
 WRONG_SYNTAX_TEXT: str = '💩 Syntax error!'
+DIALOG_EXPIRED_TEXT: str = '⌛ The dialog has expired, please start again.'
+NO_TRANSACTIONS_TEXT: str = '🤷 No transactions in this period.'
+TRANSACTION_KIND_NAMES: dict = {'balance_change': 'Income/expenditure', 'loan': 'Loans', 'set_profits': 'Set profits', 'set_spent': 'Set expenditures', 'split': 'Split expenses', 'settlement': 'Settlements', 'add_participants': 'New participants'}
+NO_HISTORY_TEXT: str = '🤷 No transactions yet.'
+NO_SLOW_UPDATES_TEXT: str = '🤷 No updates recorded, profiling is disabled (PROFILING_SAMPLE_RATE).'
+SLOWEST_UPDATES_TEXT: str = '<b>Slowest recent updates:</b>'
+OLDER_HISTORY_TEXT: str = '⬅️ Older'
+HISTORY_PERIOD_TRUNCATED_TEXT: str = '✂️ Only the first %d transactions are shown, choose a shorter period for the others.'
+USER_ADDED_TEXT: str = '👤 %s can use the bot now.'
+USER_REMOVED_TEXT: str = '🚪 %s can\'t use the bot anymore.'
+UNKNOWN_USER_TEXT: str = '🤷 There is no such user.'
+LAST_ADMIN_TEXT: str = '🚫 The last admin can\'t be removed.'
+IMPORT_HELP_TEXT: str = '''📥 Send a CSV file or /import followed by one transaction per line:
+
+<code>balance,amount,comment</code>
+<code>loan,amount,lender,borrower</code>'''
+IMPORT_FAILED_TEXT: str = '🚫 Nothing was imported, %d rows are invalid:'
+IMPORT_TOO_LARGE_TEXT: str = '🐘 Imports are limited to %d rows and 20 MB.'
+IMPORT_DONE_TEXT: str = '✅ Imported %d transactions.'
+EXPORT_PROGRESS_TEXT: str = '⏳ Exporting logs: %d%%'
+EXPORT_DONE_TEXT: str = '📦 Exported %d log records.'
+NO_LOG_RECORDS_TEXT: str = '🤷 No log records match the filter.'
 HELPER_TEXT: str = '''🗣 <b>Bot's commands:</b>
 
 /start 
 
 /set_profits user amount <i># Set profits for the user</i>
 
-/set_spent user amount <i># Set expenditures of the user</i>'''
+/set_spent user amount <i># Set expenditures of the user</i>
+
+/participants [name ...] <i># Show the participants or add new ones</i>
+
+/split payer amount [user ...] <i># Split an expense paid by payer between the users (everybody by default)</i>
+
+/settle <i># Show the transfers that settle all debts</i>
+
+/import <i># Import transactions from a CSV file or the following lines</i>
+
+/report [from] [to] <i># Sum up transactions between two dates (YYYY-MM-DD or YYYY-MM, defaults to the current month)</i>
+
+/history [n] <i># Show the last n transactions (10 by default)</i>
+
+/history from [to] <i># Show the transactions between two dates (as for /report)</i>
+
+/logs [from] [to] [level] <i># Download the logs, optionally only between two dates and from a level (e.g. WARNING)</i>
+
+/slowest [n] <i># Show the n slowest recent updates (admins only, needs profiling enabled)</i>
+
+/add_user id|@username [admin] <i># Allow a user to use the bot (admins only)</i>
+
+/remove_user id|@username <i># Revoke the access of a user (admins only)</i>'''
 
 
 # Create a logger
@@ -1,17 +1,43 @@
+import csv
+import html
+import io
+import os
 import re
+import tempfile
+import time
 import telegram
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
+from datetime import date, datetime, timedelta
+from itertools import islice
+from typing import Iterable, List, Optional, Tuple
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyMarkup, Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import CommandHandler, Updater, MessageHandler, Filters, CallbackContext, CallbackQueryHandler
-from common import format_numbers, restricted
-from finance_processor import FinanceProcessor
+from activity_log import Position
+from audit_dispatcher import AuditDispatcher
+from debts import split_amount, split_loans
+from common import admin_only, profiled, profiler, restricted, users
+from importer import parse_rows
+from ledgers import LedgerBundle, LedgerRegistry, with_ledger
+from money import CENTS, format_amount, parse_amount
 from shared.handlers import CHandler
+from shared.log_export import LEVELS, LogExport
+from shared.metrics import instrument_handler
+from shared.outbound import PRIORITY_LOGS, send_priority
+from shared.runner import run_updater
 
 # Import environemt variables
 from env import BALANCE_CHANGE_TEXT, CANCEL_TEXT, ENTER_LOAN_AMOUNT_TEXT, ERROR_TEXT, FINANCE_BOT_TOKEN, FINANCIAL_ACTIVITY_LOG_FILE_PATH, GET_LOGS_TEXT, GREETING_TEXT, HELPER_TEXT, LEND_MONEY_TEXT, LOG_FILE_PATH,\
-    PROFITS_TEXT, REQUEST_BALANCE_CHANGE_TEXT, SUCCESS_TEXT, FINANCE_LOGS_CHANNEL_ID, FINANCE_BOT_PARTICIPANTS, LOAN_NOT_IMPLEMENTED_ERROR_TEXT,\
-    CHOOSE_LOAN_LENDER_TEXT, WRONG_LOAN_AMMOUNT_TEXT, WRONG_SYNTAX_TEXT, REQUEST_BALANCE_CHANGE_COMMENT_TEXT, logger, action_logger
+    PROFITS_TEXT, REQUEST_BALANCE_CHANGE_TEXT, SUCCESS_TEXT, FINANCE_LOGS_CHANNEL_ID, NOT_ENOUGH_PARTICIPANTS_TEXT,\
+    CHOOSE_LOAN_LENDER_TEXT, WRONG_LOAN_AMMOUNT_TEXT, WRONG_SYNTAX_TEXT, REQUEST_BALANCE_CHANGE_COMMENT_TEXT, AUDIT_SPOOL_FILE, AUDIT_QUEUE_SIZE, AUDIT_BATCH_WINDOW,\
+    TELEGRAM_API_URL, FINANCE_BOT_WEBHOOK_URL, FINANCE_BOT_WEBHOOK_PORT, CONVERSATION_TTL, CONVERSATION_MAX_ENTRIES, DIALOG_EXPIRED_TEXT,\
+    NO_TRANSACTIONS_TEXT, TRANSACTION_KIND_NAMES, LOG_EXPORT_PART_SIZE, EXPORT_PROGRESS_TEXT, EXPORT_DONE_TEXT, NO_LOG_RECORDS_TEXT,\
+    NO_HISTORY_TEXT, OLDER_HISTORY_TEXT, HISTORY_PERIOD_LIMIT, HISTORY_PERIOD_TRUNCATED_TEXT, CHOOSE_LOAN_BORROWER_TEXT, NOTHING_TO_SETTLE_TEXT, SETTLEMENT_TEXT,\
+    SETTLED_BUTTON_TEXT, SETTLEMENT_OUTDATED_TEXT, PARTICIPANT_KEYBOARD_COLUMNS, IMPORT_MAX_ROWS, IMPORT_HELP_TEXT, IMPORT_FAILED_TEXT,\
+    IMPORT_TOO_LARGE_TEXT, IMPORT_DONE_TEXT, MULTI_LEDGER, LEDGER_CACHE_SIZE, LEDGER_IDLE_TTL, PARTICIPANTS_TEXT, WRONG_PARTICIPANT_NAME_TEXT,\
+    NO_SLOW_UPDATES_TEXT, SLOWEST_UPDATES_TEXT, UPDATE_CHECKPOINT_FILE, USER_ADDED_TEXT, USER_REMOVED_TEXT, UNKNOWN_USER_TEXT, LAST_ADMIN_TEXT,\
+    logger, action_logger
 
 
 class FinanceBot:
@@ -27,14 +53,13 @@ class FinanceBot:
     def dialog_default_keyboard(self) -> ReplyKeyboardMarkup:
         return ReplyKeyboardMarkup([[CANCEL_TEXT]], resize_keyboard=True, one_time_keyboard=False)
     
-    @staticmethod
-    def log_action(update: Update, context: CallbackContext, action: str):
+    def log_action(self, update: Update, context: CallbackContext, action: str):
         """
         Logs an action to both a specified Telegram channel and a local log file.
 
-        This method attempts to send a log message to a specified Telegram channel,
-        and always writes the log message to a local log file. If sending the log
-        message to the Telegram channel fails, an error is logged.
+        The log message is written to a local log file right away and queued for the
+        Telegram channel. The AuditDispatcher delivers it in the background, so the
+        handler doesn't wait for the channel, and retries failed sends.
 
         Args:
             update (Update): The update event triggering the log action.
@@ -44,29 +69,71 @@ class FinanceBot:
         Returns:
             None
         """
-        # Send log message to log channel and saves it to a local file
-        try:
-            context.bot.send_message(chat_id=FINANCE_LOGS_CHANNEL_ID, text=action, parse_mode='HTML')
-        except telegram.error.TelegramError as e:
-            logger.error(f'finance_bot.py:log_action(). Exception sending log info to log channel: {e}')
+        # Tell the ledgers of different groups apart in the shared log channel
+        if self.ledgers.key(update.effective_chat) != 'default':
+            action = f'[{update.effective_chat.title or update.effective_chat.id}] {action}'
+
+        # Queue log message for the log channel and save it to a local file
+        self.audit_dispatcher.submit(action)
         action_logger.info(action)
 
     @staticmethod
-    def build_loan_keyboard() -> InlineKeyboardMarkup:
+    def profits_report(ledger: LedgerBundle) -> str:
+        """
+        Build the HTML report about the profits and payouts of every participant of a ledger.
+
+        The rendered report is cached and only rebuilt after the financial data has changed.
+
+        Args:
+            ledger (LedgerBundle): The ledger.
+
+        Returns:
+            str: The report text.
+        """
+        finance_data = ledger.processor.get_data()
+        version, report = ledger.profits_report
+        if version == ledger.processor.version:
+            return report
+
+        version = ledger.processor.version
+        totals = ledger.processor.get_totals()
+        response = '<b>Profit:</b>\n\n'
+        for user, user_finances in finance_data.items():
+            response += f'💵 <i>{user}</i>: {format_amount(user_finances["profits"])}$\n'
+        response += f'\n💵 <i>Total profit</i>: {format_amount(totals["profits"])}$\n\n'
+        for user, user_finances in finance_data.items():
+            if user_finances['spent'] != 0:
+                response += f'💎 <i>Paid out {user}</i>: {format_amount(user_finances["spent"])}$\n'
+        response = response.rstrip('\n')
+        ledger.profits_report = (version, response)
+        return response
+
+    @staticmethod
+    def build_participant_keyboard(callback_prefix: str, participants: List[str], exclude: Optional[str] = None) -> InlineKeyboardMarkup:
         """
         Build an InlineKeyboardMarkup with buttons for each participant.
 
-        The buttons are arranged in a single-column layout, and each button's
-        callback data is a string of the format "loan|{participant}".
+        The buttons are arranged in rows of PARTICIPANT_KEYBOARD_COLUMNS buttons, and each
+        button's callback data is a string of the format "{callback_prefix}|{participant}".
+
+        Args:
+            callback_prefix (str): Prefix of the callback data.
+            participants (List[str]): Participants of the ledger.
+            exclude (Optional[str]): Participant left out of the keyboard.
 
         Returns:
             InlineKeyboardMarkup: The constructed keyboard.
         """
-        keyboard = [[InlineKeyboardButton(participant, callback_data=f'loan|{participant}')] for participant in FINANCE_BOT_PARTICIPANTS]
+        buttons = [InlineKeyboardButton(participant, callback_data=f'{callback_prefix}|{participant}') for participant in participants if participant != exclude]
+        keyboard = [buttons[i:i + PARTICIPANT_KEYBOARD_COLUMNS] for i in range(0, len(buttons), PARTICIPANT_KEYBOARD_COLUMNS)]
         return InlineKeyboardMarkup(keyboard)
-    
-    def __init__(self):
-        self.updater = Updater(token=FINANCE_BOT_TOKEN, use_context=True)
+
+    def __init__(self, updater: Optional[Updater] = None):
+        """
+        Args:
+            updater (Optional[Updater]): Updater to register the handlers on, e.g. one with an offline bot for benchmarks. By default one connected to Telegram with FINANCE_BOT_TOKEN.
+        """
+        self.updater = updater or Updater(token=FINANCE_BOT_TOKEN, base_url=TELEGRAM_API_URL, use_context=True)
         self.dispatcher = self.updater.dispatcher
 
         # Add start command handler
@@ -77,10 +144,54 @@ class FinanceBot:
         set_financial_data_handler = CommandHandler(['set_profits', 'set_spent'], self.set_financial_data_handler)
         self.dispatcher.add_handler(set_financial_data_handler)
 
+        # Add /report command handler (period summary from the history index)
+        report_handler = CommandHandler('report', self.report_handler)
+        self.dispatcher.add_handler(report_handler)
+
+        # Add /history command handler and the query handler of its "older" button
+        history_handler = CommandHandler('history', self.history_handler)
+        self.dispatcher.add_handler(history_handler)
+        history_query_handler = CallbackQueryHandler(self.history_query_handler, pattern=r'^history\|(\d+)\|(\d+)\|(\d+)$')
+        self.dispatcher.add_handler(history_query_handler)
+
+        # Add /logs command handler (filtered log export)
+        logs_handler = CommandHandler('logs', self.logs_handler)
+        self.dispatcher.add_handler(logs_handler)
+
+        # Add /slowest command handler (admins only, slowest updates recorded by the profiler)
+        slowest_handler = CommandHandler('slowest', self.slowest_handler)
+        self.dispatcher.add_handler(slowest_handler)
+
+        # Add /add_user and /remove_user command handlers (admins only, access to the bot)
+        add_user_handler = CommandHandler('add_user', self.add_user_handler)
+        self.dispatcher.add_handler(add_user_handler)
+        remove_user_handler = CommandHandler('remove_user', self.remove_user_handler)
+        self.dispatcher.add_handler(remove_user_handler)
+
         # Set help handler
         help_handler = CommandHandler('help', self.help_handler)
         self.dispatcher.add_handler(help_handler)
 
+        # Add the bulk import handlers (/import with pasted lines and uploaded CSV files)
+        import_handler = CommandHandler('import', self.import_text_handler)
+        self.dispatcher.add_handler(import_handler)
+        # Only CSV and plain text files, other documents sent to the bot aren't imports
+        import_documents = Filters.document.file_extension('csv') | Filters.document.mime_type('text/csv') | Filters.document.mime_type('text/plain')
+        import_document_handler = MessageHandler(import_documents, self.import_document_handler)
+        self.dispatcher.add_handler(import_document_handler)
+
+        # Add /participants command handler
+        participants_handler = CommandHandler('participants', self.participants_handler)
+        self.dispatcher.add_handler(participants_handler)
+
+        # Add /split and /settle command handlers and the query handler of the settlement button
+        split_handler = CommandHandler('split', self.split_handler)
+        self.dispatcher.add_handler(split_handler)
+        settle_handler = CommandHandler('settle', self.settle_handler)
+        self.dispatcher.add_handler(settle_handler)
+        settle_query_handler = CallbackQueryHandler(self.settle_query_handler, pattern=r'^settle\|(\d+)$')
+        self.dispatcher.add_handler(settle_query_handler)
+
         # Special handler that terminates any conversation
         cancel_handler = MessageHandler(Filters.text([CANCEL_TEXT]), self.cancel_handler)
         self.dispatcher.add_handler(cancel_handler)
@@ -89,18 +200,33 @@ class FinanceBot:
         text_handler = MessageHandler(Filters.text, self.text_handler)
         self.dispatcher.add_handler(text_handler)
 
-        # Add a loan query handler
-        loan_query_handler = CallbackQueryHandler(self.loan_query_handler, pattern=r'^loan\|(.+)$')
+        # Add the loan query handlers (lender, then borrower)
+        loan_query_handler = CallbackQueryHandler(self.loan_query_handler, pattern=r'^loan\|([^|]+)$')
         self.dispatcher.add_handler(loan_query_handler)
-
-        self.finance_processor: FinanceProcessor = FinanceProcessor()
-        self.c_handler = CHandler()
+        borrower_query_handler = CallbackQueryHandler(self.borrower_query_handler, pattern=r'^borrower\|([^|]+)\|([^|]+)$')
+        self.dispatcher.add_handler(borrower_query_handler)
+
+        self.ledgers = LedgerRegistry(multi_ledger=MULTI_LEDGER, max_loaded=LEDGER_CACHE_SIZE, idle_ttl=LEDGER_IDLE_TTL)
+        self.c_handler = CHandler(ttl=CONVERSATION_TTL, max_entries=CONVERSATION_MAX_ENTRIES, on_expire=self.dialog_expired)
+        self.audit_dispatcher = AuditDispatcher(self.updater.bot, FINANCE_LOGS_CHANNEL_ID, AUDIT_SPOOL_FILE,
+                                                max_queue_size=AUDIT_QUEUE_SIZE, batch_window=AUDIT_BATCH_WINDOW)
+        # Log exports read hundreds of MB, they run one at a time off the update threads
+        self.log_export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='log-export')
+        # Expiry notices are sent off the thread that evicted the dialog (another chat's handler or the sweeper)
+        self.dialog_notify_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dialog-expired')
 
     def run(self):
         # Start the bot
-        self.updater.start_polling()
-        self.updater.idle()
-
+        self.audit_dispatcher.start()
+        run_updater(self.updater, logger, webhook_url=FINANCE_BOT_WEBHOOK_URL, webhook_port=FINANCE_BOT_WEBHOOK_PORT,
+                    checkpoint_file=UPDATE_CHECKPOINT_FILE)
+        self.log_export_executor.shutdown(wait=False)
+        self.dialog_notify_executor.shutdown(wait=False)
+        self.ledgers.close()
+        self.audit_dispatcher.stop()
+
+    @instrument_handler
+    @profiled
     @restricted
     def start(self, update: Update, context: CallbackContext):
         user = update.effective_user
@@ -109,6 +235,8 @@ class FinanceBot:
         # Send message with reply keyboard
         context.bot.send_message(chat_id=chat_id, text=GREETING_TEXT % ('@' + user.username), parse_mode='HTML', reply_markup=self.default_keyboard)
 
+    @instrument_handler
+    @profiled
     @restricted
     def help_handler(self, update: Update, context: CallbackContext):
         chat_id = update.effective_chat.id
@@ -116,8 +244,321 @@ class FinanceBot:
         # Send message with reply keyboard
         context.bot.send_message(chat_id=chat_id, text=HELPER_TEXT, parse_mode='HTML', reply_markup=self.default_keyboard)
 
+    @staticmethod
+    def history_page(ledger: LedgerBundle, position: Optional[Position], n: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+        """
+        Render n activity log entries preceding a position, with a button to the older ones.
+
+        Args:
+            ledger (LedgerBundle): The ledger.
+            position (Optional[Position]): Position in the activity log, None for the newest entries.
+            n (int): Number of entries.
+
+        Returns:
+            Tuple[str, Optional[InlineKeyboardMarkup]]: The message text and keyboard.
+        """
+        entries, older = ledger.activity_log.read_before(position, n)
+        if not entries:
+            return NO_HISTORY_TEXT, None
+
+        keyboard = None
+        if older is not None:
+            keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(OLDER_HISTORY_TEXT, callback_data=f'history|{older[0]}|{older[1]}|{n}')]])
+        return FinanceBot.render_history(entries), keyboard
+
+    @staticmethod
+    def history_period(ledger: LedgerBundle, start: date, end: date) -> str:
+        """
+        Render the activity log entries of a period, oldest first, at most HISTORY_PERIOD_LIMIT of them.
+
+        Args:
+            ledger (LedgerBundle): The ledger.
+            start (date): First day of the period.
+            end (date): Last day of the period.
+
+        Returns:
+            str: The message text.
+        """
+        first = datetime.combine(start, datetime.min.time()).timestamp()
+        last = datetime.combine(end, datetime.max.time()).timestamp()
+        entries = list(islice(ledger.activity_log.read_range(first, last), HISTORY_PERIOD_LIMIT + 1))
+        if not entries:
+            return NO_TRANSACTIONS_TEXT
+
+        response = f'<b>History {start.isoformat()} — {end.isoformat()}:</b>\n' + FinanceBot.render_history(entries[:HISTORY_PERIOD_LIMIT])
+        if len(entries) > HISTORY_PERIOD_LIMIT:
+            response += '\n' + HISTORY_PERIOD_TRUNCATED_TEXT % HISTORY_PERIOD_LIMIT
+        return response
+
+    @staticmethod
+    def render_history(entries: List[dict]) -> str:
+        """Render activity log entries, one or two lines each."""
+        response = ''
+        for entry in entries:
+            amounts = ', '.join(f'{html.escape(user)} {format_amount(amount)}$' for user, amount in entry['amounts'].items())
+            response += f'🕑 <i>{time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["ts"]))}</i> {TRANSACTION_KIND_NAMES.get(entry["kind"], entry["kind"])}: {amounts}\n'
+            if entry.get('comment'):
+                # Keep a full page below Telegram's message length limit
+                comment = entry['comment'] if len(entry['comment']) <= 100 else entry['comment'][:99] + '…'
+                response += f'✉️ {html.escape(comment)}\n'
+        return response.rstrip('\n')
+
+    @instrument_handler
+    @profiled
+    @restricted
+    @with_ledger
+    def history_handler(self, update: Update, context: CallbackContext, ledger: LedgerBundle):
+        """
+        Command handler for /history [n] and /history from [to]. Shows the last n transactions, or the
+        transactions between two dates (same formats as /report).
+
+        Args:
+            update (Update): The current update instance.
+            context (CallbackContext): The context as provided by the library.
+            ledger (LedgerBundle): The ledger of the chat.
+        """
+        chat_id = update.effective_chat.id
+        if context.args and not context.args[0].isdigit():
+            period = self.parse_report_period(context.args)
+            if period is None:
+                return context.bot.send_message(chat_id=chat_id, text=WRONG_SYNTAX_TEXT)
+            return context.bot.send_message(chat_id=chat_id, text=self.history_period(ledger, *period), parse_mode='HTML')
+
+        try:
+            n = int(context.args[0]) if context.args else 10
+            if not 1 <= n <= 50:
+                raise ValueError
+        except ValueError:
+            return context.bot.send_message(chat_id=chat_id, text=WRONG_SYNTAX_TEXT)
+
+        response, keyboard = self.history_page(ledger, None, n)
+        context.bot.send_message(chat_id=chat_id, text=response, parse_mode='HTML', reply_markup=keyboard)
+
+    @instrument_handler
+    @profiled
+    @restricted
+    @with_ledger
+    def history_query_handler(self, update: Update, context: CallbackContext, ledger: LedgerBundle):
+        """Handle the "older" button of a /history message. Replaces the message with the previous page."""
+        query = update.callback_query
+        _, segment, number, n = query.data.split('|')
+        response, keyboard = self.history_page(ledger, (int(segment), int(number)), min(int(n), 50))
+        with suppress(telegram.error.TelegramError):
+            query.answer()
+        query.edit_message_text(text=response, parse_mode='HTML', reply_markup=keyboard)
+
+    @staticmethod
+    def parse_report_period(args: List[str]) -> Optional[Tuple[date, date]]:
+        """
+        Parse the arguments of the /report command.
+
+        Dates are given as YYYY-MM-DD or YYYY-MM (a whole month). Without arguments the period
+        is the current month, with one argument it ends today (or with the given month).
+
+        Args:
+            args (List[str]): The command arguments.
+
+        Returns:
+            Optional[Tuple[date, date]]: First and last day of the period, None if the arguments are invalid.
+        """
+        def parse(value: str, last_day: bool) -> date:
+            if re.fullmatch(r'\d{4}-\d{2}', value):
+                day = datetime.strptime(value, '%Y-%m').date()
+                if last_day:
+                    day = (day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+                return day
+            return datetime.strptime(value, '%Y-%m-%d').date()
+
+        today = date.today()
+        try:
+            if not args:
+                return today.replace(day=1), today
+            if len(args) == 1:
+                start = parse(args[0], last_day=False)
+                end = parse(args[0], last_day=True) if len(args[0]) == 7 else today
+            elif len(args) == 2:
+                start, end = parse(args[0], last_day=False), parse(args[1], last_day=True)
+            else:
+                return None
+        except ValueError:
+            return None
+        return (start, end) if start <= end else None
+
+    @instrument_handler
+    @profiled
     @restricted
-    def text_handler(self, update: Update, context: CallbackContext):
+    @with_ledger
+    def report_handler(self, update: Update, context: CallbackContext, ledger: LedgerBundle):
+        """
+        Command handler for /report [from] [to]. Sums up the transactions of the period per participant and kind.
+
+        Args:
+            update (Update): The current update instance.
+            context (CallbackContext): The context as provided by the library.
+            ledger (LedgerBundle): The ledger of the chat.
+        """
+        chat_id = update.effective_chat.id
+        period = self.parse_report_period(context.args)
+        if period is None:
+            return context.bot.send_message(chat_id=chat_id, text=WRONG_SYNTAX_TEXT)
+
+        start, end = period
+        rollup = ledger.history_index.report(start, end)
+        if not rollup:
+            return context.bot.send_message(chat_id=chat_id, text=NO_TRANSACTIONS_TEXT, reply_markup=self.default_keyboard)
+
+        response = f'<b>Report {start.isoformat()} — {end.isoformat()}:</b>\n'
+        for user, kinds in rollup.items():
+            response += f'\n👤 <i>{html.escape(user)}</i>\n'
+            for kind, totals in kinds.items():
+                response += f'{TRANSACTION_KIND_NAMES.get(kind, kind)}: {format_amount(totals["sum"])}$ ({totals["count"]})\n'
+        context.bot.send_message(chat_id=chat_id, text=response.rstrip('\n'), parse_mode='HTML', reply_markup=self.default_keyboard)
+
+    @instrument_handler
+    @restricted
+    @admin_only
+    def slowest_handler(self, update: Update, context: CallbackContext):
+        """
+        Command handler for /slowest [n]. Shows the n (10 by default, at most 50) slowest of the
+        recent updates recorded by the profiler, with the names of their saved profiles.
+
+        Args:
+            update (Update): The current update instance.
+            context (CallbackContext): The context as provided by the library.
+        """
+        chat_id = update.effective_chat.id
+        n = int(context.args[0]) if context.args and context.args[0].isdigit() else 10
+        slowest = profiler.slowest(min(max(n, 1), 50))
+        if not slowest:
+            return context.bot.send_message(chat_id=chat_id, text=NO_SLOW_UPDATES_TEXT, reply_markup=self.default_keyboard)
+
+        response = SLOWEST_UPDATES_TEXT + '\n'
+        for entry in slowest:
+            what = entry.get('command') or entry.get('callback') or entry['kind']
+            finished = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['time']))
+            response += f'\n⏱ {entry["duration"] * 1000:.0f} ms <code>{entry["handler"]}</code> {html.escape(what)} (chat {entry.get("chat_id")}, {finished})'
+            if entry.get('profile'):
+                response += f'\n📄 <code>{entry["profile"]}</code>'
+        context.bot.send_message(chat_id=chat_id, text=response, parse_mode='HTML', reply_markup=self.default_keyboard)
+
+    @instrument_handler
+    @restricted
+    @admin_only
+    def add_user_handler(self, update: Update, context: CallbackContext):
+        """
+        Command handler for /add_user id|@username [admin]. Allows a user to use the bot, or changes whether they are an admin.
+
+        Args:
+            update (Update): The current update instance.
+            context (CallbackContext): The context as provided by the library.
+        """
+        chat_id = update.effective_chat.id
+        if len(context.args) not in (1, 2) or (len(context.args) == 2 and context.args[1].lower() != 'admin'):
+            return context.bot.send_message(chat_id=chat_id, text=WRONG_SYNTAX_TEXT)
+
+        user = users.add(context.args[0], admin=len(context.args) == 2)
+        name = f'@{user.username}' if user.username else str(user.id)
+        self.log_action(update, context, f'User @{update.effective_user.username} allowed {name}{" as an admin" if user.admin else ""} to use the bot')
+        context.bot.send_message(chat_id=chat_id, text=USER_ADDED_TEXT % name, reply_markup=self.default_keyboard)
+
+    @instrument_handler
+    @restricted
+    @admin_only
+    def remove_user_handler(self, update: Update, context: CallbackContext):
+        """
+        Command handler for /remove_user id|@username. Revokes the access of a user.
+
+        Args:
+            update (Update): The current update instance.
+            context (CallbackContext): The context as provided by the library.
+        """
+        chat_id = update.effective_chat.id
+        if len(context.args) != 1:
+            return context.bot.send_message(chat_id=chat_id, text=WRONG_SYNTAX_TEXT)
+
+        try:
+            user = users.remove(context.args[0])
+        except ValueError:
+            return context.bot.send_message(chat_id=chat_id, text=LAST_ADMIN_TEXT)
+        if user is None:
+            return context.bot.send_message(chat_id=chat_id, text=UNKNOWN_USER_TEXT)
+        name = f'@{user.username}' if user.username else str(user.id)
+        self.log_action(update, context, f'User @{update.effective_user.username} revoked the access of {name}')
+        context.bot.send_message(chat_id=chat_id, text=USER_REMOVED_TEXT % name, reply_markup=self.default_keyboard)
+
+    @instrument_handler
+    @profiled
+    @restricted
+    def logs_handler(self, update: Update, context: CallbackContext):
+        """
+        Command handler for /logs [from] [to] [level]. Exports the log records of the period
+        (all of them without dates) with at least the given level.
+
+        Args:
+            update (Update): The current update instance.
+            context (CallbackContext): The context as provided by the library.
+        """
+        chat_id = update.effective_chat.id
+        args = list(context.args)
+        level = args.pop().upper() if args and args[-1].upper() in LEVELS else 'DEBUG'
+        start = end = None
+        if args:
+            period = self.parse_report_period(args)
+            if period is None:
+                return context.bot.send_message(chat_id=chat_id, text=WRONG_SYNTAX_TEXT)
+            start, end = period
+        self.log_export_executor.submit(self.export_logs, chat_id, [LOG_FILE_PATH, FINANCIAL_ACTIVITY_LOG_FILE_PATH], start, end, level)
+
+    def export_logs(self, chat_id: int, log_file_paths: List[str], start: Optional[date] = None, end: Optional[date] = None, level: str = 'DEBUG'):
+        """
+        Export log files with their rotated backups and upload them as gzip compressed parts.
+
+        Runs on the log export thread. The progress is shown by editing a status message.
+
+        Args:
+            chat_id (int): Chat to upload the export to.
+            log_file_paths (List[str]): Current log files to export.
+            start (Optional[date]): First day to export.
+            end (Optional[date]): Last day to export.
+            level (str): Lowest level exported.
+        """
+        bot = self.updater.bot
+        try:
+            status = bot.send_message(chat_id=chat_id, text=EXPORT_PROGRESS_TEXT % 0)
+            shown = {'percent': 0, 'at': time.monotonic()}
+            def progress(fraction: float, offset: float, share: float):
+                percent = int((offset + fraction * share) * 100)
+                # Edit at most every 3 seconds, Telegram rate limits message edits
+                if percent > shown['percent'] and time.monotonic() - shown['at'] >= 3:
+                    shown.update(percent=percent, at=time.monotonic())
+                    with suppress(telegram.error.TelegramError):
+                        status.edit_text(EXPORT_PROGRESS_TEXT % percent)
+
+            records = 0
+            with tempfile.TemporaryDirectory(prefix='log-export-') as out_dir:
+                share = 1 / len(log_file_paths)
+                for i, path in enumerate(log_file_paths):
+                    export = LogExport(path, start=start, end=end, min_level=level, part_size=LOG_EXPORT_PART_SIZE)
+                    parts = export.write_parts(out_dir, progress=lambda fraction: progress(fraction, i * share, share))
+                    records += export.records
+                    for part in parts:
+                        # Uploads wait for the interactive replies and the audit messages
+                        with open(part, 'rb') as file, send_priority(PRIORITY_LOGS):
+                            bot.send_document(chat_id=chat_id, document=file, timeout=120)
+                        os.remove(part)
+
+            with suppress(telegram.error.TelegramError):
+                status.edit_text(EXPORT_DONE_TEXT % records if records else NO_LOG_RECORDS_TEXT)
+        except Exception as e:
+            logger.error(f'finance_bot.py:export_logs(). Log export failed. Exception: {e}')
+            with suppress(telegram.error.TelegramError):
+                bot.send_message(chat_id=chat_id, text=ERROR_TEXT)
+
+    @instrument_handler
+    @profiled
+    @restricted
+    @with_ledger
+    def text_handler(self, update: Update, context: CallbackContext, ledger: LedgerBundle):
         user = update.effective_user
         chat_id = update.effective_chat.id
         text = update.message.text
@@ -129,68 +570,273 @@ class FinanceBot:
         response: str = ''
         keyboard: ReplyMarkup = self.default_keyboard
         if text == PROFITS_TEXT:
-            # Generate report about financial data
-            response = '<b>Profit:</b>\n\n'
-            finance_data = self.finance_processor.get_data()
-            for user, user_finances in finance_data.items():
-                response += f'💵 <i>{user}</i>: {format_numbers(user_finances["profits"])}$\n'
-            response += f'\n💵 <i>Total profit</i>: {format_numbers(sum(finance_data[u]["profits"] for u in finance_data))}$\n\n'
-            for user, user_finances in finance_data.items():
-                if user_finances['spent'] != 0:
-                    response += f'💎 <i>Paid out {user}</i>: {format_numbers(user_finances["spent"])}$\n'
-            response = response.rstrip('\n')
+            response = self.profits_report(ledger)
         elif text == GET_LOGS_TEXT:
             # Upload log files
-            self.send_file(update=update, context=context, filepath=LOG_FILE_PATH)
-            return self.send_file(update=update, context=context, filepath=FINANCIAL_ACTIVITY_LOG_FILE_PATH)
+            return self.log_export_executor.submit(self.export_logs, chat_id, [LOG_FILE_PATH, FINANCIAL_ACTIVITY_LOG_FILE_PATH])
         elif text == BALANCE_CHANGE_TEXT:
             self.c_handler.add_callback(chat_id=chat_id, callback=self.balance_change_handler)
             response = REQUEST_BALANCE_CHANGE_TEXT
             keyboard = self.dialog_default_keyboard
         elif text == LEND_MONEY_TEXT:
-            if len(FINANCE_BOT_PARTICIPANTS) != 2:
-                response = LOAN_NOT_IMPLEMENTED_ERROR_TEXT
+            participants = ledger.participants
+            if len(participants) < 2:
+                response = NOT_ENOUGH_PARTICIPANTS_TEXT
             else:
                 response = CHOOSE_LOAN_LENDER_TEXT
-                keyboard = self.build_loan_keyboard()
+                keyboard = self.build_participant_keyboard('loan', participants)
         else:
             return
         
         if len(response) > 0:
             context.bot.send_message(chat_id=chat_id, text=response, parse_mode='HTML', reply_markup=keyboard)
     
+    @instrument_handler
+    @profiled
     @restricted
-    def loan_query_handler(self, update: Update, context: CallbackContext):
-        """Handle an inline query that has been sent by the user. Issues a loan"""
+    @with_ledger
+    def loan_query_handler(self, update: Update, context: CallbackContext, ledger: LedgerBundle):
+        """Handle the choice of the lender of a loan. Asks for the borrower"""
         chat_id = update.effective_chat.id
         query = update.callback_query
         lender: str = query.data.split('|')[1]
 
+        # Make sure loan is given by a bot participant
+        if not ledger.is_participant(lender):
+            self.c_handler.remove_callback(chat_id)
+            return context.bot.send_message(chat_id=chat_id, text=ERROR_TEXT, parse_mode='HTML', reply_markup=self.default_keyboard)
+
+        # Replace the lender keyboard with the borrower keyboard
+        with suppress(telegram.error.TelegramError):
+            query.answer()
+        query.edit_message_text(text=CHOOSE_LOAN_BORROWER_TEXT, parse_mode='HTML', reply_markup=self.build_participant_keyboard(f'borrower|{lender}', ledger.participants, exclude=lender))
+
+    @instrument_handler
+    @profiled
+    @restricted
+    @with_ledger
+    def borrower_query_handler(self, update: Update, context: CallbackContext, ledger: LedgerBundle):
+        """Handle the choice of the borrower of a loan. Asks for the loan amount"""
+        chat_id = update.effective_chat.id
+        query = update.callback_query
+        _, lender, debtor = query.data.split('|')
+
         # Remove the message
         with suppress(Exception):
-            context.bot.delete_message(chat_id=chat_id, message_id=update.message.message_id)
+            context.bot.delete_message(chat_id=chat_id, message_id=query.message.message_id)
 
-        # Make sure loan is given to bot participants
-        if not lender in FINANCE_BOT_PARTICIPANTS:
+        # Make sure loan is given between two different bot participants
+        if not ledger.is_participant(lender) or not ledger.is_participant(debtor) or lender == debtor:
             self.c_handler.remove_callback(chat_id)
             return context.bot.send_message(chat_id=chat_id, text=ERROR_TEXT, parse_mode='HTML', reply_markup=self.default_keyboard)
-        elif len(FINANCE_BOT_PARTICIPANTS) != 2:
-            self.c_handler.remove_callback(chat_id)
-            return context.bot.send_message(chat_id=chat_id, text=LOAN_NOT_IMPLEMENTED_ERROR_TEXT, parse_mode='HTML', reply_markup=self.default_keyboard)
-
-        debtor: str = FINANCE_BOT_PARTICIPANTS[FINANCE_BOT_PARTICIPANTS.index(lender) ^ 1]
 
         # Ask user for loan amount
         self.c_handler.add_callback(chat_id=chat_id, callback=lambda update, context: self.loan_amount_handler(update, context, lender=lender, debtor=debtor))
         return context.bot.send_message(chat_id, ENTER_LOAN_AMOUNT_TEXT, parse_mode='HTML', reply_markup=self.dialog_default_keyboard)
-    
+
+    @instrument_handler
+    @profiled
+    @restricted
+    @with_ledger
+    def participants_handler(self, update: Update, context: CallbackContext, ledger: LedgerBundle):
+        """
+        Command handler for /participants [name ...]. Adds the given participants to the chat's ledger and shows all of them.
+
+        Args:
+            update (Update): The current update instance.
+            context (CallbackContext): The context as provided by the library.
+            ledger (LedgerBundle): The ledger of the chat.
+        """
+        chat_id = update.effective_chat.id
+        # Names end up in callback data, which is split on '|'
+        if any(not re.fullmatch(r'[\w.-]{1,32}', name) for name in context.args):
+            return context.bot.send_message(chat_id=chat_id, text=WRONG_PARTICIPANT_NAME_TEXT)
+
+        if context.args:
+            added = ledger.processor.add_participants(context.args)
+            if added:
+                self.log_action(update, context, f'User @{update.effective_user.username} added participants {", ".join(added)}')
+        participants = ', '.join(ledger.participants) or '-'
+        context.bot.send_message(chat_id=chat_id, text=PARTICIPANTS_TEXT % html.escape(participants), parse_mode='HTML', reply_markup=self.default_keyboard)
+
+    @instrument_handler
+    @profiled
     @restricted
-    def set_financial_data_handler(self, update: Update, context: CallbackContext):
+    @with_ledger
+    def split_handler(self, update: Update, context: CallbackContext, ledger: LedgerBundle):
+        """
+        Command handler for /split payer amount [user ...].
+
+        The expense is split in shares of whole cents between the users (all participants by default,
+        the payer included if listed) and every user owes their share to the payer.
+
+        Args:
+            update (Update): The current update instance.
+            context (CallbackContext): The context as provided by the library.
+            ledger (LedgerBundle): The ledger of the chat.
+        """
+        chat_id = update.effective_chat.id
+        if len(context.args) < 2:
+            return context.bot.send_message(chat_id=chat_id, text=WRONG_SYNTAX_TEXT)
+
+        payer, amount, *participants = context.args
+        participants = list(dict.fromkeys(participants)) or ledger.participants
+        if not ledger.is_participant(payer) or any(not ledger.is_participant(participant) for participant in participants):
+            return context.bot.send_message(chat_id=chat_id, text=WRONG_SYNTAX_TEXT)
+        amount = parse_amount(amount)
+        if amount is None or amount < 5 * CENTS:
+            return context.bot.send_message(chat_id=chat_id, text=WRONG_LOAN_AMMOUNT_TEXT, parse_mode='HTML')
+
+        shares = split_amount(amount, participants)
+        transfers = split_loans(payer, shares)
+        if transfers:
+            ledger.processor.process_transfers('split', transfers, debts=True)
+        self.log_action(update, context, f'User @{update.effective_user.username} split ${format_amount(amount)} paid by {payer} between {", ".join(participants)}')
+        context.bot.send_message(chat_id=chat_id, text=SUCCESS_TEXT, reply_markup=self.default_keyboard)
+
+    @staticmethod
+    def settlement_message(ledger: LedgerBundle) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+        """
+        Render the minimal transfers settling all debts of a ledger with a button marking them as done.
+
+        Args:
+            ledger (LedgerBundle): The ledger.
+
+        Returns:
+            Tuple[str, Optional[InlineKeyboardMarkup]]: The message text and keyboard.
+        """
+        plan, transfers = ledger.processor.settlement_plan()
+        if not transfers:
+            return NOTHING_TO_SETTLE_TEXT, None
+        response = SETTLEMENT_TEXT + '\n\n'
+        response += '\n'.join(f'💸 <i>{debtor}</i> → <i>{creditor}</i>: {format_amount(amount)}$' for debtor, creditor, amount in transfers)
+        return response, InlineKeyboardMarkup([[InlineKeyboardButton(SETTLED_BUTTON_TEXT, callback_data=f'settle|{plan}')]])
+
+    @instrument_handler
+    @profiled
+    @restricted
+    @with_ledger
+    def import_text_handler(self, update: Update, context: CallbackContext, ledger: LedgerBundle):
+        """Command handler for /import. Imports the transactions on the lines following the command"""
+        lines = update.message.text.splitlines()[1:]
+        if not lines:
+            return context.bot.send_message(chat_id=update.effective_chat.id, text=IMPORT_HELP_TEXT, parse_mode='HTML')
+        self.import_transactions(update, context, lines, source='message', ledger=ledger)
+
+    @instrument_handler
+    @profiled
+    @restricted
+    @with_ledger
+    def import_document_handler(self, update: Update, context: CallbackContext, ledger: LedgerBundle):
+        """Imports the transactions of an uploaded CSV file"""
+        document = update.message.document
+        # Bots can't download files larger than 20 MB
+        if document.file_size and document.file_size > 20 * 1024 * 1024:
+            return context.bot.send_message(chat_id=update.effective_chat.id, text=IMPORT_TOO_LARGE_TEXT % IMPORT_MAX_ROWS)
+
+        with tempfile.TemporaryDirectory(prefix='import-') as directory:
+            path = document.get_file().download(custom_path=os.path.join(directory, 'import.csv'))
+            with open(path, 'r', encoding='utf-8-sig', errors='replace', newline='') as f:
+                self.import_transactions(update, context, f, source=document.file_name or 'file', ledger=ledger)
+
+    def import_transactions(self, update: Update, context: CallbackContext, lines: Iterable[str], source: str, ledger: LedgerBundle):
+        """
+        Validate and apply imported transactions.
+
+        The lines are parsed one at a time. If any row is invalid nothing is imported and the
+        errors are reported, otherwise all rows are applied in a single FinanceProcessor
+        transaction and audited as one summary message plus a CSV attachment with every row.
+
+        Args:
+            update (Update): The current update instance.
+            context (CallbackContext): The context as provided by the library.
+            lines (Iterable[str]): Lines of CSV text.
+            source (str): Name of the import source, used in the audit message.
+            ledger (LedgerBundle): The ledger the transactions are imported into.
+        """
+        chat_id = update.effective_chat.id
+        rows, errors = [], []
+        for row, error in parse_rows(lines, set(ledger.participants)):
+            if error is not None:
+                errors.append(error)
+            else:
+                rows.append(row)
+            if len(rows) + len(errors) > IMPORT_MAX_ROWS:
+                return context.bot.send_message(chat_id=chat_id, text=IMPORT_TOO_LARGE_TEXT % IMPORT_MAX_ROWS)
+
+        if errors:
+            response = IMPORT_FAILED_TEXT % len(errors) + '\n' + '\n'.join(html.escape(str(error)) for error in errors[:10])
+            context.bot.send_message(chat_id=chat_id, text=response, parse_mode='HTML')
+            if len(errors) > 10:
+                report = io.BytesIO('\n'.join(str(error) for error in errors).encode('utf-8'))
+                context.bot.send_document(chat_id=chat_id, document=report, filename='import_errors.txt')
+            return
+        if not rows:
+            return context.bot.send_message(chat_id=chat_id, text=IMPORT_HELP_TEXT, parse_mode='HTML')
+
+        username = update.effective_user.username
+        if not ledger.processor.apply_batch(rows, comment=f'Import of {len(rows)} rows from {source} by @{username}'):
+            return context.bot.send_message(chat_id=chat_id, text=ERROR_TEXT)
+        loans = [(row.lender, row.borrower, row.amount) for row in rows if row.kind == 'loan']
+
+        balance_changes = [row.amount for row in rows if row.kind == 'balance_change']
+        self.log_action(update, context, f'User @{username} imported {len(rows)} transactions from {source}: '
+                                         f'{len(balance_changes)} balance changes (total ${format_amount(sum(balance_changes))}), '
+                                         f'{len(loans)} loans (total ${format_amount(sum(amount for _, _, amount in loans))})')
+
+        # Every imported row goes to the action log and, as one attachment, to the log channel
+        details = io.StringIO()
+        writer = csv.writer(details)
+        writer.writerow(['line', 'kind', 'amount', 'lender', 'borrower', 'comment'])
+        for row in rows:
+            writer.writerow(row._replace(amount=format_amount(row.amount, group=False)))
+            action_logger.info(f'Imported row {row.line} from {source}: {row.kind} ${format_amount(row.amount)} {row.lender} {row.borrower} {row.comment}'.rstrip())
+        try:
+            with send_priority(PRIORITY_LOGS):
+                context.bot.send_document(chat_id=FINANCE_LOGS_CHANNEL_ID, document=io.BytesIO(details.getvalue().encode('utf-8')), filename=f'import_{int(time.time())}.csv')
+        except telegram.error.TelegramError as e:
+            logger.error(f'finance_bot.py:import_transactions(). Failed to send the import details to the log channel. Exception: {e}')
+
+        context.bot.send_message(chat_id=chat_id, text=IMPORT_DONE_TEXT % len(rows), reply_markup=self.default_keyboard)
+
+    @instrument_handler
+    @profiled
+    @restricted
+    @with_ledger
+    def settle_handler(self, update: Update, context: CallbackContext, ledger: LedgerBundle):
+        """Command handler for /settle. Shows the transfers that settle all debts"""
+        response, keyboard = self.settlement_message(ledger)
+        context.bot.send_message(chat_id=update.effective_chat.id, text=response, parse_mode='HTML', reply_markup=keyboard)
+
+    @instrument_handler
+    @profiled
+    @restricted
+    @with_ledger
+    def settle_query_handler(self, update: Update, context: CallbackContext, ledger: LedgerBundle):
+        """Handle the "mark as settled" button. Clears the debts if they haven't changed since the plan was shown"""
+        query = update.callback_query
+        with suppress(telegram.error.TelegramError):
+            query.answer()
+
+        transfers = ledger.processor.settle(int(query.data.split('|')[1]))
+        if transfers is None:
+            response, keyboard = self.settlement_message(ledger)
+            return query.edit_message_text(text=f'{SETTLEMENT_OUTDATED_TEXT}\n\n{response}', parse_mode='HTML', reply_markup=keyboard)
+
+        summary = ', '.join(f'{debtor} → {creditor} ${format_amount(amount)}' for debtor, creditor, amount in transfers)
+        self.log_action(update, context, f'User @{update.effective_user.username} settled all debts: {summary}')
+        query.edit_message_text(text=SUCCESS_TEXT)
+
+    @instrument_handler
+    @profiled
+    @restricted
+    @with_ledger
+    def set_financial_data_handler(self, update: Update, context: CallbackContext, ledger: LedgerBundle):
         """
         Command handler for the /set_profits and /set_spent commands.
         
         This command requires two arguments: 'user' and 'amount'. It checks if 'user' exists 
-        in the FINANCE_BOT_PARTICIPANTS list, and if 'amount' is a positive integer greater than 5. 
+        in the participants of the chat's ledger, and if 'amount' is a number of dollars greater than 5. 
         If any condition is not met, it sends a message with the text WRONG_SYNTAX_TEXT.
         Changes corresponding data in financial records for a specified user
         
@@ -198,6 +844,7 @@ class FinanceBot:
             update (telegram.Update): The current update instance.
             context (telegram.ext.CallbackContext): The context as provided by the library. 
                 Contains the state and data from the update.
+            ledger (LedgerBundle): The ledger of the chat.
         
         Returns:
             None
@@ -212,30 +859,29 @@ class FinanceBot:
         user, amount = context.args
 
         # Check if the user exists
-        if user not in FINANCE_BOT_PARTICIPANTS:
+        if not ledger.is_participant(user):
             context.bot.send_message(chat_id=update.effective_chat.id, text=WRONG_SYNTAX_TEXT)
             return
 
-        # Check if the amount is a positive integer greater than 5
-        try:
-            amount = int(amount)
-            if amount <= 5:
-                raise ValueError
-        except ValueError:
+        # Check if the amount is greater than $5
+        amount = parse_amount(amount)
+        if amount is None or amount <= 5 * CENTS:
             return context.bot.send_message(chat_id=update.effective_chat.id, text=WRONG_SYNTAX_TEXT)
         
         # If all checks pass, update financial info
         if update.message.text.startswith('/set_profits'):
-            self.finance_processor.set_profits(user=user, amount=amount)
-            self.log_action(update, context, f'User @{username} set income of {user} to ${format_numbers(amount)}')
+            ledger.processor.set_profits(user=user, amount=amount)
+            self.log_action(update, context, f'User @{username} set income of {user} to ${format_amount(amount)}')
         elif update.message.text.startswith('/set_spent'):
-            self.finance_processor.set_spent(user=user, amount=amount)
-            self.log_action(update, context, f'User @{username} set expenditures of{user} to ${format_numbers(amount)}')
+            ledger.processor.set_spent(user=user, amount=amount)
+            self.log_action(update, context, f'User @{username} set expenditures of{user} to ${format_amount(amount)}')
         else:
             return context.bot.send_message(chat_id=update.effective_chat.id, text=WRONG_SYNTAX_TEXT)
         return self.cancel_handler(update, context)
  
         
+    @instrument_handler
+    @profiled
     @restricted
     def cancel_handler(self, update: Update, context: CallbackContext):
         """
@@ -252,33 +898,60 @@ class FinanceBot:
         self.c_handler.remove_callback(chat_id)
         context.bot.send_message(chat_id, SUCCESS_TEXT, parse_mode='HTML', reply_markup=self.default_keyboard)
 
-    def loan_amount_handler(self, update: Update, context: CallbackContext, lender: str, debtor: str):
+    def dialog_expired(self, chat_id: int, reason: str):
+        """
+        Tells the user that their unanswered dialog has been dropped by the conversation store.
+
+        Called by the store on the thread that evicted the dialog, so the message is sent
+        from dialog_notify_executor instead of blocking that thread on the Telegram API.
+
+        Args:
+            chat_id (int): The chat whose dialog has expired.
+            reason (str): Why the dialog was dropped ('expired' or 'capacity').
+        """
+        logger.info(f'finance_bot.py:dialog_expired(). Dialog of [id={chat_id}] dropped: {reason}')
+        try:
+            self.dialog_notify_executor.submit(self.send_dialog_expired, chat_id)
+        except RuntimeError:
+            # The executor has been shut down, the bot is stopping
+            pass
+
+    def send_dialog_expired(self, chat_id: int):
+        try:
+            self.updater.bot.send_message(chat_id, DIALOG_EXPIRED_TEXT, parse_mode='HTML', reply_markup=self.default_keyboard)
+        except telegram.error.TelegramError as e:
+            logger.error(f'finance_bot.py:send_dialog_expired(). Exception: {e}')
+
+    @instrument_handler
+    @profiled
+    @with_ledger
+    def loan_amount_handler(self, update: Update, context: CallbackContext, lender: str, debtor: str, ledger: LedgerBundle):
         chat_id = update.effective_chat.id
         text = update.message.text
 
         # Make sure information is correct
-        if not lender in FINANCE_BOT_PARTICIPANTS or not debtor in FINANCE_BOT_PARTICIPANTS:
+        if not ledger.is_participant(lender) or not ledger.is_participant(debtor):
             self.c_handler.remove_callback(chat_id)
             return context.bot.send_message(chat_id=chat_id, text=ERROR_TEXT, parse_mode='HTML', reply_markup=self.default_keyboard)
-        elif len(FINANCE_BOT_PARTICIPANTS) != 2:
-            self.c_handler.remove_callback(chat_id)
-            return context.bot.send_message(chat_id=chat_id, text=LOAN_NOT_IMPLEMENTED_ERROR_TEXT, parse_mode='HTML', reply_markup=self.default_keyboard)
 
         # Make sure entered amount is correct
-        if not text.isdigit() or int(text) < 5:
+        loan_amount = parse_amount(text)
+        if loan_amount is None or loan_amount < 5 * CENTS:
             self.c_handler.add_callback(chat_id=chat_id, callback=lambda update, context: self.loan_amount_handler(update, context, lender=lender, debtor=debtor))
             return context.bot.send_message(chat_id, WRONG_LOAN_AMMOUNT_TEXT, parse_mode='HTML', reply_markup=self.dialog_default_keyboard)
 
-        loan_amount: int = int(text)
-        self.log_action(update=update, context=context, action=f'User {lender} lended ${format_numbers(loan_amount)} to {debtor}')
-        self.finance_processor.process_loan(lender=lender, debtor=debtor, amount=loan_amount)
+        # The ledger is changed before the action is logged, a replayed update stops at the change
+        ledger.processor.process_loan(lender=lender, debtor=debtor, amount=loan_amount)
+        self.log_action(update=update, context=context, action=f'User {lender} lended ${format_amount(loan_amount)} to {debtor}')
         return self.cancel_handler(update=update, context=context)
 
+    @instrument_handler
+    @profiled
     def balance_change_handler(self, update: Update, context: CallbackContext):
         """
         Handles the initial phase of a user-requested change in total balance.
         The function first validates if the entered amount for balance change 
-        is a valid integer. If the input is invalid, it sends an error message back 
+        is a valid number of dollars with up to two decimals. If the input is invalid, it sends an error message back 
         to the user and requests for a new input. If the input is valid, the function
         sets a callback to the comment handler function for the next user input.
 
@@ -293,16 +966,18 @@ class FinanceBot:
         chat_id = update.effective_chat.id
         text = update.message.text
 
-        if not re.match(r'^-?\d+$', text):
+        balance_change = parse_amount(text, allow_negative=True)
+        if balance_change is None:
             self.c_handler.add_callback(chat_id=chat_id, callback=self.balance_change_handler)
             return context.bot.send_message(chat_id, ERROR_TEXT, parse_mode='HTML', reply_markup=self.dialog_default_keyboard)
-
-        balance_change = int(text)
         self.c_handler.add_callback(chat_id=chat_id, callback=lambda update, context: self.balance_change_comment_handler(update, context, balance_change=balance_change))
         return context.bot.send_message(chat_id, REQUEST_BALANCE_CHANGE_COMMENT_TEXT, parse_mode='HTML', reply_markup=self.dialog_default_keyboard)
 
 
-    def balance_change_comment_handler(self, update: Update, context: CallbackContext, balance_change: int):
+    @instrument_handler
+    @profiled
+    @with_ledger
+    def balance_change_comment_handler(self, update: Update, context: CallbackContext, balance_change: int, ledger: LedgerBundle):
         """
         Handles the second phase of a user-requested change in total balance. 
         It retrieves the comment input from the user, processes the balance change,
@@ -311,7 +986,8 @@ class FinanceBot:
         Args:
             update (Update): The update event triggering the balance change.
             context (CallbackContext): The context of the update event.
-            balance_change (int): The balance change amount provided by the user.
+            balance_change (int): The balance change amount provided by the user, in cents.
+            ledger (LedgerBundle): The ledger of the chat.
 
         Returns:
             None
@@ -319,24 +995,6 @@ class FinanceBot:
         user = update.effective_user
         chat_id = update.effective_chat.id
         comment: str = update.message.text
-        self.log_action(update=update, context=context, action=f'User @{user.username} {"decreased" if balance_change < 0 else "increased"} total account balance by ${format_numbers(balance_change)}$\nExplanation: {comment}')
-        self.finance_processor.process_balance_change(balance=balance_change)
+        ledger.processor.process_balance_change(balance=balance_change, comment=comment)
+        self.log_action(update=update, context=context, action=f'User @{user.username} {"decreased" if balance_change < 0 else "increased"} total account balance by ${format_amount(balance_change)}$\nExplanation: {comment}')
         return self.cancel_handler(update=update, context=context)
-
-    def send_file(self, update: Update, context: CallbackContext, filepath: str):
-        """
-        This function uploads a file to a user on Telegram.
-
-        Args:
-            update (Update): An object that contains information about the incoming update.
-            context (CallbackContext): An object that contains information about the current context of the update.
-            filepath (str): The path to the file to be sent.
-
-        Returns:
-            None
-        """
-        chat_id = update.effective_chat.id
-
-        # Exceptions correspond to files being empty
-        with suppress(Exception), open(filepath, 'rb') as file:
-            context.bot.send_document(chat_id=chat_id, document=file)
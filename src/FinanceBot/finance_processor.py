@@ -1,124 +1,467 @@
-import json
 import os
-from typing import Dict
-from filelock import FileLock
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from debts import Debts, Transfer, debt_balances, load_debts_file, minimal_transfers, net_loans, plan_id, settle_all
+from history import Transaction
+from importer import ImportRow
+from money import CENTS, Balances, split_evenly
+from storage import FinanceStorage, LedgerStorage
+from shared import metrics
 
 # Import env variables
-from env import FINANCE_INFO_FILE, FINANCE_BOT_PARTICIPANTS, logger
+from env import FINANCE_INFO_FILE, FINANCE_DB_FILE, FINANCE_STORAGE_BACKEND, FINANCE_CHANGE_DETECTION, FINANCE_BOT_PARTICIPANTS, FINANCE_SNAPSHOT_INTERVAL,\
+    FINANCE_APPLIED_UPDATES, logger
+
+
+LOCK_WAIT = metrics.histogram('finance_lock_wait_seconds', 'Time waited for the storage lock (FileLock of the ledger backend) before a mutation.')
+LOCK_HOLD = metrics.histogram('finance_lock_hold_seconds', 'Time the storage lock was held by a mutation, including the commit.')
+LOCK_WAITERS = metrics.gauge('finance_lock_waiters', 'Threads currently waiting for the storage lock.')
+DUPLICATE_UPDATES = metrics.counter('finance_duplicate_updates_total', 'Mutations rejected because their update had already been applied.')
+
+
+class DuplicateUpdate(Exception):
+    """Raised by a mutation made for an update whose mutation has already been applied."""
+    def __init__(self, update_id: int):
+        super().__init__(f'Update {update_id} has already been applied')
+        self.update_id = update_id
+
+
+def create_storage(initial_data: Dict[str, Dict[str, int]], info_file: str = FINANCE_INFO_FILE, db_file: str = FINANCE_DB_FILE) -> FinanceStorage:
+    """
+    Create the storage backend selected by the FINANCE_STORAGE_BACKEND env variable.
+
+    Args:
+        initial_data (Dict[str, Dict[str, int]]): Data used when the storage is empty.
+        info_file (str): Path to the JSON snapshot of the ledger backend (also imported by a new SQLite database).
+        db_file (str): Path to the SQLite database.
+
+    Returns:
+        FinanceStorage: 'sqlite' returns a SQLiteStorage, anything else a LedgerStorage.
+    """
+    if FINANCE_STORAGE_BACKEND == 'sqlite':
+        from sqlite_storage import SQLiteStorage
+        return SQLiteStorage(db_file, initial_data, json_path=info_file, applied_updates=FINANCE_APPLIED_UPDATES)
+    return LedgerStorage(info_file, initial_data, snapshot_interval=FINANCE_SNAPSHOT_INTERVAL, change_detection=FINANCE_CHANGE_DETECTION,
+                         applied_updates=FINANCE_APPLIED_UPDATES)
 
 
 class FinanceProcessor:
     """
     Processor for handling and persisting financial information of bot users.
     
-    The financial information is stored in a JSON file specified by the
-    FINANCE_INFO_FILE constant. If the file does not exist upon instantiation,
-    it is created with initial data.
+    The financial information is persisted by a pluggable storage backend (see
+    FinanceStorage). By default it is a JSON snapshot file specified by the
+    FINANCE_INFO_FILE constant and an append-only journal next to it; alternatively
+    an SQLite database. If the storage is empty upon instantiation, it is created with initial data.
+
+    Amounts are integer cents (see money.py) and the data is a column-wise Balances store.
+    A change of the total balance is split into shares that add up to it exactly.
+
+    The debts between the participants are part of the storage: loans, splits and
+    settlements change the profits and the debts in the same storage transaction, so
+    neither can be applied without the other.
     
-    A file lock is used when reading or writing to the file to ensure thread safety.
+    Every mutation runs inside a storage transaction to ensure thread and process safety.
+
+    The totals over all participants are kept up to date incrementally: a mutation adjusts
+    them by the difference it makes, and they are only summed up again when the data was
+    reloaded because another process changed the storage.
+
+    Listeners added with add_listener() receive the Transactions of every storage transaction, under its lock.
+
+    Mutations made inside applying(update_id) are idempotent per Telegram update: the
+    first one persists the update ID together with its changes, and a mutation for an
+    update the storage has already applied raises DuplicateUpdate without changing anything.
     """
-    _data: Dict[str, Dict[str, int]]
+    _storage: FinanceStorage
 
-    def __init__(self):
+    def __init__(self, storage: FinanceStorage = None, participants: Optional[List[str]] = None):
         """
-        Initialize the FinanceProcessor, creating the financial data file if necessary.
+        Initialize the FinanceProcessor, creating the storage if necessary.
+
+        Args:
+            storage (FinanceStorage): Storage to use instead of the one selected by the env config.
+            participants (Optional[List[str]]): Users of a new storage, FINANCE_BOT_PARTICIPANTS by default.
         """
-        self.lock = FileLock(FINANCE_INFO_FILE + '.lock')
-        if not os.path.exists(FINANCE_INFO_FILE):
-            initial_data = {participant: {'profits': 0.0, 'spent': 0.0} for participant in FINANCE_BOT_PARTICIPANTS}
-            with self.lock:
-                with open(FINANCE_INFO_FILE, 'w') as f:
-                    json.dump(initial_data, f)
-        self._refresh_data()
+        participants = FINANCE_BOT_PARTICIPANTS if participants is None else participants
+        initial_data = {participant: {'profits': 0, 'spent': 0} for participant in participants}
+        self._storage = storage or create_storage(initial_data)
+        self._totals_lock = threading.Lock()
+        self._totals = {'profits': 0, 'spent': 0}
+        # Storage version the totals correspond to, -1 forces a recount
+        self._totals_version = -1
+        self._listeners: List[Callable[[List[Transaction]], None]] = []
+        # Transactions recorded by the storage transaction in progress
+        self._pending: List[Transaction] = []
+        # [update ID, whether a mutation has recorded it] of the thread's applying() context
+        self._local = threading.local()
+
+    @property
+    def _data(self) -> Balances:
+        return self._storage.data
+
+    @property
+    def storage(self) -> FinanceStorage:
+        return self._storage
+
+    @property
+    def version(self) -> int:
+        """
+        Version of the financial data, changes whenever the data does. Refresh first (e.g. with get_data())
+        to include changes made by other processes.
+        """
+        return self._storage.version
 
     def _refresh_data(self):
         """
-        Load the financial data from the file into the _data attribute.
+        Apply changes committed by other processes to the in-memory data.
+        """
+        self._storage.refresh()
 
-        The file is locked during the operation to prevent concurrent modifications.
+    def get_data(self) -> Balances:
         """
-        with self.lock:
-            with open(FINANCE_INFO_FILE, 'r') as f:
-                self._data = json.load(f)
+        Refresh and return the financial data of the bot users.
+
+        The in-memory data is returned as is (no copy) and is only reloaded if another
+        process has changed the storage, so callers must not modify it.
+
+        The data reads like a nested dictionary where the outer dictionary's keys are
+        usernames and the values are inner dictionaries with keys 'profits' and 'spent' in cents.
 
-    def _update_data(self):
+        Returns:
+            Balances: The financial data of the bot users.
         """
-        Save the current financial data from the _data attribute to the file.
+        self._refresh_data()
+        return self._data
 
-        The file is locked during the operation to prevent concurrent modifications.
+    def get_debts(self) -> Debts:
         """
-        with self.lock:
-            with open(FINANCE_INFO_FILE, 'w') as f:
-                json.dump(self._data, f)
+        Refresh and return the open debts as {debtor: {creditor: amount in cents}}. Callers must not modify them.
 
-    def get_data(self) -> Dict[str, Dict[str, int]]:
+        Returns:
+            Debts: The debts.
         """
-        Refresh and return the financial data of the bot users.
+        self._refresh_data()
+        return self._storage.debts
+
+    def settlement_plan(self) -> Tuple[int, List[Transfer]]:
+        """
+        Returns:
+            Tuple[int, List[Transfer]]: ID of the current debts (see settle()) and the minimal transfers settling every debt.
+        """
+        debts = self.get_debts()
+        return plan_id(debts), minimal_transfers(debt_balances(debts))
+
+    def settle(self, plan: int) -> Optional[List[Transfer]]:
+        """
+        Clear every debt and apply the transfers of the settlement plan to the profits, as they have been made.
+
+        Args:
+            plan (int): ID returned by settlement_plan().
+
+        Returns:
+            Optional[List[Transfer]]: The transfers that settled the debts, None if the debts changed since the plan was made.
+        """
+        with self._transaction():
+            debts = self._storage.debts
+            if plan_id(debts) != plan:
+                return None
+            transfers = minimal_transfers(debt_balances(debts))
+            if transfers:
+                self._record_transfers('settlement', transfers, debts=settle_all(debts))
+        return transfers
+
+    def import_debts(self, debts_path: str):
+        """
+        Move the debts of a debts.json file, where they were kept before, into the storage.
+
+        The file is renamed to <name>.imported once its debts are committed.
+
+        Args:
+            debts_path (str): Path to the file.
+        """
+        with self._transaction():
+            debts = load_debts_file(debts_path)
+            if debts is None:
+                return
+            if debts:
+                self._record('import_debts', {}, amounts={}, transactions=[], debts={debtor: dict(creditors) for debtor, creditors in debts.items()})
+            os.replace(debts_path, debts_path + '.imported')
+        logger.info(f'finance_processor.py:import_debts(). Imported the debts of {debts_path}')
+
+    def add_participants(self, users: List[str]) -> List[str]:
+        """
+        Add users with empty financial data.
+
+        Args:
+            users (List[str]): Names of the users.
 
-        The data returned is a nested dictionary where the outer dictionary's keys
-        are usernames and the values are inner dictionaries with keys 'profits' and 'spent'.
+        Returns:
+            List[str]: The users that didn't exist yet and were added.
+        """
+        with self._transaction():
+            added = [user for user in dict.fromkeys(users) if user not in self._data]
+            if added:
+                self._record('add_participants', {user: {'profits': 0, 'spent': 0} for user in added}, amounts={})
+        return added
+
+    def close(self):
+        """
+        Release the storage.
+        """
+        self._storage.close()
+
+    def get_totals(self) -> Dict[str, int]:
+        """
+        Refresh and return the profits and spent values in cents summed over all users.
 
         Returns:
-            Dict[str, Dict[str, int]]: The financial data of the bot users.
+            Dict[str, int]: Dictionary with keys 'profits' and 'spent'.
         """
         self._refresh_data()
-        return self._data
+        with self._totals_lock:
+            version = self._storage.version
+            if self._totals_version != version:
+                self._totals = self._data.totals()
+                self._totals_version = version
+            return dict(self._totals)
+
+    def add_listener(self, listener: Callable[[List[Transaction]], None]):
+        """
+        Register a function called with the transactions of every storage transaction.
+
+        Listeners are called at the end of the storage transaction, while it holds the lock, in the
+        thread that made the change: they are called in commit order and one at a time, and must not
+        start another storage transaction.
+
+        Args:
+            listener (Callable[[List[Transaction]], None]): The function to call.
+        """
+        self._listeners.append(listener)
 
-    def process_balance_change(self, balance: int):
+    @contextmanager
+    def applying(self, update_id: Optional[int]) -> Iterator[None]:
+        """
+        Context manager tagging the mutations made by the current thread with the update that causes them.
+
+        Nested contexts for the same update share its state, so a dialog step that calls
+        another handler still applies the update once.
+
+        Args:
+            update_id (Optional[int]): ID of the Telegram update, None for mutations that aren't caused by one.
+        """
+        previous = getattr(self._local, 'update', None)
+        if previous is not None and previous[0] == update_id:
+            yield
+            return
+        self._local.update = [update_id, False] if update_id is not None else None
+        try:
+            yield
+        finally:
+            self._local.update = previous
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        """
+        Storage transaction that notifies the listeners about the recorded transactions before releasing the lock.
+
+        The time spent waiting for and holding the storage lock (including the listeners) is recorded in the metrics.
+        """
+        LOCK_WAITERS.inc()
+        waiting = True
+        started = time.perf_counter()
+        try:
+            with self._storage.transaction():
+                acquired = time.perf_counter()
+                LOCK_WAITERS.dec()
+                waiting = False
+                LOCK_WAIT.observe(acquired - started)
+                update = getattr(self._local, 'update', None)
+                if update is not None and not update[1] and update[0] in self._storage.applied_updates:
+                    DUPLICATE_UPDATES.inc()
+                    raise DuplicateUpdate(update[0])
+                self._pending = []
+                try:
+                    yield
+                    # Before the storage transaction ends and releases the lock, so the listeners (the history
+                    # index, the activity log) are updated along with it and see the transactions in commit order
+                    if self._pending:
+                        self._notify(self._pending)
+                finally:
+                    self._pending = []
+        finally:
+            if waiting:
+                LOCK_WAITERS.dec()
+        LOCK_HOLD.observe(time.perf_counter() - acquired)
+
+    def _notify(self, committed: List[Transaction]):
+        for listener in self._listeners:
+            try:
+                listener(committed)
+            except Exception as e:
+                logger.error(f'finance_processor.py:_notify(). Transaction listener failed. Exception: {e}')
+
+    def _record(self, kind: str, changes: Dict[str, Dict[str, int]], amounts: Dict[str, int], comment: str = '',
+                transactions: Optional[List[Transaction]] = None, debts: Optional[Debts] = None):
+        """
+        Persist a mutation and adjust the totals by the difference it makes. Must be called inside a storage transaction.
+
+        The listeners receive `transactions` instead of the mutation itself if given (e.g. the rows of a batch).
+        `debts` holds the resulting amounts of the debt pairs the mutation changes (see debts.net_loans()).
+        """
+        with self._totals_lock:
+            up_to_date = self._totals_version == self._storage.version
+            deltas = {'profits': 0, 'spent': 0}
+            for user, fields in changes.items():
+                for field, value in fields.items():
+                    deltas[field] += value - self._data.value(user, field)
+
+            update = getattr(self._local, 'update', None)
+            update_id = None
+            if update is not None and not update[1]:
+                update_id, update[1] = update[0], True
+            self._storage.record(kind, changes, amounts=amounts, comment=comment, update_id=update_id, debts=debts)
+
+            if up_to_date:
+                for field, delta in deltas.items():
+                    self._totals[field] += delta
+                self._totals_version = self._storage.version
+        self._pending.extend(transactions if transactions is not None else [Transaction(time.time(), kind, amounts, comment)])
+
+    def process_balance_change(self, balance: int, comment: str = ''):
         """
         Process a change in total balance, dividing the change evenly among all users.
 
-        The change is rounded to the nearest integer and added to each user's profits.
+        The change is split into shares that add up to it exactly (see split_evenly()),
+        which are added to the users' profits.
 
         Args:
-            balance (int): The total change in balance to be processed.
+            balance (int): The total change in balance to be processed, in cents.
+            comment (str): Explanation of the change, kept in the transaction history.
         """
-        self._refresh_data()
-        n_users = len(self._data)
-        change = round(balance / n_users)
-        for user in self._data:
-            self._data[user]['profits'] += change
-        self._update_data()
+        with self._transaction():
+            n_users = len(self._data)
+            if n_users == 0:
+                return logger.warning('finance_processor.py:process_balance_change(). Balance change failed: there are no users.')
+            shares = split_evenly(balance, n_users)
+            self._record('balance_change', self._add_to_profits(shares), amounts=dict(zip(self._data.names, shares)), comment=comment)
+
+    def _add_to_profits(self, amounts: List[int]) -> Dict[str, Dict[str, int]]:
+        """Changes adding amounts (in the order of the participants of the data) to the profits of every participant."""
+        data = self._data
+        return {user: {'profits': profits + amount} for user, profits, amount in zip(data.names, data.columns['profits'], amounts)}
+
+    def apply_batch(self, rows: List[ImportRow], comment: str = '') -> bool:
+        """
+        Apply imported balance changes and loans in a single transaction.
+
+        The rows are applied in order with the same rules as process_balance_change() and
+        process_loan(), loans included in the debts, but the storage persists them as one
+        'import' record, so a batch costs one lock acquisition and one write whatever its
+        size. The listeners still receive every row as a separate transaction.
+
+        Args:
+            rows (List[ImportRow]): The validated rows.
+            comment (str): Explanation of the import, kept in the transaction history.
+
+        Returns:
+            bool: False if a loan row refers to a user that doesn't exist, in which case no changes are made.
+        """
+        with self._transaction():
+            if any(row.kind == 'loan' and (row.lender not in self._data or row.borrower not in self._data) for row in rows):
+                return False
+            now = time.time()
+            data = self._data
+            transactions = []
+            if not data and any(row.kind == 'balance_change' for row in rows):
+                return False
+            # Sum of the rows per participant, in the order of the participants of the data
+            totals = [0] * len(data)
+            changed = set()
+            for row in rows:
+                if row.kind == 'balance_change':
+                    shares = split_evenly(row.amount, len(data))
+                    totals = [total + share for total, share in zip(totals, shares)]
+                    changed.update(data.names)
+                    amounts = dict(zip(data.names, shares))
+                else:
+                    for user, amount in ((row.lender, row.amount), (row.borrower, -row.amount)):
+                        totals[data.position(user)] += amount
+                        changed.add(user)
+                    amounts = {row.lender: row.amount, row.borrower: -row.amount}
+                transactions.append(Transaction(now, row.kind, amounts, row.comment))
+            changes = {user: fields for user, fields in self._add_to_profits(totals).items() if user in changed}
+            amounts = {user: total for user, total in zip(data.names, totals) if user in changed}
+            loans = [(row.lender, row.borrower, row.amount) for row in rows if row.kind == 'loan']
+            self._record('import', changes, amounts=amounts, comment=comment, transactions=transactions,
+                         debts=net_loans(self._storage.debts, loans) if loans else None)
+        return True
 
     def process_loan(self, lender: str, debtor: str, amount: int):
         """
-        Process a loan between two users, updating their profits accordingly.
+        Process a loan between two users, updating their profits and debts accordingly.
 
         If either of the users do not exist, a warning is logged and no changes are made.
 
         Args:
             lender (str): The username of the user giving the loan.
             debtor (str): The username of the user receiving the loan.
-            amount (int): The amount of the loan.
+            amount (int): The amount of the loan in cents.
         """
-        # Increase lender's money as they performed a real world transaction and thus require to have it compensated on the account
-        self._refresh_data()
-        if lender in self._data and debtor in self._data:
-            self._data[lender]['profits'] += amount
-            self._data[debtor]['profits'] -= amount
-            self._update_data()
-        else:
+        if not self.process_transfers('loan', [(lender, debtor, amount)], debts=True):
             logger.warning(f"finance_processor.py:process_loan(). Loan operation failed: Check if users '{lender}' and '{debtor}' exist.")
 
+    def process_transfers(self, kind: str, transfers: List[Tuple[str, str, int]], comment: str = '', debts: bool = False) -> bool:
+        """
+        Process real world payments between users (loans, split expenses) as one transaction.
+
+        The payer's profits are increased by the amount, as they performed a real world transaction
+        and thus require to have it compensated on the account, and the receiver's profits are decreased.
+
+        Args:
+            kind (str): Kind of the transaction (loan, split).
+            transfers (List[Tuple[str, str, int]]): (payer, receiver, amount in cents) of every payment.
+            comment (str): Explanation of the payments, kept in the transaction history.
+            debts (bool): The receivers also owe the amounts to the payers (see debts.net_loans()).
+
+        Returns:
+            bool: False if one of the users doesn't exist, in which case no changes are made.
+        """
+        with self._transaction():
+            if any(payer not in self._data or receiver not in self._data for payer, receiver, _ in transfers):
+                return False
+            self._record_transfers(kind, transfers, comment=comment, debts=net_loans(self._storage.debts, transfers) if debts else None)
+        return True
+
+    def _record_transfers(self, kind: str, transfers: List[Tuple[str, str, int]], comment: str = '', debts: Optional[Debts] = None):
+        amounts: Dict[str, int] = {}
+        for payer, receiver, amount in transfers:
+            amounts[payer] = amounts.get(payer, 0) + amount
+            amounts[receiver] = amounts.get(receiver, 0) - amount
+        changes = {user: {'profits': self._data.value(user, 'profits') + amount} for user, amount in amounts.items()}
+        self._record(kind, changes, amounts=amounts, comment=comment, debts=debts)
+
     def set_profits(self, user: str, amount: int):
         """
         Sets the profits of a given user to a specified amount.
 
         Args:
             user (str): The name of the user whose profits are to be set.
-            amount (int): The amount to which the profits are to be set. It should be greater than 1000.
+            amount (int): The amount in cents to which the profits are to be set. It should be at least $1000.
 
         Returns:
-            None, but logs a warning if the user doesn't exist or if the amount is less than or equal to 1000.
+            None, but logs a warning if the user doesn't exist or if the amount is less than $1000.
         """
-        self._refresh_data()
-        if not user in self._data:
-            return logger.warning(f"finance_processor.py:set_profits(). Failed to set profits: Check if user '{user}' exists.")
-        if amount < 1000:
-            return logger.warning(f"finance_processor.py:set_profits(). Failed to set profits: amount should be > 1000. Supplied amount: {amount}")
-        
-        self._data[user]['profits'] = amount
-        self._update_data()
+        with self._transaction():
+            if not user in self._data:
+                return logger.warning(f"finance_processor.py:set_profits(). Failed to set profits: Check if user '{user}' exists.")
+            if amount < 1000 * CENTS:
+                return logger.warning(f"finance_processor.py:set_profits(). Failed to set profits: amount should be >= $1000. Supplied amount in cents: {amount}")
+
+            self._record('set_profits', {user: {'profits': amount}}, amounts={user: amount})
 
     def set_spent(self, user: str, amount: int):
         """
@@ -126,14 +469,13 @@ class FinanceProcessor:
 
         Args:
             user (str): The name of the user whose spent value is to be set.
-            amount (int): The amount to which the spent value is to be set.
+            amount (int): The amount in cents to which the spent value is to be set.
 
         Returns:
             None, but logs a warning if the user doesn't exist.
         """
-        self._refresh_data()
-        if not user in self._data:
-            return logger.warning(f"finance_processor.py:set_spent(). Failed to set spent: Check if user '{user}' exists.")
-        
-        self._data[user]['spent'] = amount
-        self._update_data()
+        with self._transaction():
+            if not user in self._data:
+                return logger.warning(f"finance_processor.py:set_spent(). Failed to set spent: Check if user '{user}' exists.")
+
+            self._record('set_spent', {user: {'spent': amount}}, amounts={user: amount})
@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+import time
+
+from datetime import date, timedelta
+from typing import Dict, List, NamedTuple, Optional
+from ledger import CorruptJournal
+from money import MONEY_FORMAT, from_legacy
+from shared.fileio import atomic_write_bytes, atomic_write_json
+
+# Import env variables
+from env import logger
+
+
+class Transaction(NamedTuple):
+    """A committed mutation of the financial data, the amounts in cents."""
+    timestamp: float
+    kind: str
+    amounts: Dict[str, int]
+    comment: str = ''
+
+
+# participant -> kind -> {'sum': total amount, 'count': number of transactions}
+Rollup = Dict[str, Dict[str, Dict[str, int]]]
+
+
+class HistoryIndex:
+    """
+    Daily and monthly rollups of the transactions, per participant and per kind.
+
+    Every transaction adds its amounts to the bucket of its day ('YYYY-MM-DD') and of
+    its month ('YYYY-MM'), so a report over a period only merges the buckets covering
+    it: whole months are taken from the monthly buckets and only the partial months at
+    the edges from the daily ones. The cost depends on the number of buckets, not on
+    the number of transactions.
+
+    The index is kept in memory and persisted like the balances (see Ledger): every batch
+    of updates appends one fsync'd line to a journal next to the JSON snapshot, holding
+    the resulting totals of the entries it touched, and after `snapshot_interval` lines
+    the snapshot is rewritten and the journal emptied. As the lines hold totals rather
+    than deltas, replaying one that is already part of the snapshot is harmless.
+
+    Days are in the local time zone of the bot. The sums are in cents; an index written
+    before (without the 'format' key) is converted when loaded.
+    """
+    def __init__(self, index_path: str, snapshot_interval: int = 500):
+        """
+        Initialize the index, loading it from the files if they exist.
+
+        Args:
+            index_path (str): Path to the JSON snapshot of the index.
+            snapshot_interval (int): Number of journal lines after which the snapshot is rewritten.
+
+        Raises:
+            CorruptJournal: If a journal line other than a torn last one can't be read.
+        """
+        self.index_path = index_path
+        self.journal_path = os.path.splitext(index_path)[0] + '.journal'
+        self.snapshot_interval = max(1, snapshot_interval)
+        self._lock = threading.Lock()
+        self._days: Dict[str, Rollup] = {}
+        self._months: Dict[str, Rollup] = {}
+        self._journal_records = 0
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, 'r') as f:
+                    index = json.load(f)
+                self._days, self._months = index['days'], index['months']
+                if index.get('format') != MONEY_FORMAT:
+                    for buckets in (self._days, self._months):
+                        for bucket in buckets.values():
+                            for kinds in bucket.values():
+                                for totals in kinds.values():
+                                    totals['sum'] = from_legacy(totals['sum'])
+                    self._compact()
+                    logger.info(f'history.py:__init__(). Converted the history index {index_path} to cents')
+            except (ValueError, KeyError) as e:
+                logger.error(f'history.py:__init__(). Failed to load the history index {index_path}, starting an empty one. Exception: {e}')
+        self._replay()
+
+    def add(self, transactions: List[Transaction]):
+        """
+        Add transactions to the rollups of their day and month and persist the changed totals once.
+
+        Args:
+            transactions (List[Transaction]): The committed transactions.
+        """
+        with self._lock:
+            changed: Dict[str, Dict[str, Rollup]] = {'days': {}, 'months': {}}
+            for transaction in transactions:
+                day = time.strftime('%Y-%m-%d', time.localtime(transaction.timestamp))
+                for name, buckets, key in (('days', self._days, day), ('months', self._months, day[:7])):
+                    bucket = buckets.setdefault(key, {})
+                    for participant, amount in transaction.amounts.items():
+                        totals = bucket.setdefault(participant, {}).setdefault(transaction.kind, {'sum': 0, 'count': 0})
+                        totals['sum'] += amount
+                        totals['count'] += 1
+                        changed[name].setdefault(key, {}).setdefault(participant, {})[transaction.kind] = totals
+            if not changed['days']:
+                return
+            try:
+                self._append(changed)
+            except OSError as e:
+                logger.error(f'history.py:add(). Failed to save the history index {self.index_path}. Exception: {e}')
+
+    def _append(self, changed: Dict[str, Dict[str, Rollup]]):
+        record = json.dumps(changed, separators=(',', ':')) + '\n'
+        with open(self.journal_path, 'ab') as journal:
+            journal.write(record.encode('utf-8'))
+            journal.flush()
+            os.fsync(journal.fileno())
+        self._journal_records += 1
+        if self._journal_records >= self.snapshot_interval:
+            self._compact()
+
+    def _replay(self):
+        if not os.path.exists(self.journal_path):
+            return
+        offset = 0
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Appends write a whole line at once, only the last one can be torn
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.error(f'history.py:_replay(). Unreadable record at byte {offset} of {self.journal_path}')
+                    raise CorruptJournal(self.journal_path, offset)
+                for name, buckets in (('days', self._days), ('months', self._months)):
+                    for key, bucket in record[name].items():
+                        for participant, kinds in bucket.items():
+                            buckets.setdefault(key, {}).setdefault(participant, {}).update(kinds)
+                offset += len(line)
+                self._journal_records += 1
+            torn = f.seek(0, os.SEEK_END) > offset
+        if torn:
+            logger.warning(f'history.py:_replay(). Discarding a torn record at the end of {self.journal_path}')
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(offset)
+
+    def _compact(self):
+        """Writes the snapshot, then empties the journal: a crash in between only leaves lines already in the snapshot."""
+        atomic_write_json(self.index_path, {'format': MONEY_FORMAT, 'days': self._days, 'months': self._months})
+        atomic_write_bytes(self.journal_path, b'')
+        self._journal_records = 0
+
+    def report(self, start: date, end: date) -> Rollup:
+        """
+        Sum up the transactions of a period.
+
+        Args:
+            start (date): First day of the period.
+            end (date): Last day of the period (inclusive).
+
+        Returns:
+            Rollup: Sum (in cents) and count of the amounts per participant and kind.
+        """
+        result: Rollup = {}
+        with self._lock:
+            for bucket in self._buckets(start, end):
+                for participant, kinds in bucket.items():
+                    for kind, totals in kinds.items():
+                        merged = result.setdefault(participant, {}).setdefault(kind, {'sum': 0, 'count': 0})
+                        merged['sum'] += totals['sum']
+                        merged['count'] += totals['count']
+        return result
+
+    def _buckets(self, start: date, end: date) -> List[Rollup]:
+        buckets = []
+        day = start
+        while day <= end:
+            next_month = (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+            if day.day == 1 and next_month - timedelta(days=1) <= end:
+                bucket: Optional[Rollup] = self._months.get(day.strftime('%Y-%m'))
+                day = next_month
+            else:
+                bucket = self._days.get(day.isoformat())
+                day += timedelta(days=1)
+            if bucket:
+                buckets.append(bucket)
+        return buckets
@@ -0,0 +1,74 @@
+import csv
+
+from typing import Collection, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from money import CENTS, parse_amount
+
+
+class ImportRow(NamedTuple):
+    """A validated row of an import, the amount in cents."""
+    line: int
+    kind: str
+    amount: int
+    lender: str = ''
+    borrower: str = ''
+    comment: str = ''
+
+
+class RowError(Exception):
+    """Raised for an invalid row, with the line number and the reason."""
+    def __init__(self, line: int, reason: str):
+        super().__init__(f'line {line}: {reason}')
+        self.line = line
+        self.reason = reason
+
+
+def parse_rows(lines: Iterable[str], participants: Collection[str]) -> Iterator[Tuple[Optional[ImportRow], Optional[RowError]]]:
+    """
+    Parse CSV transaction rows one at a time.
+
+    Supported rows (empty lines, lines starting with # and a "kind,..." header are skipped):
+
+        balance,<amount>,<comment>           change of the total balance, may be negative
+        loan,<amount>,<lender>,<borrower>    loan between two participants, at least 5
+
+    Amounts are dollars with up to two decimals, e.g. 12.50.
+
+    Args:
+        lines (Iterable[str]): Lines of the CSV text, read lazily.
+        participants (Collection[str]): Valid participant names, a set for constant time lookups.
+
+    Yields:
+        Tuple[Optional[ImportRow], Optional[RowError]]: Either a valid row or the error of an invalid one.
+    """
+    reader = csv.reader(lines)
+    for fields in reader:
+        line = reader.line_num
+        fields = [field.strip() for field in fields]
+        if not any(fields) or fields[0].startswith('#') or (line == 1 and fields[0].lower() == 'kind'):
+            continue
+        try:
+            yield _parse_row(line, fields, participants), None
+        except RowError as e:
+            yield None, e
+
+
+def _parse_row(line: int, fields: List[str], participants: Collection[str]) -> ImportRow:
+    kind = fields[0].lower()
+    amount = parse_amount(fields[1], allow_negative=True) if len(fields) >= 2 else None
+    if amount is None:
+        raise RowError(line, 'the amount must be a number with up to two decimals')
+
+    if kind == 'balance':
+        if amount == 0:
+            raise RowError(line, 'the balance change can\'t be 0')
+        return ImportRow(line, 'balance_change', amount, comment=','.join(fields[2:]))
+    if kind == 'loan':
+        if len(fields) != 4:
+            raise RowError(line, 'expected loan,<amount>,<lender>,<borrower>')
+        lender, borrower = fields[2], fields[3]
+        if lender not in participants or borrower not in participants or lender == borrower:
+            raise RowError(line, 'lender and borrower must be two different participants')
+        if amount < 5 * CENTS:
+            raise RowError(line, 'the loan amount can\'t be less than 5')
+        return ImportRow(line, 'loan', amount, lender=lender, borrower=borrower)
+    raise RowError(line, f'unknown kind "{fields[0]}", expected balance or loan')
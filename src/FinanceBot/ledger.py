@@ -0,0 +1,298 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, Optional
+
+from debts import Debts, apply_debts
+from money import MONEY_FORMAT, Balances, from_legacy, is_current
+from shared.fileio import atomic_write_bytes, atomic_write_json
+from shared.file_watch import FileSignature, file_signature
+
+# Import env variables
+from env import logger
+
+
+class CorruptJournal(Exception):
+    """Raised when a journal line other than a torn last one can't be read, the journal must be repaired by hand."""
+    def __init__(self, path: str, offset: int):
+        super().__init__(f'Unreadable record at byte {offset} of {path}, the records after it would be lost: repair or move the file aside')
+        self.path = path
+        self.offset = offset
+
+
+class AppliedUpdates:
+    """
+    Bounded index of the IDs of the most recent updates whose mutations have been applied.
+
+    Lookups and insertions are O(1); once `capacity` IDs are stored, the oldest one is
+    forgotten for every new one.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self._ids: 'OrderedDict[int, None]' = OrderedDict()
+
+    def __contains__(self, update_id: int) -> bool:
+        return update_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._ids)
+
+    def add(self, update_id: int) -> Optional[int]:
+        """
+        Args:
+            update_id (int): ID of the applied update.
+
+        Returns:
+            Optional[int]: The ID that was forgotten to make room, if any.
+        """
+        self._ids[update_id] = None
+        self._ids.move_to_end(update_id)
+        if len(self._ids) > self.capacity:
+            return self._ids.popitem(last=False)[0]
+        return None
+
+    def replace(self, update_ids: Iterable[int]):
+        """Forget every ID and add the given ones, oldest first."""
+        self._ids.clear()
+        for update_id in update_ids:
+            self.add(update_id)
+
+
+class Ledger:
+    """
+    Append-only transaction journal backed by a periodically compacted snapshot.
+
+    The snapshot is the regular finance_info.json file. Every mutation is appended to
+    a journal file next to it as a single JSON line holding the post-image of the
+    fields it touched, and is fsync'd before the call returns. After a configurable
+    number of records the in-memory state is written as a new snapshot with an atomic
+    rename and the journal is replaced by an empty one.
+
+    Because records hold resulting values rather than deltas, replaying a record that
+    is already included in the snapshot is harmless. That makes the snapshot/journal
+    switch crash-safe without having to track sequence numbers.
+
+    A record can carry the ID of the Telegram update that caused it, so the mutation and
+    the fact that the update has been applied are persisted by the same write. The most
+    recent IDs are kept in `applied_updates`; a compaction starts the new journal with a
+    record listing them, so they survive it.
+
+    The debts between the participants are kept alongside: a record may carry the
+    resulting amounts of the debt pairs it changed (see debts.net_loans()), so a loan
+    and its debt are persisted by the same write.
+
+    Amounts are integer cents (see money.py) and the snapshot holds them column-wise. A
+    snapshot of the former format ({participant: {field: dollars}}) and its journal are
+    converted when loaded: a 'migrate' record with the converted state replaces the
+    journal before the snapshot is rewritten, and records following a record with a
+    'format' key are never converted, so a crash in between can't convert twice.
+
+    All methods that touch the files must be called while holding the processor's file lock.
+    """
+    data: Balances
+
+    def __init__(self, snapshot_path: str, initial_data: Dict[str, Dict[str, int]], snapshot_interval: int, applied_updates: int = 10000):
+        """
+        Initialize the ledger, creating the snapshot file if necessary.
+
+        Args:
+            snapshot_path (str): Path to the JSON snapshot file.
+            initial_data (Dict[str, Dict[str, int]]): Data in cents used when no snapshot exists yet.
+            snapshot_interval (int): Number of journal records after which a snapshot is written.
+            applied_updates (int): Number of recent update IDs remembered.
+        """
+        self.snapshot_path = snapshot_path
+        self.journal_path = os.path.splitext(snapshot_path)[0] + '.journal'
+        self.snapshot_interval = max(1, snapshot_interval)
+        self.data = Balances()
+        self.debts: Debts = {}
+        self.applied_updates = AppliedUpdates(applied_updates)
+        # Incremented whenever `data` changes, so that values derived from it can be cached
+        self.version = 0
+        self._journal = None
+        self._journal_offset = 0
+        self._journal_records = 0
+        self._snapshot_signature: FileSignature = None
+        # Whether the journal records being replayed hold dollars of the former format
+        self._legacy_records = False
+
+        if not os.path.exists(self.snapshot_path):
+            atomic_write_json(self.snapshot_path, Balances.from_dict(initial_data).to_snapshot())
+        if not os.path.exists(self.journal_path):
+            atomic_write_bytes(self.journal_path, b'')
+
+    def load(self):
+        """
+        Load the snapshot and replay every journal record written after it.
+
+        A torn record at the end of the journal (left by a crash in the middle of an
+        append) is discarded and cut off, so the next append starts on a clean line.
+        A snapshot of the former format is converted to cents and rewritten.
+
+        Raises:
+            CorruptJournal: If a complete line of the journal can't be read.
+        """
+        with open(self.snapshot_path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self._snapshot_signature = st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+            snapshot = json.load(f)
+        self.data = Balances.from_snapshot(snapshot)
+        self.debts = snapshot.get('debts', {}) if is_current(snapshot) else {}
+        self.version += 1
+        self.applied_updates.replace(())
+
+        self._close_journal()
+        self._journal_offset = 0
+        self._journal_records = 0
+        self._legacy_records = not is_current(snapshot)
+        if os.path.exists(self.journal_path):
+            self._replay()
+        if not is_current(snapshot):
+            self._migrate()
+
+    def catch_up(self):
+        """
+        Bring the in-memory state up to date with records written by other processes.
+
+        Only the bytes appended since the last call are read. If the snapshot or the
+        journal has been replaced by another process' compaction, or the snapshot has been
+        edited by hand, the state is reloaded.
+        """
+        try:
+            journal_stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return self.load()
+
+        if file_signature(self.snapshot_path) != self._snapshot_signature or journal_stat.st_size < self._journal_offset:
+            return self.load()
+        if self._journal is not None and os.fstat(self._journal.fileno()).st_ino != journal_stat.st_ino:
+            return self.load()
+        if journal_stat.st_size > self._journal_offset:
+            self._replay()
+
+    def append(self, operation: str, changes: Dict[str, Dict[str, int]], amounts: Optional[Dict[str, int]] = None, comment: str = '',
+               update_id: Optional[int] = None, debts: Optional[Debts] = None):
+        """
+        Apply changes to the in-memory state and durably append them to the journal.
+
+        Args:
+            operation (str): Name of the operation that produced the changes.
+            changes (Dict[str, Dict[str, int]]): New values of the changed fields per participant.
+            amounts (Optional[Dict[str, int]]): Transaction amount per affected participant, kept for history.
+            comment (str): Optional free text explanation, kept for history.
+            update_id (Optional[int]): Telegram update that caused the changes.
+            debts (Optional[Debts]): Resulting amounts of the changed debt pairs.
+        """
+        entry = {'ts': time.time(), 'op': operation, 'set': changes}
+        if debts:
+            entry['debts'] = debts
+        if amounts:
+            entry['amounts'] = amounts
+        if comment:
+            entry['comment'] = comment
+        if update_id is not None:
+            entry['update'] = update_id
+        record = json.dumps(entry, separators=(',', ':')) + '\n'
+        journal = self._open_journal()
+        journal.write(record.encode('utf-8'))
+        journal.flush()
+        os.fsync(journal.fileno())
+
+        self._journal_offset = journal.tell()
+        self._journal_records += 1
+        self._apply(changes, debts)
+        if update_id is not None:
+            self.applied_updates.add(update_id)
+
+        if self._journal_records >= self.snapshot_interval:
+            self.compact()
+
+    def compact(self):
+        """
+        Write the in-memory state as a new snapshot and start an empty journal.
+
+        The snapshot is replaced before the journal, so a crash in between only leaves
+        records that are already part of the snapshot. The new journal starts with the
+        recently applied update IDs.
+        """
+        header = b''
+        if self.applied_updates:
+            entry = {'ts': time.time(), 'op': 'applied_updates', 'set': {}, 'updates': list(self.applied_updates)}
+            header = (json.dumps(entry, separators=(',', ':')) + '\n').encode('utf-8')
+        atomic_write_json(self.snapshot_path, {**self.data.to_snapshot(), 'debts': self.debts})
+        atomic_write_bytes(self.journal_path, header)
+        self._close_journal()
+        self._snapshot_signature = file_signature(self.snapshot_path)
+        self._journal_offset = len(header)
+        self._journal_records = 0
+
+    def _migrate(self):
+        """Replace the journal of a snapshot in dollars by a record of the converted state, then compact."""
+        entry = {'ts': time.time(), 'op': 'migrate', 'format': MONEY_FORMAT, 'set': {participant: self.data[participant] for participant in self.data},
+                 'updates': list(self.applied_updates)}
+        record = (json.dumps(entry, separators=(',', ':')) + '\n').encode('utf-8')
+        atomic_write_bytes(self.journal_path, record)
+        self._close_journal()
+        self._journal_offset = len(record)
+        self._legacy_records = False
+        self.compact()
+        logger.info(f'ledger.py:_migrate(). Converted {len(self.data)} participants of {self.snapshot_path} to cents')
+
+    def _replay(self):
+        with open(self.journal_path, 'rb') as f:
+            f.seek(self._journal_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Appends write a whole line at once, only the last one can be torn
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.error(f'ledger.py:_replay(). Unreadable record at byte {self._journal_offset} of {self.journal_path}')
+                    raise CorruptJournal(self.journal_path, self._journal_offset)
+                if 'format' in record:
+                    self._legacy_records = False
+                changes = record['set']
+                if self._legacy_records:
+                    changes = {participant: {field: from_legacy(value) for field, value in fields.items()} for participant, fields in changes.items()}
+                self._apply(changes, record.get('debts'))
+                for update_id in record.get('updates', ()):
+                    self.applied_updates.add(update_id)
+                if 'update' in record:
+                    self.applied_updates.add(record['update'])
+                self._journal_offset += len(line)
+                self._journal_records += 1
+
+            torn = f.seek(0, os.SEEK_END) > self._journal_offset
+
+        if torn:
+            logger.warning(f'ledger.py:_replay(). Discarding a torn record at the end of {self.journal_path}')
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(self._journal_offset)
+                os.fsync(f.fileno())
+
+    def _apply(self, changes: Dict[str, Dict[str, int]], debts: Optional[Debts] = None):
+        self.data.apply(changes)
+        if debts:
+            apply_debts(self.debts, debts)
+        self.version += 1
+
+    def close(self):
+        """
+        Close the journal. It is reopened by the next append.
+        """
+        self._close_journal()
+
+    def _open_journal(self):
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'ab')
+        return self._journal
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -0,0 +1,234 @@
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, Iterator, List, Optional, Tuple
+from telegram import Chat, Update
+from telegram.ext import CallbackContext
+from activity_log import ActivityLog
+from finance_processor import DuplicateUpdate, FinanceProcessor, create_storage
+from history import HistoryIndex, Transaction
+
+# Import env variables
+from env import FINANCE_INFO_FILE, FINANCE_DB_FILE, DEBTS_FILE, HISTORY_INDEX_FILE, ACTIVITY_LOG_PATH, LEDGERS_DIR, FINANCE_SNAPSHOT_INTERVAL, logger
+
+
+DEFAULT_LEDGER = 'default'
+
+
+class LedgerBundle:
+    """
+    Everything that belongs to one ledger: the financial data and debts, the history
+    index, the activity log and the cached profits report.
+    """
+    def __init__(self, key: str, processor: FinanceProcessor, history_index: HistoryIndex, activity_log: ActivityLog):
+        self.key = key
+        self.processor = processor
+        self.history_index = history_index
+        self.activity_log = activity_log
+        # (data version, rendered text) of the last profits report
+        self.profits_report: Tuple[Optional[int], str] = (None, '')
+        self.leases = 0
+        self.last_used = time.monotonic()
+        processor.add_listener(history_index.add)
+        processor.add_listener(self.record_activity)
+
+    @classmethod
+    def open(cls, key: str, directory: Optional[str] = None) -> 'LedgerBundle':
+        """
+        Open (and create if needed) a ledger.
+
+        Args:
+            key (str): Key of the ledger.
+            directory (Optional[str]): Directory of the ledger files, None for the default ledger at the configured paths.
+
+        Returns:
+            LedgerBundle: The opened ledger.
+        """
+        if directory is None:
+            processor = FinanceProcessor()
+            # Debts used to be kept in a file of their own
+            processor.import_debts(DEBTS_FILE)
+            return cls(key, processor, HistoryIndex(HISTORY_INDEX_FILE, snapshot_interval=FINANCE_SNAPSHOT_INTERVAL), ActivityLog(ACTIVITY_LOG_PATH))
+
+        os.makedirs(directory, exist_ok=True)
+        storage = create_storage({}, info_file=os.path.join(directory, 'finance_info.json'), db_file=os.path.join(directory, 'finance.db'))
+        # Participants of a new group ledger are added with /participants
+        processor = FinanceProcessor(storage=storage, participants=[])
+        processor.import_debts(os.path.join(directory, 'debts.json'))
+        return cls(key, processor, HistoryIndex(os.path.join(directory, 'history_index.json'), snapshot_interval=FINANCE_SNAPSHOT_INTERVAL),
+                   ActivityLog(os.path.join(directory, 'financial_activity')))
+
+    @property
+    def participants(self) -> List[str]:
+        return list(self.processor.get_data())
+
+    def is_participant(self, name: str) -> bool:
+        """Membership check without building the list of participants."""
+        return name in self.processor.get_data()
+
+    def record_activity(self, transactions: List[Transaction]):
+        """
+        Append committed transactions to the JSON lines activity log.
+
+        Args:
+            transactions (List[Transaction]): The committed transactions.
+        """
+        entries = []
+        for transaction in transactions:
+            entry = {'ts': transaction.timestamp, 'kind': transaction.kind, 'amounts': transaction.amounts}
+            if transaction.comment:
+                entry['comment'] = transaction.comment
+            entries.append(entry)
+        self.activity_log.append(entries)
+
+    def close(self):
+        self.processor.close()
+
+
+class LedgerRegistry:
+    """
+    Ledgers of every chat, loaded on first use and unloaded when idle.
+
+    Private chats share the default ledger. With `multi_ledger` enabled, every group
+    has its own ledger in LEDGERS_DIR/<chat id>, with its own participants and files,
+    so groups never wait on each other's locks.
+
+    Ledgers are leased for the duration of a handler (see with_ledger). Ledgers that
+    aren't leased are unloaded once they have been idle for `idle_ttl` seconds or when
+    more than `max_loaded` ledgers are in memory (least recently used first). The
+    registry lock is only held for dictionary operations; a ledger is loaded under a
+    lock of its own, so loading a large ledger doesn't block other chats.
+    """
+    def __init__(self, multi_ledger: bool = False, max_loaded: int = 100, idle_ttl: float = 1800):
+        """
+        Args:
+            multi_ledger (bool): Give every group its own ledger.
+            max_loaded (int): Maximum number of group ledgers kept in memory when idle.
+            idle_ttl (float): Seconds after which an idle group ledger is unloaded.
+        """
+        self.multi_ledger = multi_ledger
+        self.max_loaded = max(1, max_loaded)
+        self.idle_ttl = idle_ttl
+        self._lock = threading.Lock()
+        self._loaded: 'OrderedDict[str, LedgerBundle]' = OrderedDict()
+        self._loading: Dict[str, threading.Lock] = {}
+        # The default ledger is always loaded
+        self.default = LedgerBundle.open(DEFAULT_LEDGER)
+
+    def __len__(self) -> int:
+        return len(self._loaded)
+
+    def key(self, chat: Chat) -> str:
+        """
+        Returns:
+            str: Key of the ledger of a chat.
+        """
+        if self.multi_ledger and chat.type in (Chat.GROUP, Chat.SUPERGROUP):
+            return str(chat.id)
+        return DEFAULT_LEDGER
+
+    @contextmanager
+    def lease(self, chat: Chat) -> Iterator[LedgerBundle]:
+        """
+        Context manager that provides the ledger of a chat and keeps it loaded until left.
+
+        Args:
+            chat (Chat): The chat.
+        """
+        key = self.key(chat)
+        if key == DEFAULT_LEDGER:
+            yield self.default
+            return
+
+        bundle = self._acquire(key)
+        try:
+            yield bundle
+        finally:
+            with self._lock:
+                bundle.leases -= 1
+                bundle.last_used = time.monotonic()
+            self._evict()
+
+    def close(self):
+        """Unloads every ledger."""
+        with self._lock:
+            bundles, self._loaded = list(self._loaded.values()), OrderedDict()
+        for bundle in bundles + [self.default]:
+            bundle.close()
+
+    def _acquire(self, key: str) -> LedgerBundle:
+        while True:
+            with self._lock:
+                bundle = self._loaded.get(key)
+                if bundle is not None:
+                    bundle.leases += 1
+                    self._loaded.move_to_end(key)
+                    return bundle
+                loading = self._loading.setdefault(key, threading.Lock())
+
+            with loading:
+                with self._lock:
+                    if key in self._loaded or self._loading.get(key) is not loading:
+                        # Loaded by another thread in the meantime
+                        continue
+                try:
+                    bundle = LedgerBundle.open(key, os.path.join(LEDGERS_DIR, key))
+                except Exception:
+                    with self._lock:
+                        self._loading.pop(key, None)
+                    raise
+                with self._lock:
+                    bundle.leases += 1
+                    self._loaded[key] = bundle
+                    self._loading.pop(key, None)
+                logger.info(f'ledgers.py:_acquire(). Loaded the ledger {key} ({len(self._loaded)} loaded)')
+                self._evict()
+                return bundle
+
+    def _evict(self):
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            idle = [key for key, bundle in self._loaded.items() if bundle.leases == 0]
+            for key in idle:
+                bundle = self._loaded[key]
+                if len(self._loaded) > self.max_loaded or now - bundle.last_used >= self.idle_ttl:
+                    evicted.append(self._loaded.pop(key))
+        for bundle in evicted:
+            try:
+                bundle.close()
+            except Exception as e:
+                logger.error(f'ledgers.py:_evict(). Failed to close the ledger {bundle.key}. Exception: {e}')
+        if evicted:
+            logger.info(f'ledgers.py:_evict(). Unloaded {len(evicted)} idle ledgers')
+
+
+def with_ledger(func):
+    """
+    A decorator that passes the ledger of the update's chat to a bot function as the `ledger` keyword argument.
+
+    The ledger is leased from the bot's LedgerRegistry (`self.ledgers`) while the function runs,
+    and its mutations are applied for the update (see FinanceProcessor.applying()). If the update
+    has already been applied, e.g. it is delivered again after a restart, the mutation raises
+    DuplicateUpdate and the rest of the function is skipped, so functions must mutate the ledger
+    before auditing or answering.
+
+    Args:
+        func (Callable): The bot function to be wrapped.
+
+    Returns:
+        Callable: The wrapped function.
+    """
+    @wraps(func)
+    def wrapped(self, update: Update, context: CallbackContext, *args, **kwargs):
+        with self.ledgers.lease(update.effective_chat) as ledger:
+            try:
+                with ledger.processor.applying(update.update_id):
+                    return func(self, update, context, *args, ledger=ledger, **kwargs)
+            except DuplicateUpdate as e:
+                logger.warning(f'ledgers.py:with_ledger(). Skipping {func.__name__}: {e}')
+    return wrapped
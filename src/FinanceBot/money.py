@@ -0,0 +1,184 @@
+import re
+
+from array import array
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional
+
+# Amounts are integers in minor units (cents): $12.34 is 1234
+CENTS = 100
+# Version of the files holding amounts in cents, files without it hold whole dollars
+MONEY_FORMAT = 2
+FIELDS = ('profits', 'spent')
+
+AMOUNT_PATTERN = re.compile(r'(-?)(\d+)(?:\.(\d{1,2}))?')
+
+
+def parse_amount(text: str, allow_negative: bool = False) -> Optional[int]:
+    """
+    Parse an amount of dollars with up to two decimals, e.g. 12, 12.5 or -12.34.
+
+    Args:
+        text (str): The text entered by the user.
+        allow_negative (bool): Accept amounts starting with -.
+
+    Returns:
+        Optional[int]: The amount in cents, None if the text isn't a valid amount.
+    """
+    match = AMOUNT_PATTERN.fullmatch(text.strip())
+    if match is None or (match.group(1) and not allow_negative):
+        return None
+    sign, whole, fraction = match.groups()
+    cents = int(whole) * CENTS + int((fraction or '').ljust(2, '0'))
+    return -cents if sign else cents
+
+
+def format_amount(cents: int, group: bool = True) -> str:
+    """
+    Format an amount of cents as dollars with spaces between groups of three digits, e.g. -1 234.50.
+
+    The decimals are omitted for whole dollars.
+
+    Args:
+        cents (int): The amount in cents.
+        group (bool): Separate the groups of digits, False gives a text parse_amount() accepts.
+
+    Returns:
+        str: The formatted amount.
+    """
+    dollars, rest = divmod(abs(int(cents)), CENTS)
+    text = f'{dollars:,}'.replace(',', ' ') if group else str(dollars)
+    if rest:
+        text += f'.{rest:02d}'
+    return '-' + text if cents < 0 else text
+
+
+def from_legacy(amount: float) -> int:
+    """Convert an amount of whole (or float) dollars of a file written before MONEY_FORMAT to cents."""
+    return round(amount * CENTS)
+
+
+def split_evenly(amount: int, n: int) -> List[int]:
+    """
+    Split an amount into n integer shares that add up to the amount exactly.
+
+    The remainder of the division is distributed one cent at a time over the first shares.
+
+    Args:
+        amount (int): The amount in cents, may be negative.
+        n (int): Number of shares.
+
+    Returns:
+        List[int]: The shares.
+    """
+    share, remainder = divmod(amount, n)
+    return [share + 1] * remainder + [share] * (n - remainder)
+
+
+class Balances(Mapping):
+    """
+    Profits and spent of every participant, in cents.
+
+    The values are stored column-wise in one array of 64-bit integers per field, indexed
+    by the position of the participant, so totals and operations over all participants
+    run over flat arrays instead of a dictionary per participant.
+
+    It reads like the former {participant: {'profits': ..., 'spent': ...}} dictionary
+    (data[user]['profits'], items(), ...); the inner dictionaries are built on access,
+    so changes go through apply().
+    """
+    def __init__(self):
+        self.names: List[str] = []
+        self._index: Dict[str, int] = {}
+        self.columns: Dict[str, array] = {field: array('q') for field in FIELDS}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Dict[str, Any]], legacy: bool = False) -> 'Balances':
+        """
+        Args:
+            data (Dict[str, Dict[str, Any]]): Values per participant.
+            legacy (bool): The values are dollars of a file written before MONEY_FORMAT.
+
+        Returns:
+            Balances: The balances.
+        """
+        balances = cls()
+        balances.apply({participant: {field: from_legacy(value) if legacy else int(value) for field, value in fields.items()}
+                        for participant, fields in data.items()})
+        return balances
+
+    @classmethod
+    def from_snapshot(cls, snapshot: Dict[str, Any]) -> 'Balances':
+        """
+        Args:
+            snapshot (Dict[str, Any]): Result of to_snapshot() or a legacy {participant: {field: dollars}} dictionary.
+
+        Returns:
+            Balances: The balances.
+        """
+        if not is_current(snapshot):
+            return cls.from_dict(snapshot, legacy=True)
+        balances = cls()
+        balances.names = list(snapshot['names'])
+        balances._index = {name: i for i, name in enumerate(balances.names)}
+        balances.columns = {field: array('q', snapshot[field]) for field in FIELDS}
+        return balances
+
+    def to_snapshot(self) -> Dict[str, Any]:
+        """
+        Returns:
+            Dict[str, Any]: JSON serializable columns: {"format": 2, "names": [...], "profits": [...], "spent": [...]}.
+        """
+        return {'format': MONEY_FORMAT, 'names': list(self.names), **{field: column.tolist() for field, column in self.columns.items()}}
+
+    def __getitem__(self, participant: str) -> Dict[str, int]:
+        i = self._index[participant]
+        return {field: column[i] for field, column in self.columns.items()}
+
+    def __contains__(self, participant: object) -> bool:
+        return participant in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def position(self, participant: str) -> int:
+        """Index of a participant in `names` and the columns."""
+        return self._index[participant]
+
+    def value(self, participant: str, field: str) -> int:
+        """The value of a field, 0 for an unknown participant."""
+        i = self._index.get(participant)
+        return 0 if i is None else self.columns[field][i]
+
+    def apply(self, changes: Dict[str, Dict[str, int]]):
+        """
+        Set fields of participants, adding the participants that don't exist yet.
+
+        Args:
+            changes (Dict[str, Dict[str, int]]): New values of the changed fields per participant.
+        """
+        for participant, fields in changes.items():
+            i = self._index.get(participant)
+            if i is None:
+                # Readers don't take a lock: the columns grow before the participant becomes visible
+                i = len(self.names)
+                for column in self.columns.values():
+                    column.append(0)
+                self.names.append(participant)
+                self._index[participant] = i
+            for field, value in fields.items():
+                self.columns[field][i] = value
+
+    def totals(self) -> Dict[str, int]:
+        """
+        Returns:
+            Dict[str, int]: Every field summed up over all participants.
+        """
+        return {field: sum(column) for field, column in self.columns.items()}
+
+
+def is_current(document: Any) -> bool:
+    """Whether a JSON document has been written with amounts in cents (see MONEY_FORMAT)."""
+    return isinstance(document, dict) and document.get('format') == MONEY_FORMAT
@@ -0,0 +1,249 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+from filelock import FileLock
+from debts import Debts, apply_debts
+from ledger import AppliedUpdates, Ledger
+from money import CENTS, MONEY_FORMAT, Balances
+from storage import FinanceStorage
+
+# Import env variables
+from env import logger
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS participants (
+    name TEXT PRIMARY KEY,
+    profits INTEGER NOT NULL DEFAULT 0,
+    spent INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY,
+    participant TEXT NOT NULL REFERENCES participants(name),
+    kind TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    comment TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS transactions_participant_timestamp ON transactions(participant, timestamp);
+CREATE INDEX IF NOT EXISTS transactions_kind_timestamp ON transactions(kind, timestamp);
+CREATE INDEX IF NOT EXISTS transactions_timestamp ON transactions(timestamp);
+CREATE TABLE IF NOT EXISTS applied_updates (
+    update_id INTEGER PRIMARY KEY,
+    timestamp REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS debts (
+    debtor TEXT NOT NULL,
+    creditor TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    PRIMARY KEY (debtor, creditor)
+);
+'''
+
+# Statements are kept as constants so that sqlite3's statement cache reuses the prepared versions
+SELECT_PARTICIPANTS = 'SELECT name, profits, spent FROM participants'
+INSERT_PARTICIPANT = 'INSERT OR IGNORE INTO participants(name, profits, spent) VALUES (?, ?, ?)'
+UPDATE_PROFITS = 'UPDATE participants SET profits = ? WHERE name = ?'
+UPDATE_SPENT = 'UPDATE participants SET spent = ? WHERE name = ?'
+INSERT_TRANSACTION = 'INSERT INTO transactions(participant, kind, amount, timestamp, comment) VALUES (?, ?, ?, ?, ?)'
+INSERT_APPLIED_UPDATE = 'INSERT OR IGNORE INTO applied_updates(update_id, timestamp) VALUES (?, ?)'
+DELETE_APPLIED_UPDATE = 'DELETE FROM applied_updates WHERE update_id = ?'
+SELECT_APPLIED_UPDATES = 'SELECT update_id FROM applied_updates ORDER BY update_id DESC LIMIT ?'
+SELECT_DEBTS = 'SELECT debtor, creditor, amount FROM debts'
+UPSERT_DEBT = 'INSERT OR REPLACE INTO debts(debtor, creditor, amount) VALUES (?, ?, ?)'
+DELETE_DEBT = 'DELETE FROM debts WHERE debtor = ? AND creditor = ?'
+UPDATE_FIELD = {'profits': UPDATE_PROFITS, 'spent': UPDATE_SPENT}
+# Conversion of a database in dollars, applied while PRAGMA user_version is below MONEY_FORMAT
+MIGRATE_TO_CENTS = [
+    f'UPDATE participants SET profits = CAST(ROUND(profits * {CENTS}) AS INTEGER), spent = CAST(ROUND(spent * {CENTS}) AS INTEGER)',
+    f'UPDATE transactions SET amount = CAST(ROUND(amount * {CENTS}) AS INTEGER)',
+]
+
+
+class SQLiteStorage(FinanceStorage):
+    """
+    Storage backed by an embedded SQLite database in WAL mode.
+
+    Current balances live in the `participants` table, one row per participant, so a
+    mutation is a handful of single-row UPDATEs plus INSERTs into the indexed
+    `transactions` history table, all inside one transaction. Writers are serialized
+    with BEGIN IMMEDIATE, which also works across processes, and `PRAGMA data_version`
+    tells whether another connection has committed since the last read.
+
+    The IDs of the updates that caused the mutations are inserted into `applied_updates`
+    in the same transaction; the table is trimmed to the IDs kept in memory. So are the
+    changed pairs of the `debts` table.
+
+    Amounts are integer cents. `PRAGMA user_version` holds the MONEY_FORMAT of the
+    database; an older database (in dollars) is converted when it is opened.
+    """
+    def __init__(self, db_path: str, initial_data: Dict[str, Dict[str, int]], json_path: Optional[str] = None, applied_updates: int = 10000):
+        """
+        Open (and create if needed) the database.
+
+        Args:
+            db_path (str): Path to the SQLite database file.
+            initial_data (Dict[str, Dict[str, int]]): Participants inserted if they are not in the database yet.
+            json_path (Optional[str]): Legacy JSON snapshot imported once if the database does not exist yet.
+            applied_updates (int): Number of recent update IDs remembered.
+        """
+        is_new = not os.path.exists(db_path)
+        self.db_path = db_path
+        self.data = Balances()
+        self.debts: Debts = {}
+        self.version = 0
+        self.applied_updates = AppliedUpdates(applied_updates)
+        self._lock = threading.RLock()
+        self._data_version: Optional[int] = None
+        self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False, cached_statements=64)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.execute('PRAGMA foreign_keys=ON')
+        self._conn.execute('PRAGMA busy_timeout=10000')
+        self._conn.executescript(SCHEMA)
+        self._migrate(is_new)
+
+        if is_new and json_path and os.path.exists(json_path):
+            initial_data = migrate_from_json(json_path, self)
+        with self.transaction():
+            self._conn.executemany(INSERT_PARTICIPANT, [(name, values.get('profits', 0), values.get('spent', 0)) for name, values in initial_data.items()])
+            self._load()
+
+    def refresh(self):
+        with self._lock:
+            if self._read_data_version() != self._data_version:
+                self._load()
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self._read_data_version() != self._data_version:
+                    self._load()
+                yield
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                self._load()
+                raise
+            self._conn.execute('COMMIT')
+
+    def record(self, kind: str, changes: Dict[str, Dict[str, int]], amounts: Dict[str, int], comment: str = '',
+               update_id: Optional[int] = None, debts: Optional[Debts] = None):
+        for participant, fields in changes.items():
+            if participant not in self.data:
+                # Added by add_participants()
+                self._conn.execute(INSERT_PARTICIPANT, (participant, 0, 0))
+            for field, value in fields.items():
+                self._conn.execute(UPDATE_FIELD[field], (value, participant))
+        timestamp = time.time()
+        self._conn.executemany(INSERT_TRANSACTION, [(participant, kind, amount, timestamp, comment) for participant, amount in amounts.items()])
+        if update_id is not None:
+            self._conn.execute(INSERT_APPLIED_UPDATE, (update_id, timestamp))
+            forgotten = self.applied_updates.add(update_id)
+            if forgotten is not None:
+                self._conn.execute(DELETE_APPLIED_UPDATE, (forgotten,))
+        for debtor, creditors in (debts or {}).items():
+            for creditor, amount in creditors.items():
+                self._conn.execute(UPSERT_DEBT if amount else DELETE_DEBT, (debtor, creditor, amount) if amount else (debtor, creditor))
+
+        self.data.apply(changes)
+        if debts:
+            apply_debts(self.debts, debts)
+        self.version += 1
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get_transactions(self, participant: Optional[str] = None, kind: Optional[str] = None,
+                         since: Optional[float] = None, until: Optional[float] = None, limit: int = 100) -> List[Tuple]:
+        """
+        Return transactions matching the filters, newest first, using the history indexes.
+
+        Args:
+            participant (Optional[str]): Only return transactions of this participant.
+            kind (Optional[str]): Only return transactions of this kind.
+            since (Optional[float]): Lower bound (inclusive) of the unix timestamp.
+            until (Optional[float]): Upper bound (exclusive) of the unix timestamp.
+            limit (int): Maximum number of rows to return.
+
+        Returns:
+            List[Tuple]: Rows of (participant, kind, amount, timestamp, comment).
+        """
+        conditions, params = [], []
+        for column, operator, value in (('participant', '=', participant), ('kind', '=', kind), ('timestamp', '>=', since), ('timestamp', '<', until)):
+            if value is not None:
+                conditions.append(f'{column} {operator} ?')
+                params.append(value)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        query = f'SELECT participant, kind, amount, timestamp, comment FROM transactions{where} ORDER BY timestamp DESC LIMIT ?'
+        with self._lock:
+            return self._conn.execute(query, (*params, limit)).fetchall()
+
+    def _read_data_version(self) -> int:
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def _migrate(self, is_new: bool):
+        """Convert the amounts of a database written before MONEY_FORMAT to cents."""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self._conn.execute('PRAGMA user_version').fetchone()[0] < MONEY_FORMAT:
+                    if not is_new:
+                        for statement in MIGRATE_TO_CENTS:
+                            self._conn.execute(statement)
+                        logger.info(f'sqlite_storage.py:_migrate(). Converted the amounts of {self.db_path} to cents')
+                    self._conn.execute(f'PRAGMA user_version = {MONEY_FORMAT}')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def _load(self):
+        self.data = Balances.from_dict({name: {'profits': profits, 'spent': spent} for name, profits, spent in self._conn.execute(SELECT_PARTICIPANTS)})
+        self.debts = {}
+        for debtor, creditor, amount in self._conn.execute(SELECT_DEBTS):
+            self.debts.setdefault(debtor, {})[creditor] = amount
+        recent = self._conn.execute(SELECT_APPLIED_UPDATES, (self.applied_updates.capacity,)).fetchall()
+        self.applied_updates.replace(update_id for update_id, in reversed(recent))
+        self._data_version = self._read_data_version()
+        self.version += 1
+
+
+def migrate_from_json(json_path: str, storage: SQLiteStorage) -> Dict[str, Dict[str, int]]:
+    """
+    Import the JSON snapshot and its journal into a freshly created SQLite storage.
+
+    Args:
+        json_path (str): Path to the legacy finance_info.json file.
+        storage (SQLiteStorage): The storage to import into.
+
+    Returns:
+        Dict[str, Dict[str, int]]: The imported data.
+    """
+    # Same lock as LedgerStorage: a bot still running on the JSON files may be appending to the journal
+    with FileLock(json_path + '.lock'):
+        ledger = Ledger(json_path, {}, snapshot_interval=1)
+        ledger.load()
+    with storage.transaction():
+        storage._conn.executemany(INSERT_PARTICIPANT, [(name, values.get('profits', 0), values.get('spent', 0)) for name, values in ledger.data.items()])
+        storage._conn.executemany(INSERT_APPLIED_UPDATE, [(update_id, time.time()) for update_id in ledger.applied_updates])
+        storage._conn.executemany(UPSERT_DEBT, [(debtor, creditor, amount) for debtor, creditors in ledger.debts.items() for creditor, amount in creditors.items()])
+    logger.info(f'sqlite_storage.py:migrate_from_json(). Imported {len(ledger.data)} participants from {json_path} into {storage.db_path}')
+    return ledger.data
+
+
+if __name__ == '__main__':
+    # One-shot migration: python3 sqlite_storage.py [finance_info.json] [finance.db]
+    from env import FINANCE_INFO_FILE, FINANCE_DB_FILE
+
+    json_path = sys.argv[1] if len(sys.argv) > 1 else FINANCE_INFO_FILE
+    db_path = sys.argv[2] if len(sys.argv) > 2 else FINANCE_DB_FILE
+    if os.path.exists(db_path):
+        sys.exit(f'{db_path} already exists, refusing to overwrite it')
+    SQLiteStorage(db_path, {}, json_path=json_path)
@@ -0,0 +1,131 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+from filelock import FileLock
+from debts import Debts
+from ledger import AppliedUpdates, Ledger
+from money import Balances
+from shared.file_watch import ChangeWatcher
+
+
+class FinanceStorage(ABC):
+    """
+    Storage interface used by FinanceProcessor.
+
+    A storage keeps the current financial data in memory (the `data` attribute, amounts
+    in cents) and persists every mutation. Mutations are grouped in transactions: inside the
+    `transaction()` context `data` is guaranteed to be up to date and no other thread
+    or process can commit until the context is left.
+    """
+    data: Balances
+    # Debts between the participants, changed by the same records as `data`
+    debts: Debts
+    # Incremented whenever `data` changes (own records and reloads alike)
+    version: int
+    # Updates whose mutations are persisted, up to date inside `transaction()`
+    applied_updates: AppliedUpdates
+
+    @abstractmethod
+    def refresh(self):
+        """
+        Bring `data` up to date with changes committed by other processes.
+        """
+
+    @abstractmethod
+    def transaction(self) -> Iterator[None]:
+        """
+        Context manager that holds exclusive write access to the storage.
+        """
+
+    def close(self):
+        """
+        Release the files, connections and threads held by the storage.
+        """
+
+    @abstractmethod
+    def record(self, kind: str, changes: Dict[str, Dict[str, int]], amounts: Dict[str, int], comment: str = '',
+               update_id: Optional[int] = None, debts: Optional[Debts] = None):
+        """
+        Persist a mutation and apply it to `data`. Must be called inside `transaction()`.
+
+        Args:
+            kind (str): Kind of the transaction (loan, balance_change, set_profits, set_spent).
+            changes (Dict[str, Dict[str, int]]): New values in cents of the changed fields per participant.
+            amounts (Dict[str, int]): Transaction amount in cents per affected participant.
+            comment (str): Optional free text explanation.
+            update_id (Optional[int]): Telegram update that caused the mutation, persisted atomically with it
+                and added to `applied_updates`.
+            debts (Optional[Debts]): Resulting amounts of the debt pairs changed by the mutation (0 settles a pair),
+                persisted atomically with it and applied to `debts`.
+        """
+
+
+class LedgerStorage(FinanceStorage):
+    """
+    Storage backed by the append-only journal and JSON snapshot (see Ledger).
+
+    Transactions are serialized across processes with a FileLock next to the snapshot.
+
+    The in-memory state is authoritative. Unless change detection is disabled
+    (change_detection='lock'), refresh() neither takes the lock nor reads the files
+    as long as the snapshot and the journal are unchanged according to a ChangeWatcher
+    (inotify, or stat() signatures with change_detection='stat').
+    """
+    def __init__(self, snapshot_path: str, initial_data: Dict[str, Dict[str, int]], snapshot_interval: int, change_detection: str = 'inotify',
+                 applied_updates: int = 10000):
+        self.lock = FileLock(snapshot_path + '.lock')
+        with self.lock:
+            self._ledger = Ledger(snapshot_path, initial_data, snapshot_interval=snapshot_interval, applied_updates=applied_updates)
+            self._watcher = None
+            if change_detection != 'lock':
+                self._watcher = ChangeWatcher([snapshot_path, self._ledger.journal_path], use_inotify=change_detection == 'inotify')
+                self._watcher.mark_seen()
+            self._ledger.load()
+
+    @property
+    def data(self) -> Balances:
+        return self._ledger.data
+
+    @property
+    def version(self) -> int:
+        return self._ledger.version
+
+    @property
+    def debts(self) -> Debts:
+        return self._ledger.debts
+
+    @property
+    def applied_updates(self) -> AppliedUpdates:
+        return self._ledger.applied_updates
+
+    def refresh(self):
+        if self._watcher is not None and not self._watcher.changed():
+            return
+        with self.lock:
+            self._catch_up()
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        with self.lock:
+            # inotify events may still be in flight here, so writers always check the files.
+            # It costs two stat() calls unless another process has appended records.
+            self._catch_up()
+            yield
+            if self._watcher is not None and not self._watcher.uses_inotify:
+                # Our own writes are already applied in memory
+                self._watcher.mark_seen()
+
+    def close(self):
+        with self.lock:
+            if self._watcher is not None:
+                self._watcher.close()
+            self._ledger.close()
+
+    def _catch_up(self):
+        if self._watcher is not None:
+            self._watcher.mark_seen()
+        self._ledger.catch_up()
+
+    def record(self, kind: str, changes: Dict[str, Dict[str, int]], amounts: Dict[str, int], comment: str = '',
+               update_id: Optional[int] = None, debts: Optional[Debts] = None):
+        self._ledger.append(kind, changes, amounts=amounts, comment=comment, update_id=update_id, debts=debts)
@@ -0,0 +1,212 @@
+import json
+import os
+import threading
+
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+from filelock import FileLock
+from telegram import User as TelegramUser
+from shared.fileio import atomic_write_json
+from shared.file_watch import ChangeWatcher
+
+# Import env variables
+from env import logger
+
+
+class User(NamedTuple):
+    """A user allowed to use the bot. `id` is None until the user first writes to the bot."""
+    id: Optional[int]
+    username: str
+    aliases: Tuple[str, ...] = ()
+    admin: bool = False
+
+
+class UserRegistry:
+    """
+    The users allowed to use the bot, keyed by their Telegram user ID.
+
+    The users are kept in a JSON file of the form
+    {"users": [{"id": 123, "username": "alice", "aliases": ["alice_old"], "admin": true}, ...]}.
+    A user added by username only (e.g. seeded from ALLOWED_USERS_FINANCE_BOT) has no ID
+    yet; the ID is bound when a Telegram user with that username or alias first writes to
+    the bot, and from then on only that ID is accepted, even if the username changes
+    hands.
+
+    Lookups are dictionary reads. The file is reloaded when it changes (checked with a
+    ChangeWatcher, a flag read with inotify), so it can be edited by hand without a
+    restart; an invalid edit is logged and the previous users are kept. Changes made by
+    the bot are applied under a FileLock to the latest version of the file and written
+    atomically.
+    """
+    def __init__(self, path: str, seed_usernames: List[str], seed_admins: List[str], use_inotify: bool = True):
+        """
+        Open (and create if needed) the registry.
+
+        Args:
+            path (str): Path to the JSON file.
+            seed_usernames (List[str]): Usernames of the users of a new file.
+            seed_admins (List[str]): Usernames of the admins of a new file.
+            use_inotify (bool): Watch the file with inotify instead of polling stat().
+        """
+        self.path = path
+        self.lock = FileLock(path + '.lock')
+        self._write_lock = threading.Lock()
+        self._users: List[User] = []
+        self._by_id: Dict[int, User] = {}
+        self._by_name: Dict[str, User] = {}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.lock:
+            if not os.path.exists(path):
+                admins = {name.lower() for name in seed_admins}
+                seed = [User(None, name, admin=name.lower() in admins) for name in dict.fromkeys(seed_usernames) if name]
+                self._write(seed)
+                logger.info(f'users.py:__init__(). Created {path} with {len(seed)} users')
+            self._watcher = ChangeWatcher([path], use_inotify=use_inotify)
+            self._watcher.mark_seen()
+            self._index(self._read())
+
+    def __len__(self) -> int:
+        self._refresh()
+        return len(self._users)
+
+    def get(self, user: TelegramUser) -> Optional[User]:
+        """
+        Look up the registry entry of a Telegram user, binding the user's ID to an entry added by username.
+
+        Args:
+            user (TelegramUser): The user.
+
+        Returns:
+            Optional[User]: The entry, None if the user isn't allowed.
+        """
+        self._refresh()
+        entry = self._by_id.get(user.id)
+        if entry is not None:
+            return entry
+        entry = self._by_name.get((user.username or '').lower())
+        if entry is None:
+            return None
+        if entry.id is not None:
+            logger.warning(f'users.py:get(). @{user.username} (id={user.id}) uses the username of the user with id={entry.id}')
+            return None
+        return self._bind(user)
+
+    def is_allowed(self, user: TelegramUser) -> bool:
+        return self.get(user) is not None
+
+    def is_admin(self, user: TelegramUser) -> bool:
+        entry = self.get(user)
+        return entry is not None and entry.admin
+
+    def add(self, identifier: str, admin: bool = False) -> User:
+        """
+        Add a user, or change the admin flag of an existing one.
+
+        Args:
+            identifier (str): Telegram user ID or username (with or without @).
+            admin (bool): Allow the user to run the admin commands.
+
+        Returns:
+            User: The added or updated entry.
+        """
+        user_id, name = _parse_identifier(identifier)
+
+        def add(users: List[User]) -> Tuple[List[User], User]:
+            for i, entry in enumerate(users):
+                if (user_id is not None and entry.id == user_id) or (name and name.lower() in _names(entry)):
+                    users[i] = entry._replace(admin=admin)
+                    return users, users[i]
+            entry = User(user_id, name or '', admin=admin)
+            return users + [entry], entry
+        return self._modify(add)
+
+    def remove(self, identifier: str) -> Optional[User]:
+        """
+        Remove a user.
+
+        Args:
+            identifier (str): Telegram user ID, username or alias (with or without @).
+
+        Returns:
+            Optional[User]: The removed entry, None if there is no such user.
+
+        Raises:
+            ValueError: If the user is the last admin.
+        """
+        user_id, name = _parse_identifier(identifier)
+
+        def remove(users: List[User]) -> Tuple[List[User], Optional[User]]:
+            for entry in users:
+                if (user_id is not None and entry.id == user_id) or (name and name.lower() in _names(entry)):
+                    if entry.admin and sum(user.admin for user in users) == 1:
+                        raise ValueError('The last admin can\'t be removed')
+                    return [user for user in users if user is not entry], entry
+            return users, None
+        return self._modify(remove)
+
+    def _bind(self, user: TelegramUser) -> Optional[User]:
+        def bind(users: List[User]) -> Tuple[List[User], Optional[User]]:
+            for i, current in enumerate(users):
+                if current.id == user.id:
+                    # Bound by a concurrent update of the same user
+                    return users, current
+                if current.id is None and (user.username or '').lower() in _names(current):
+                    users[i] = current._replace(id=user.id)
+                    logger.info(f'users.py:_bind(). Bound @{user.username} to id={user.id}')
+                    return users, users[i]
+            # Removed or bound to another ID in the meantime
+            return users, None
+        return self._modify(bind)
+
+    def _modify(self, change: Callable[[List[User]], Tuple[List[User], object]]):
+        with self._write_lock, self.lock:
+            self._watcher.mark_seen()
+            current = self._read()
+            users, result = change(list(current))
+            if users != current:
+                self._write(users)
+            self._index(users)
+        return result
+
+    def _refresh(self):
+        if not self._watcher.changed():
+            return
+        with self._write_lock:
+            self._watcher.mark_seen()
+            try:
+                self._index(self._read())
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.error(f'users.py:_refresh(). Keeping the previous users, {self.path} is invalid. Exception: {e}')
+                return
+        logger.info(f'users.py:_refresh(). Reloaded {len(self._users)} users from {self.path}')
+
+    def _index(self, users: List[User]):
+        by_id = {entry.id: entry for entry in users if entry.id is not None}
+        by_name = {name: entry for entry in users for name in _names(entry)}
+        # Readers don't take a lock, so the indexes are replaced rather than updated
+        self._users, self._by_id, self._by_name = users, by_id, by_name
+
+    def _read(self) -> List[User]:
+        with open(self.path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)['users']
+        return [User(int(entry['id']) if entry.get('id') is not None else None, entry.get('username') or '',
+                     tuple(entry.get('aliases', ())), bool(entry.get('admin', False))) for entry in entries]
+
+    def _write(self, users: List[User]):
+        entries = []
+        for user in users:
+            entry = {'id': user.id, 'username': user.username, 'admin': user.admin}
+            if user.aliases:
+                entry['aliases'] = list(user.aliases)
+            entries.append(entry)
+        atomic_write_json(self.path, {'users': entries})
+
+
+def _names(user: User) -> List[str]:
+    return [name.lower() for name in (user.username,) + tuple(user.aliases) if name]
+
+
+def _parse_identifier(identifier: str) -> Tuple[Optional[int], str]:
+    identifier = identifier.strip().lstrip('@')
+    if identifier.isdigit():
+        return int(identifier), ''
+    return None, identifier
@@ -1,35 +1,57 @@
-import os
-import pgpy
+import html
+import re
 import telegram
 
-from pgpy import PGPMessage
+from concurrent.futures import TimeoutError
+from typing import List
+
 from telegram import Update
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
 
+from decryption_service import DecryptionService, ServiceBusy, TooManyMessages
+from shared import metrics
+from shared.metrics import instrument_handler
+from shared.profiling import SlowUpdateProfiler
 from shared.handlers import CHandler
+from shared.runner import run_updater
 
 # Import environment variables
-from env import GREETINGS_MESSAGE, CANCEL_TEXT, SUCCESS_MESSAGE, ERROR_MESSAGE, DECRIPTION_SUCCESSFUL_MESSAGE, PGP_PASSPHRASE, PGP_DIR, logger
+from env import GREETINGS_MESSAGE, CANCEL_TEXT, BUSY_MESSAGE, TOO_MANY_MESSAGES_MESSAGE, DECRYPTION_WORKERS, DECRYPTION_QUEUE_SIZE, DECRYPTION_TIMEOUT, SUCCESS_MESSAGE, ERROR_MESSAGE, DECRIPTION_SUCCESSFUL_MESSAGE, PGP_PASSPHRASE, PGP_DIR,\
+    TELEGRAM_API_URL, TWO_FA_BOT_WEBHOOK_URL, TWO_FA_BOT_WEBHOOK_PORT, CONVERSATION_TTL, CONVERSATION_MAX_ENTRIES, PROFILES_DIR, PROFILING_SAMPLE_RATE,\
+    PROFILING_THRESHOLD, PROFILING_MAX_PROFILES, PROFILING_RECENT_UPDATES, logger
+
+
+PGP_MESSAGE_PATTERN = re.compile(r'-----BEGIN PGP MESSAGE-----.*?-----END PGP MESSAGE-----', re.DOTALL)
+# Opt-in profiling of the update handlers, the summaries of the updates never contain the messages
+profiler = SlowUpdateProfiler(PROFILES_DIR, logger, sample_rate=PROFILING_SAMPLE_RATE, threshold=PROFILING_THRESHOLD,
+                              max_profiles=PROFILING_MAX_PROFILES, recent=PROFILING_RECENT_UPDATES)
+DECRYPT_FAILURES = metrics.counter('decrypt_failures_total', 'Messages that couldn\'t be decrypted.', ('reason',))
 
 
 class TwoFABot:
     def __init__(self, token: str):
-        self.c_handler = CHandler()
+        self.c_handler = CHandler(ttl=CONVERSATION_TTL, max_entries=CONVERSATION_MAX_ENTRIES)
+        self.decryption_service = DecryptionService(PGP_DIR, PGP_PASSPHRASE, workers=DECRYPTION_WORKERS,
+                                                    max_pending=DECRYPTION_QUEUE_SIZE, timeout=DECRYPTION_TIMEOUT)
         self._token = token
         self._updater: Updater = None
         self._dp: Updater.dispatcher = None
         self.bot: telegram.Bot = None
 
     def run(self):
-        self._updater = Updater(self._token)
+        self._updater = Updater(self._token, base_url=TELEGRAM_API_URL)
         self._dp = self._updater.dispatcher
         self.bot = self._updater.bot
 
         self._dp.add_handler(CommandHandler("start", self.bot_startup))
         self._dp.add_handler(MessageHandler(Filters.text, self.process_text))
 
-        self._updater.start_polling()
+        self.decryption_service.start()
+        run_updater(self._updater, logger, webhook_url=TWO_FA_BOT_WEBHOOK_URL, webhook_port=TWO_FA_BOT_WEBHOOK_PORT)
+        self.decryption_service.shutdown()
 
+    @instrument_handler
+    @profiler.wrap
     def bot_startup(self, update: Update, context: CallbackContext):
         """Handles /start command"""
         message = update.message
@@ -42,6 +64,8 @@ class TwoFABot:
         except Exception as e:
             logger.error(f'TWOFA_bot.py:bot_startup(). Exception: {e}')
 
+    @instrument_handler
+    @profiler.wrap
     def process_text(self, update: Update, context: CallbackContext):
         """Decrypts a pgp signed message"""
         message = update.message
@@ -59,16 +83,34 @@ class TwoFABot:
             except:
                 self.bot.send_message(chat_id, ERROR_MESSAGE)
 
+    @staticmethod
+    def split_messages(text: str) -> List[str]:
+        """Returns every armored PGP message block found in the text, or the whole text if there is none."""
+        return PGP_MESSAGE_PATTERN.findall(text) or [text]
+
     def decrypt_message(self, chat_id: int, text: str):
+        """Decrypts every PGP message block of the text in parallel and replies with all the results at once."""
+        try:
+            results = self.decryption_service.decrypt_all(self.split_messages(text))
+        except ServiceBusy:
+            DECRYPT_FAILURES.inc(reason='busy')
+            logger.warning(f'TWOFA_bot.py:decrypt_message(). Decryption queue is full, asking [id={chat_id}] to retry')
+            return self.bot.send_message(chat_id, BUSY_MESSAGE)
+        except TooManyMessages:
+            DECRYPT_FAILURES.inc(reason='too_many')
+            logger.warning(f'TWOFA_bot.py:decrypt_message(). [id={chat_id}] sent more than {self.decryption_service.max_pending} PGP messages at once')
+            return self.bot.send_message(chat_id, TOO_MANY_MESSAGES_MESSAGE.format(self.decryption_service.max_pending))
+        except TimeoutError:
+            DECRYPT_FAILURES.inc(reason='timeout')
+            logger.error(f'TWOFA_bot.py:decrypt_message(). Decryption timed out after {DECRYPTION_TIMEOUT}s')
+            return self.bot.send_message(chat_id, ERROR_MESSAGE)
+        except Exception as e:
+            DECRYPT_FAILURES.inc(reason='error')
+            logger.error('TWOFA_bot.py:decrypt_message(). Error dycrypting the following message:\n' + text + f'. Exception: {e}')
+            return
+
         try:
-            key, _ = pgpy.PGPKey.from_file(os.path.join(PGP_DIR, 'key.asc'))
-            message = PGPMessage.from_blob(text)
-
-            with key.unlock(PGP_PASSPHRASE):
-                result = key.decrypt(message).message
-                if isinstance(result, bytes):
-                    result = result.decode('utf-8')
-                self.bot.send_message(chat_id, DECRIPTION_SUCCESSFUL_MESSAGE)
-                self.bot.send_message(chat_id, '<code>' + result + '</code>', parse_mode=telegram.ParseMode.HTML)
+            self.bot.send_message(chat_id, DECRIPTION_SUCCESSFUL_MESSAGE)
+            self.bot.send_message(chat_id, '\n\n'.join('<code>' + html.escape(result) + '</code>' for result in results), parse_mode=telegram.ParseMode.HTML)
         except Exception as e:
             logger.error('TWOFA_bot.py:decrypt_message(). Error dycrypting the following message:\n' + text + f'. Exception: {e}')
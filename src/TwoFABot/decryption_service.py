@@ -0,0 +1,168 @@
+import multiprocessing
+import os
+import threading
+import time
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import List, Optional
+from decryption_worker import decrypt, init_worker, ping
+from shared import metrics
+
+
+DECRYPT_DURATION = metrics.histogram('decrypt_duration_seconds', 'Time from queueing a decryption job until it is done, including the wait for a worker.')
+PENDING_JOBS = metrics.gauge('decrypt_pending_jobs', 'Decryption jobs queued or running.')
+REJECTED_JOBS = metrics.counter('decrypt_rejected_total', 'Decryption jobs rejected because the queue was full.')
+KEY_LOAD_SECONDS = metrics.gauge('pgp_key_load_seconds', 'Time the latest load of the PGP keys took in a decryption worker, as reported by its last job.')
+
+
+class ServiceBusy(Exception):
+    """Raised when the decryption queue is full."""
+
+
+class TooManyMessages(Exception):
+    """Raised when a single request holds more messages than the queue can ever take."""
+
+
+class DecryptionService:
+    """
+    Decrypts PGP messages in a pool of worker processes.
+
+    pgpy is pure Python and CPU bound, so decrypting in the bot's own process would
+    hold the GIL and stall every other chat. Each worker process loads and unlocks the
+    keys once (see Keyring) and keeps them for its lifetime, so throughput scales with
+    the number of cores.
+
+    At most `max_pending` jobs are accepted at a time; further submissions raise
+    ServiceBusy so the bot can ask the user to retry instead of queueing without limit.
+
+    The keys are loaded in the workers: every job also reports how long the worker's
+    latest key load took, kept in `key_load_duration` and the pgp_key_load_seconds metric.
+    """
+    def __init__(self, key_dir: str, passphrase: str, workers: int = 0, max_pending: int = 0, timeout: float = 30.0):
+        """
+        Args:
+            key_dir (str): Directory containing the ASCII armored private keys.
+            passphrase (str): Passphrase protecting the keys.
+            workers (int): Number of worker processes, 0 uses the number of available cores.
+            max_pending (int): Maximum number of queued and running jobs, 0 uses 4 per worker.
+            timeout (float): Seconds to wait for a single job.
+        """
+        self.workers = workers or _available_cores()
+        self.timeout = timeout
+        self.key_load_duration: Optional[float] = None
+        self.max_pending = max_pending or self.workers * 4
+        self._pending = threading.BoundedSemaphore(self.max_pending)
+        # 'spawn' avoids forking a process that already runs the logging and polling threads,
+        # the workers only import decryption_worker (and the guarded start_bot.py as __mp_main__)
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                         initializer=init_worker, initargs=(key_dir, passphrase))
+
+    def start(self):
+        """Starts the worker processes so that the keys are loaded before the first message arrives."""
+        for future in [self._pool.submit(ping) for _ in range(self.workers)]:
+            _, load_duration = future.result()
+            self._report_key_load(load_duration)
+
+    def submit(self, text: str) -> Future:
+        """
+        Queues a message for decryption.
+
+        Args:
+            text (str): The ASCII armored PGP message.
+
+        Returns:
+            Future: Resolves to the decrypted text and the duration of the worker's latest key load, see result().
+
+        Raises:
+            ServiceBusy: If `max_pending` jobs are already queued or running.
+        """
+        if not self._pending.acquire(blocking=False):
+            REJECTED_JOBS.inc()
+            raise ServiceBusy()
+        try:
+            future = self._pool.submit(decrypt, text)
+        except BaseException:
+            self._pending.release()
+            raise
+        PENDING_JOBS.inc()
+        submitted = time.perf_counter()
+        future.add_done_callback(lambda _: self._job_done(submitted))
+        return future
+
+    def result(self, future: Future, timeout: Optional[float]) -> str:
+        """
+        Args:
+            future (Future): A future returned by submit().
+            timeout (Optional[float]): Seconds to wait for the job.
+
+        Returns:
+            str: The decrypted text.
+        """
+        text, load_duration = future.result(timeout)
+        self._report_key_load(load_duration)
+        return text
+
+    def _report_key_load(self, load_duration: Optional[float]):
+        if load_duration is not None:
+            self.key_load_duration = load_duration
+            KEY_LOAD_SECONDS.set(load_duration)
+
+    def _job_done(self, submitted: float):
+        self._pending.release()
+        PENDING_JOBS.dec()
+        DECRYPT_DURATION.observe(time.perf_counter() - submitted)
+
+    def decrypt(self, text: str) -> str:
+        """
+        Decrypts a message, waiting at most `timeout` seconds.
+
+        Raises:
+            ServiceBusy: If the queue is full.
+            concurrent.futures.TimeoutError: If the job didn't finish in time.
+        """
+        future = self.submit(text)
+        try:
+            return self.result(future, self.timeout)
+        except BaseException:
+            # A job that hasn't started yet doesn't need to run anymore
+            future.cancel()
+            raise
+
+    def decrypt_all(self, texts: List[str]) -> List[str]:
+        """
+        Decrypts several messages in parallel, waiting at most `timeout` seconds for all of them.
+
+        Args:
+            texts (List[str]): The ASCII armored PGP messages.
+
+        Returns:
+            List[str]: The decrypted texts, in the same order.
+
+        Raises:
+            TooManyMessages: If there are more messages than `max_pending`, nothing is queued.
+            ServiceBusy: If the queue can't take all the messages. The ones already queued are cancelled.
+            concurrent.futures.TimeoutError: If the jobs didn't finish in time.
+        """
+        if len(texts) > self.max_pending:
+            # Every message takes a slot, they would never fit even in an idle queue
+            raise TooManyMessages()
+        futures = []
+        try:
+            for text in texts:
+                futures.append(self.submit(text))
+            deadline = time.monotonic() + self.timeout
+            return [self.result(future, max(0.0, deadline - time.monotonic())) for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
@@ -0,0 +1,40 @@
+import logging
+import os
+import sys
+
+from typing import Optional, Tuple
+from pgpy import PGPMessage
+from key_manager import Keyring
+
+
+# Entry points of the decryption worker processes (see DecryptionService).
+# The workers are spawned and import this module only: it must not import env, which
+# opens the bot's rotating log file and starts its logging thread in every worker.
+
+# Keyring of the current worker process, created by init_worker
+_worker_keys: Optional[Keyring] = None
+
+
+def init_worker(key_dir: str, passphrase: str):
+    global _worker_keys
+    # Workers report through stderr (docker logs) so they never rotate the bot's log file
+    log = logging.getLogger('decryption_worker')
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s[%(process)d] - %(levelname)s - %(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    _worker_keys = Keyring(key_dir, passphrase, log=log)
+
+
+# The results carry the duration of the worker's latest key (re)load, so the bot process can publish it
+
+def ping() -> Tuple[int, Optional[float]]:
+    return os.getpid(), _worker_keys.load_duration
+
+
+def decrypt(text: str) -> Tuple[str, Optional[float]]:
+    result = _worker_keys.decrypt(PGPMessage.from_blob(text))
+    if isinstance(result, bytes):
+        result = result.decode('utf-8')
+    return result, _worker_keys.load_duration
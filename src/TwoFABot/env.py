@@ -7,12 +7,21 @@ from shared.shared_env import *
 
 # Define constants
 PGP_DIR: str = os.path.join(BASE_DIR, 'PGP')
+# Profiles of slow updates (see PROFILING_SAMPLE_RATE)
+PROFILES_DIR: str = os.path.join(BASE_DIR, 'logs/profiles')
 
 CANCEL_TEXT: str = '❌ Cancel'
 ERROR_MESSAGE: str = '❌ An error has occured!'
 SUCCESS_MESSAGE: str = '✅ Done!'
 DECRIPTION_SUCCESSFUL_MESSAGE: str = '😎 The message has been decrypted!'
 GREETINGS_MESSAGE: str = '👋 Send an encrypted PGP message to the bot!'
+BUSY_MESSAGE: str = '⏳ The bot is busy, please retry in a moment.'
+TOO_MANY_MESSAGES_MESSAGE: str = '❌ Too many PGP messages, send at most {} at once.'
+
+# Decryption worker processes (0 = one per available core), maximum queued jobs (0 = 4 per worker) and timeout per job in seconds
+DECRYPTION_WORKERS: int = int(os.environ.get('DECRYPTION_WORKERS', 0))
+DECRYPTION_QUEUE_SIZE: int = int(os.environ.get('DECRYPTION_QUEUE_SIZE', 0))
+DECRYPTION_TIMEOUT: float = float(os.environ.get('DECRYPTION_TIMEOUT', 30))
 
 # Create a logger
 logger: Logger = get_logger(__name__, os.path.join(BASE_DIR, 'logs/two_fa_bot.log'))
@@ -0,0 +1,106 @@
+import logging
+import os
+import threading
+import time
+import pgpy
+
+from logging import Logger
+from typing import Dict, List, Optional, Union
+from pgpy import PGPKey, PGPMessage
+from shared.file_watch import ChangeWatcher
+
+
+class Keyring:
+    """
+    Keeps every private PGP key of a directory parsed and unlocked in memory.
+
+    All `*.asc` files in the directory are loaded and each key is indexed by the key IDs
+    of its primary key and subkeys. A message is decrypted with the key found by looking
+    up its recipient key IDs in the index, without trial decryption.
+
+    Parsing the ASCII armor and deriving the keys from the passphrase (S2K) happen once
+    at startup instead of for every message, so decryption only costs the asymmetric
+    operation. The directory is watched and the keyring is reloaded when it changes.
+
+    The passphrase is only handed to pgpy's unlock() and is never logged. The unlocked
+    key material is cleared (by leaving the unlock contexts) when the keys are replaced
+    or the keyring is closed.
+    """
+    def __init__(self, key_dir: str, passphrase: str, log: Optional[Logger] = None):
+        """
+        Args:
+            key_dir (str): Directory containing ASCII armored private keys (*.asc).
+            passphrase (str): Passphrase protecting the keys.
+            log (Optional[Logger]): Logger used to report (re)loads, defaults to the module's logger.
+        """
+        self.log = log or logging.getLogger(__name__)
+        self.key_dir = key_dir
+        self._passphrase = passphrase
+        self._lock = threading.Lock()
+        self._index: Dict[str, PGPKey] = {}
+        self._unlock_contexts: List = []
+        self.load_duration: Optional[float] = None
+        self._watcher = ChangeWatcher([key_dir])
+        self._reload()
+
+    def __len__(self) -> int:
+        return len({id(key) for key in self._index.values()})
+
+    def decrypt(self, message: PGPMessage) -> Union[str, bytes]:
+        """
+        Decrypts a message with the key it is addressed to, reloading the keyring first if the directory has changed.
+
+        Args:
+            message (PGPMessage): The encrypted message.
+
+        Returns:
+            Union[str, bytes]: The decrypted content.
+        """
+        if self._watcher.changed():
+            self._reload()
+        index = self._index
+        for key_id in message.encrypters:
+            key = index.get(key_id)
+            if key is not None:
+                return key.decrypt(message).message
+        raise Exception(f'No key in {self.key_dir} for recipients {", ".join(message.encrypters) or "-"}')
+
+    def close(self):
+        """Clears the unlocked key material."""
+        with self._lock:
+            self._release(self._unlock_contexts)
+            self._index, self._unlock_contexts = {}, []
+
+    def _reload(self):
+        with self._lock:
+            if not self._watcher.changed():
+                return
+            self._watcher.mark_seen()
+
+            start = time.perf_counter()
+            index, unlock_contexts = {}, []
+            for name in sorted(os.listdir(self.key_dir)) if os.path.isdir(self.key_dir) else []:
+                if not name.endswith('.asc'):
+                    continue
+                try:
+                    key, _ = pgpy.PGPKey.from_file(os.path.join(self.key_dir, name))
+                    unlock_context = key.unlock(self._passphrase)
+                    unlock_context.__enter__()
+                except Exception as e:
+                    self.log.error(f'key_manager.py:_reload(). Failed to load the PGP key {name} from {self.key_dir}. Exception: {e}')
+                    continue
+                unlock_contexts.append(unlock_context)
+                index[key.fingerprint.keyid] = key
+                for key_id in key.subkeys:
+                    index[key_id] = key
+            self.load_duration = time.perf_counter() - start
+
+            previous_contexts = self._unlock_contexts
+            self._index, self._unlock_contexts = index, unlock_contexts
+            self._release(previous_contexts)
+            self.log.info(f'key_manager.py:_reload(). Loaded {len(unlock_contexts)} PGP keys ({len(index)} key IDs) in {self.load_duration * 1000:.1f} ms')
+
+    @staticmethod
+    def _release(unlock_contexts: List):
+        for unlock_context in unlock_contexts:
+            unlock_context.__exit__(None, None, None)
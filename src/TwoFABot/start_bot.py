@@ -1,8 +1,8 @@
-# Import environment variables
-from TWOFA_bot import TwoFABot
-from env import *
-
-
 if __name__ == '__main__':
+    # Imported here: the decryption workers are spawned and re-import this script as
+    # __mp_main__, they must not load the bot, its environment and its log file
+    from TWOFA_bot import TwoFABot
+    from env import TWO_FA_BOT_TOKEN
+
     bot = TwoFABot(TWO_FA_BOT_TOKEN)
     bot.run()
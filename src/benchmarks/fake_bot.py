@@ -0,0 +1,50 @@
+import itertools
+import threading
+import time
+import telegram
+
+from collections import Counter
+from telegram.utils.request import Request
+from typing import Dict, Union
+
+
+class FakeBot(telegram.Bot):
+    """
+    telegram.Bot that answers every Bot API request in-process instead of calling Telegram.
+
+    Requests go through the regular Bot methods (argument handling, defaults,
+    de_json of the results) and only the HTTP round trip in _post() is replaced:
+    message requests get a minimal Message back, everything else True. An optional
+    `latency` simulates the round trip to the API.
+
+    `calls` counts the requests per endpoint.
+    """
+    def __init__(self, latency: float = 0.0):
+        """
+        Args:
+            latency (float): Seconds every request takes.
+        """
+        # The pool size only silences the Updater's warning, no connection is ever made
+        super().__init__(token='123456:BENCHMARK', request=Request(con_pool_size=8))
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._calls_lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+
+    def _post(self, endpoint: str, data: Dict = None, timeout=None, api_kwargs: Dict = None) -> Union[bool, Dict]:
+        with self._calls_lock:
+            self.calls[endpoint] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        data = {**(data or {}), **(api_kwargs or {})}
+        if endpoint == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        if endpoint in ('sendMessage', 'sendDocument', 'editMessageText'):
+            return {
+                'message_id': data.get('message_id') or next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': data.get('chat_id', 0), 'type': 'private'},
+                'text': data.get('text', ''),
+            }
+        return True
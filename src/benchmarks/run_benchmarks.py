@@ -0,0 +1,259 @@
+"""
+Offline benchmarks of the FinanceBot.
+
+Replays synthetic update streams (profits requests, loan and balance change dialogs,
+/set_* commands) of many chats through the FinanceBot handlers, with a FakeBot in
+place of the Telegram API, and times the FinanceProcessor operations, format_amount
+and CHandler on their own. Prints the results as JSON, so runs before and after a
+storage or concurrency change can be compared:
+
+    python3 src/benchmarks/run_benchmarks.py --chats 50 --iterations 20 --output before.json
+
+Every run works in a fresh temporary BASE_DIR. The bot's env variables (e.g.
+FINANCE_STORAGE_BACKEND, FINANCE_CHANGE_DETECTION) are taken from the environment;
+the required ones that are missing get placeholder values.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from typing import Callable, Dict, List
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(SRC_DIR, 'FinanceBot'), SRC_DIR]
+
+# Placeholders for the env variables the bot requires, no request leaves the process
+BENCHMARK_ENV = {
+    'DEVELOPEMENT_ENVIRONMENT': 'true',
+    'PGP_PASSPHRASE': 'benchmark',
+    'USERNAME': 'benchmark',
+    'ALLOWED_USERS_FINANCE_BOT': 'benchmark',
+    'FINANCE_BOT_PARTICIPANTS': 'alice,bob,carol',
+    'FINANCE_LOGS_CHANNEL_ID': '-1000000000000',
+    'FINANCE_BOT_TOKEN_DEV': '123456:BENCHMARK',
+    'FINANCE_BOT_LINK_DEV': 'benchmark',
+    'FINANCE_BOT_TOKEN_PRODUCTION': '123456:BENCHMARK',
+    'FINANCE_BOT_LINK_PRODUCTION': 'benchmark',
+    'TWO_FA_BOT_TOKEN_DEV': '123456:BENCHMARK',
+    'TWO_FA_BOT_LINK_DEV': 'benchmark',
+    'TWO_FA_BOT_TOKEN_PRODUCTION': '123456:BENCHMARK',
+    'TWO_FA_BOT_LINK_PRODUCTION': 'benchmark',
+}
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """
+    Args:
+        sorted_values (List[float]): Values in ascending order.
+        fraction (float): The percentile as a fraction, e.g. 0.95.
+
+    Returns:
+        float: The nearest-rank percentile, 0 for no values.
+    """
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+
+
+def summarize(durations: List[float], wall_time: float) -> Dict[str, float]:
+    """
+    Args:
+        durations (List[float]): Duration of every operation in seconds.
+        wall_time (float): Seconds the whole run took.
+
+    Returns:
+        Dict[str, float]: Count, throughput and latency percentiles (in milliseconds).
+    """
+    durations = sorted(durations)
+    return {
+        'count': len(durations),
+        'seconds': round(wall_time, 6),
+        'throughput_per_s': round(len(durations) / wall_time, 1) if wall_time > 0 else 0.0,
+        'mean_ms': round(sum(durations) / len(durations) * 1000, 4) if durations else 0.0,
+        'p50_ms': round(percentile(durations, 0.50) * 1000, 4),
+        'p95_ms': round(percentile(durations, 0.95) * 1000, 4),
+        'p99_ms': round(percentile(durations, 0.99) * 1000, 4),
+        'max_ms': round(durations[-1] * 1000, 4) if durations else 0.0,
+    }
+
+
+def run_scenario(bot, factory, scenario: Callable, chats: List[int], participants: List[str], iterations: int, workers: int) -> Dict[str, float]:
+    """
+    Replay `iterations` rounds of a scenario in every chat and time every update.
+
+    The rounds of the chats are interleaved. With workers > 0 the updates are processed
+    by a ChatOrderedDispatcher like in production, otherwise one after another.
+
+    Returns:
+        Dict[str, float]: The summary of the handler latencies, and the number of errors.
+    """
+    from shared.chat_dispatcher import ChatOrderedDispatcher
+    from env import logger
+
+    updates = [update for _ in range(iterations) for chat_id in chats for update in scenario(factory, chat_id, participants)]
+    dispatcher = bot.dispatcher
+    process_update = dispatcher.process_update
+    durations: List[float] = []
+    errors: List[Exception] = []
+
+    def timed_process_update(update):
+        started = time.perf_counter()
+        process_update(update)
+        durations.append(time.perf_counter() - started)
+
+    def error_handler(update, context):
+        errors.append(context.error)
+
+    dispatcher.add_error_handler(error_handler)
+    object.__setattr__(dispatcher, 'process_update', timed_process_update)
+    try:
+        started = time.perf_counter()
+        if workers > 0:
+            chat_dispatcher = ChatOrderedDispatcher(dispatcher, logger, max_concurrency=workers, max_pending=len(updates) + 1)
+            chat_dispatcher.install()
+            for update in updates:
+                dispatcher.process_update(update)
+            chat_dispatcher.stop(timeout=3600)
+        else:
+            for update in updates:
+                timed_process_update(update)
+        wall_time = time.perf_counter() - started
+    finally:
+        object.__setattr__(dispatcher, 'process_update', process_update)
+        dispatcher.remove_error_handler(error_handler)
+
+    summary = summarize(durations, wall_time)
+    summary['errors'] = len(errors)
+    if errors:
+        summary['first_error'] = repr(errors[0])
+    return summary
+
+
+def micro(operation: Callable[[int], object], ops: int) -> Dict[str, float]:
+    """
+    Time single calls of an operation. The timer adds a few tens of nanoseconds to every call.
+
+    Args:
+        operation (Callable[[int], object]): Called with the number of the call.
+        ops (int): Number of calls.
+
+    Returns:
+        Dict[str, float]: The summary of the call durations.
+    """
+    durations = []
+    started = time.perf_counter()
+    for i in range(ops):
+        call_started = time.perf_counter()
+        operation(i)
+        durations.append(time.perf_counter() - call_started)
+    return summarize(durations, time.perf_counter() - started)
+
+
+def run_micro(base_dir: str, ops: int) -> Dict[str, Dict[str, float]]:
+    """Microbenchmarks of FinanceProcessor, format_amount and CHandler."""
+    from finance_processor import FinanceProcessor, create_storage
+    from money import CENTS, format_amount
+    from shared.handlers import CHandler
+
+    directory = os.path.join(base_dir, 'micro')
+    os.makedirs(directory)
+    participants = ['alice', 'bob', 'carol']
+    storage = create_storage({}, info_file=os.path.join(directory, 'finance_info.json'), db_file=os.path.join(directory, 'finance.db'))
+    processor = FinanceProcessor(storage=storage)
+    processor.add_participants(participants)
+    c_handler = CHandler(ttl=0)
+    callback = lambda *_: None
+
+    def chandler_dialog(i: int):
+        c_handler.add_callback(i, callback)
+        c_handler.store_data(i, 'amount', i)
+        c_handler.has_callback(i)
+        c_handler.get_callback(i)
+        c_handler.pop_data(i, 'amount')
+
+    results = {
+        'processor.process_balance_change': micro(lambda i: processor.process_balance_change((i % 1000 - 400) * CENTS + i % 7, comment='benchmark'), ops),
+        'processor.process_loan': micro(lambda i: processor.process_loan(participants[i % 3], participants[(i + 1) % 3], 100 * CENTS), ops),
+        'processor.set_profits': micro(lambda i: processor.set_profits(participants[i % 3], 1001 * CENTS + i), ops),
+        'processor.get_data': micro(lambda i: processor.get_data(), ops),
+        'processor.get_totals': micro(lambda i: processor.get_totals(), ops),
+        'format_amount': micro(lambda i: format_amount(i * 7919 - 5000000), ops * 10),
+        'chandler.dialog': micro(chandler_dialog, ops * 10),
+    }
+    processor.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the FinanceBot, printed as JSON.')
+    parser.add_argument('--chats', type=int, default=20, help='Number of chats sending updates.')
+    parser.add_argument('--iterations', type=int, default=10, help='Rounds of every scenario per chat.')
+    parser.add_argument('--workers', type=int, default=16, help='Concurrent updates (ChatOrderedDispatcher), 0 processes them one after another.')
+    parser.add_argument('--scenario', action='append', help='Scenario to run (repeatable), all by default.')
+    parser.add_argument('--groups', action='store_true', help='Send from group chats with MULTI_LEDGER enabled (one ledger per chat).')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='Seconds every Telegram API request takes.')
+    parser.add_argument('--micro-ops', type=int, default=2000, help='Calls per microbenchmark, 0 skips them.')
+    parser.add_argument('--output', help='File to write the JSON results to instead of stdout.')
+    args = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp(prefix='finance-bot-benchmark-')
+    for name, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(name, value)
+    os.environ['BASE_DIR'] = base_dir
+    os.environ['UPDATE_MODE'] = 'polling'
+    if args.groups:
+        os.environ['MULTI_LEDGER'] = 'true'
+    for directory in ('data', 'logs'):
+        os.makedirs(os.path.join(base_dir, directory), exist_ok=True)
+
+    from telegram.ext import Updater
+    from fake_bot import FakeBot
+    from synthetic_updates import SCENARIOS, UpdateFactory
+    from finance_bot import FinanceBot
+    from env import ALLOWED_USERS_FINANCE_BOT, FINANCE_BOT_PARTICIPANTS, FINANCE_STORAGE_BACKEND, FINANCE_CHANGE_DETECTION, MULTI_LEDGER
+
+    fake_bot = FakeBot(latency=args.api_latency)
+    bot = FinanceBot(updater=Updater(bot=fake_bot, use_context=True))
+    bot.audit_dispatcher.start()
+    factory = UpdateFactory(fake_bot, ALLOWED_USERS_FINANCE_BOT[0])
+    participants = FINANCE_BOT_PARTICIPANTS[:2]
+    chats = [-(1000 + i) if args.groups else 1000 + i for i in range(args.chats)]
+    if args.groups:
+        for chat_id in chats:
+            bot.dispatcher.process_update(factory.message(chat_id, '/participants ' + ' '.join(participants)))
+
+    scenarios = args.scenario or list(SCENARIOS)
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'config': {**vars(args), 'storage_backend': FINANCE_STORAGE_BACKEND, 'change_detection': FINANCE_CHANGE_DETECTION, 'multi_ledger': MULTI_LEDGER},
+        'scenarios': {},
+        'micro': {},
+    }
+    try:
+        for name in scenarios:
+            results['scenarios'][name] = run_scenario(bot, factory, SCENARIOS[name], chats, participants, args.iterations, args.workers)
+        if args.micro_ops > 0:
+            results['micro'] = run_micro(base_dir, args.micro_ops)
+    finally:
+        bot.audit_dispatcher.stop()
+        bot.log_export_executor.shutdown(wait=False)
+        bot.ledgers.close()
+        shutil.rmtree(base_dir, ignore_errors=True)
+    results['api_calls'] = dict(fake_bot.calls)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import itertools
+import time
+
+from typing import Callable, Dict, List
+from telegram import Bot, Update
+
+# Import env variables
+from env import PROFITS_TEXT, LEND_MONEY_TEXT, BALANCE_CHANGE_TEXT
+
+
+class UpdateFactory:
+    """Builds Telegram updates as they would be received from the Bot API."""
+    def __init__(self, bot: Bot, username: str, user_id: int = 1000):
+        """
+        Args:
+            bot (Bot): Bot the updates are bound to.
+            username (str): Username of the sender of every update.
+            user_id (int): Telegram ID of the sender.
+        """
+        self.bot = bot
+        self.user = {'id': user_id, 'is_bot': False, 'first_name': username, 'username': username}
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def chat(chat_id: int) -> Dict:
+        if chat_id < 0:
+            return {'id': chat_id, 'type': 'group', 'title': f'Group {-chat_id}'}
+        return {'id': chat_id, 'type': 'private'}
+
+    def message(self, chat_id: int, text: str) -> Update:
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()), 'chat': self.chat(chat_id), 'from': self.user, 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return Update.de_json({'update_id': next(self._update_ids), 'message': message}, self.bot)
+
+    def callback(self, chat_id: int, data: str) -> Update:
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()), 'chat': self.chat(chat_id), 'text': ''}
+        query = {'id': str(next(self._message_ids)), 'from': self.user, 'chat_instance': str(chat_id), 'message': message, 'data': data}
+        return Update.de_json({'update_id': next(self._update_ids), 'callback_query': query}, self.bot)
+
+
+# A scenario returns the updates of one round of a dialog in a chat
+Scenario = Callable[[UpdateFactory, int, List[str]], List[Update]]
+
+
+def profits(factory: UpdateFactory, chat_id: int, participants: List[str]) -> List[Update]:
+    return [factory.message(chat_id, PROFITS_TEXT)]
+
+
+def loan_dialog(factory: UpdateFactory, chat_id: int, participants: List[str]) -> List[Update]:
+    lender, borrower = participants[:2]
+    return [
+        factory.message(chat_id, LEND_MONEY_TEXT),
+        factory.callback(chat_id, f'loan|{lender}'),
+        factory.callback(chat_id, f'borrower|{lender}|{borrower}'),
+        factory.message(chat_id, '120'),
+    ]
+
+
+def balance_change_dialog(factory: UpdateFactory, chat_id: int, participants: List[str]) -> List[Update]:
+    return [
+        factory.message(chat_id, BALANCE_CHANGE_TEXT),
+        factory.message(chat_id, '-250'),
+        factory.message(chat_id, 'Groceries'),
+    ]
+
+
+def set_commands(factory: UpdateFactory, chat_id: int, participants: List[str]) -> List[Update]:
+    return [
+        factory.message(chat_id, f'/set_profits {participants[0]} 10000'),
+        factory.message(chat_id, f'/set_spent {participants[1]} 2500'),
+    ]
+
+
+def mixed(factory: UpdateFactory, chat_id: int, participants: List[str]) -> List[Update]:
+    return (profits(factory, chat_id, participants) + loan_dialog(factory, chat_id, participants)
+            + profits(factory, chat_id, participants) + balance_change_dialog(factory, chat_id, participants)
+            + set_commands(factory, chat_id, participants))
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    'profits': profits,
+    'loan_dialog': loan_dialog,
+    'balance_change_dialog': balance_change_dialog,
+    'set_commands': set_commands,
+    'mixed': mixed,
+}
@@ -0,0 +1,123 @@
+import asyncio
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger
+from typing import Callable, Dict, Hashable, Optional
+from telegram import Update
+from telegram.ext import Dispatcher
+from shared.checkpoint import UpdateCheckpoint
+
+
+class ChatOrderedDispatcher:
+    """
+    Processes the updates of a Dispatcher on an asyncio event loop with per-chat ordering.
+
+    Every chat gets its own lightweight queue and task on the loop: updates of different
+    chats are processed concurrently, while the updates of one chat are processed
+    strictly one after another, which the conversation steps stored in CHandler rely on.
+    A chat's task ends as soon as its queue is empty, so idle chats cost nothing.
+
+    The handlers are blocking python-telegram-bot 13 callbacks, so each of them is
+    explicitly offloaded to a bounded thread pool; at most `max_concurrency` updates
+    run at the same time. Submitting blocks once `max_pending` updates are waiting,
+    which propagates backpressure to the polling thread or the webhook server.
+
+    With a `checkpoint`, updates are registered with it when submitted (updates it tells
+    to skip are dropped) and reported to it once processed.
+    """
+    def __init__(self, dispatcher: Dispatcher, logger: Logger, max_concurrency: int = 16, max_pending: int = 1000,
+                 checkpoint: Optional[UpdateCheckpoint] = None):
+        """
+        Args:
+            dispatcher (Dispatcher): The dispatcher whose handlers process the updates.
+            logger (Logger): Logger of the bot.
+            max_concurrency (int): Maximum number of updates processed at the same time.
+            max_pending (int): Maximum number of submitted updates that haven't been processed yet.
+            checkpoint (Optional[UpdateCheckpoint]): Checkpoint of the processed updates.
+        """
+        self.dispatcher = dispatcher
+        self.logger = logger
+        self.checkpoint = checkpoint
+        self._process_update: Callable = dispatcher.process_update
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='update-worker')
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._chats: Dict[Hashable, asyncio.Queue] = {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='chat-dispatcher', daemon=True)
+
+    def install(self):
+        """Starts the event loop and routes the dispatcher's updates through it."""
+        self._thread.start()
+        # Dispatcher.start() (polling) and the webhook workers call process_update() for every update.
+        # object.__setattr__ skips PTB's warning about custom attributes on its objects.
+        object.__setattr__(self.dispatcher, 'process_update', self.submit)
+
+    def stop(self, timeout: float = 10.0):
+        """
+        Processes the updates already submitted and stops the event loop.
+
+        Args:
+            timeout (float): Seconds to wait for the submitted updates.
+        """
+        object.__setattr__(self.dispatcher, 'process_update', self._process_update)
+        future = asyncio.run_coroutine_threadsafe(self._drain(), self._loop)
+        try:
+            future.result(timeout)
+        except Exception as e:
+            self.logger.warning(f'chat_dispatcher.py:stop(). Not all updates were processed before stopping: {e}')
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        self._executor.shutdown(wait=False)
+
+    @property
+    def active_chats(self) -> int:
+        return len(self._chats)
+
+    def submit(self, update: object):
+        """
+        Schedules an update for processing. Thread-safe.
+
+        Args:
+            update (object): An Update, or an error object put in the update queue by the Updater.
+        """
+        if not isinstance(update, Update):
+            return self._process_update(update)
+        if self.checkpoint is not None and not self.checkpoint.received(update.update_id):
+            return
+        self._pending.acquire()
+        self._loop.call_soon_threadsafe(self._enqueue, update)
+
+    @staticmethod
+    def _chat_key(update: Update) -> Hashable:
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return 'user', update.effective_user.id
+        # Updates without a chat (e.g. polls) don't need ordering
+        return 'update', update.update_id
+
+    def _enqueue(self, update: Update):
+        key = self._chat_key(update)
+        chat_queue = self._chats.get(key)
+        if chat_queue is None:
+            chat_queue = self._chats[key] = asyncio.Queue()
+            self._loop.create_task(self._run_chat(key, chat_queue))
+        chat_queue.put_nowait(update)
+
+    async def _run_chat(self, key: Hashable, chat_queue: asyncio.Queue):
+        while not chat_queue.empty():
+            update = chat_queue.get_nowait()
+            try:
+                await self._loop.run_in_executor(self._executor, self._process_update, update)
+            except Exception as e:
+                self.logger.error(f'chat_dispatcher.py:_run_chat(). Exception processing update {update.update_id}: {e}')
+            finally:
+                if self.checkpoint is not None:
+                    self.checkpoint.processed(update.update_id)
+                self._pending.release()
+        del self._chats[key]
+
+    async def _drain(self):
+        while self._chats:
+            await asyncio.sleep(0.05)
@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+
+from logging import Logger
+from typing import Callable, Optional, Set
+from telegram import Update
+from telegram.ext import Dispatcher
+from shared import metrics
+from shared.fileio import atomic_write_json
+
+
+SKIPPED_UPDATES = metrics.counter('checkpoint_skipped_updates_total', 'Updates skipped because they were processed before the last checkpoint.')
+
+
+class UpdateCheckpoint:
+    """
+    Persisted ID of the last update that has been processed, so a restarted bot resumes after it.
+
+    Updates are registered with received() when they arrive and reported with
+    processed() once their handlers have run. They may finish out of order (see
+    ChatOrderedDispatcher), so the checkpoint is the update before the lowest ID that is
+    still being processed. It is written at most every `interval` seconds and on close().
+
+    On restart, polling resumes with the update after the checkpoint (which also confirms
+    the older ones to Telegram). With `skip_processed`, updates up to the checkpoint
+    loaded at startup that are delivered again are skipped. That relies on updates
+    arriving in ascending order, as getUpdates returns them; webhooks are delivered
+    concurrently and a lower ID may arrive after a higher one, so in webhook mode only
+    updates that are in flight are skipped. Updates processed again (after a crash, or
+    redelivered webhooks) are rejected by the ledgers (see FinanceProcessor.applying()).
+    """
+    def __init__(self, path: str, logger: Logger, interval: float = 1.0, skip_processed: bool = True):
+        """
+        Args:
+            path (str): JSON file holding the checkpoint.
+            logger (Logger): Logger of the bot.
+            interval (float): Minimum seconds between two writes of the checkpoint.
+            skip_processed (bool): Skip updates up to the checkpoint loaded at startup, only safe with polling.
+        """
+        self.path = path
+        self.logger = logger
+        self.interval = interval
+        self._lock = threading.Lock()
+        # Updates received and not processed yet
+        self._in_flight: Set[int] = set()
+        self._last_processed = self._load()
+        self._skip_until = self._last_processed if skip_processed else None
+        self._written = self._last_processed
+        self._written_at = 0.0
+
+    @property
+    def last_processed(self) -> Optional[int]:
+        """ID of the newest update that has been processed along with every update received before it."""
+        return self._last_processed
+
+    def install(self, dispatcher: Dispatcher):
+        """
+        Checkpoint the updates of a dispatcher that processes them one by one.
+
+        With a ChatOrderedDispatcher, pass the checkpoint to it instead.
+
+        Args:
+            dispatcher (Dispatcher): The dispatcher.
+        """
+        process_update: Callable = dispatcher.process_update
+
+        def checkpointed_process_update(update: object):
+            if not isinstance(update, Update):
+                return process_update(update)
+            if not self.received(update.update_id):
+                return
+            try:
+                return process_update(update)
+            finally:
+                self.processed(update.update_id)
+
+        # object.__setattr__ skips PTB's warning about custom attributes on its objects
+        object.__setattr__(dispatcher, 'process_update', checkpointed_process_update)
+
+    def received(self, update_id: int) -> bool:
+        """
+        Register an update that is about to be processed.
+
+        Args:
+            update_id (int): ID of the update.
+
+        Returns:
+            bool: False if the update is being processed or was processed before the restart and must be skipped.
+        """
+        with self._lock:
+            if (self._skip_until is not None and update_id <= self._skip_until) or update_id in self._in_flight:
+                SKIPPED_UPDATES.inc()
+                return False
+            self._in_flight.add(update_id)
+            return True
+
+    def processed(self, update_id: int):
+        """
+        Report that the handlers of an update have run, successfully or not.
+
+        Args:
+            update_id (int): ID of the update.
+        """
+        with self._lock:
+            self._in_flight.discard(update_id)
+            if self._in_flight:
+                # At most the concurrency limit of updates are in flight
+                oldest = min(self._in_flight)
+                if self._last_processed is None or oldest - 1 > self._last_processed:
+                    self._last_processed = oldest - 1
+            elif self._last_processed is None or update_id > self._last_processed:
+                self._last_processed = update_id
+            if time.monotonic() - self._written_at >= self.interval:
+                self._write()
+
+    def close(self):
+        """Write the checkpoint if it has changed since the last write."""
+        with self._lock:
+            self._write()
+
+    def _load(self) -> Optional[int]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)['update_id']
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.error(f'checkpoint.py:_load(). Ignoring the unreadable checkpoint {self.path}. Exception: {e}')
+            return None
+
+    def _write(self):
+        if self._last_processed == self._written:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            atomic_write_json(self.path, {'update_id': self._last_processed})
+            self._written = self._last_processed
+        except OSError as e:
+            self.logger.error(f'checkpoint.py:_write(). Failed to write the checkpoint {self.path}. Exception: {e}')
+        self._written_at = time.monotonic()
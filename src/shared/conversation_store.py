@@ -0,0 +1,175 @@
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+
+EVICTED_EXPIRED = 'expired'
+EVICTED_CAPACITY = 'capacity'
+
+
+class _Conversation:
+    __slots__ = ('callback', 'data', 'touched_at')
+
+    def __init__(self):
+        self.callback: Optional[Callable] = None
+        self.data: Dict[str, Any] = {}
+        self.touched_at = 0.0
+
+
+class _Shard:
+    __slots__ = ('lock', 'entries')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: 'OrderedDict[Hashable, _Conversation]' = OrderedDict()
+
+
+class ConversationStore:
+    """
+    Thread-safe store of per-chat conversation state (pending callback and dialog data).
+
+    Chats are spread over shards by hash, each with its own lock, so chats in different
+    shards never contend. Within a shard, conversations are kept in least recently used
+    order: every access moves the chat to the end, so expired conversations are always
+    at the front and both TTL expiry and LRU eviction are O(1) per entry. The capacity
+    is split evenly between the shards and enforced per shard.
+
+    `on_evict(chat_id, callback, reason)` is called, outside of any lock, for every
+    conversation removed because it was idle for longer than `ttl` seconds
+    (reason 'expired') or because the shard was full (reason 'capacity'). It runs on the
+    thread that evicted the conversation, another chat's request or the sweeper, so it
+    must return quickly and hand slow work (e.g. messaging the user) to another thread.
+    """
+    def __init__(self, ttl: float = 900, max_entries: int = 10000, shards: int = 16,
+                 on_evict: Optional[Callable[[Hashable, Optional[Callable], str], None]] = None, sweep_interval: Optional[float] = None):
+        """
+        Args:
+            ttl (float): Seconds of inactivity after which a conversation expires, 0 disables expiry.
+            max_entries (int): Maximum number of live conversations.
+            shards (int): Number of independently locked shards.
+            on_evict (Optional[Callable]): Called with (chat_id, pending callback, reason) for evicted conversations.
+            sweep_interval (Optional[float]): Seconds between background expiry sweeps, defaults to ttl / 4.
+        """
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._shards = [_Shard() for _ in range(max(1, min(shards, max_entries)))]
+        self._shard_capacity = max(1, -(-max_entries // len(self._shards)))
+        self._counters_lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+        if ttl > 0:
+            interval = sweep_interval or max(1.0, ttl / 4)
+            threading.Thread(target=self._sweep_forever, args=(interval,), name='conversation-sweeper', daemon=True).start()
+
+    def __len__(self) -> int:
+        return sum(len(shard.entries) for shard in self._shards)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            Dict[str, int]: Number of live conversations and of conversations evicted so far.
+        """
+        return {'live': len(self), 'evictions': self.evictions, 'expirations': self.expirations}
+
+    def set_callback(self, chat_id: Hashable, callback: Callable):
+        self._update(chat_id, lambda conversation: setattr(conversation, 'callback', callback), create=True)
+
+    def has_callback(self, chat_id: Hashable) -> bool:
+        return self._update(chat_id, lambda conversation: conversation.callback is not None) or False
+
+    def pop_callback(self, chat_id: Hashable) -> Optional[Callable]:
+        def pop(conversation: _Conversation):
+            callback, conversation.callback = conversation.callback, None
+            return callback
+        return self._update(chat_id, pop)
+
+    def remove_callback(self, chat_id: Hashable):
+        self.pop_callback(chat_id)
+
+    def store_data(self, chat_id: Hashable, data_name: str, data: Any):
+        self._update(chat_id, lambda conversation: conversation.data.__setitem__(data_name, data), create=True)
+
+    def get_data(self, chat_id: Hashable, data_name: str) -> Any:
+        return self._update(chat_id, lambda conversation: conversation.data.get(data_name))
+
+    def pop_data(self, chat_id: Hashable, data_name: str) -> Any:
+        return self._update(chat_id, lambda conversation: conversation.data.pop(data_name, None))
+
+    def clear(self, chat_id: Hashable):
+        shard = self._shard(chat_id)
+        with shard.lock:
+            shard.entries.pop(chat_id, None)
+
+    def sweep(self):
+        """Removes every expired conversation."""
+        for shard in self._shards:
+            with shard.lock:
+                evicted = self._expire(shard, time.monotonic(), limit=None)
+            self._notify(evicted)
+
+    def _shard(self, chat_id: Hashable) -> _Shard:
+        return self._shards[hash(chat_id) % len(self._shards)]
+
+    def _update(self, chat_id: Hashable, action: Callable[[_Conversation], Any], create: bool = False) -> Any:
+        shard = self._shard(chat_id)
+        now = time.monotonic()
+        with shard.lock:
+            evicted = self._expire(shard, now, limit=2)
+            conversation = shard.entries.get(chat_id)
+            if conversation is None:
+                if not create:
+                    result = None
+                    conversation = None
+                else:
+                    conversation = shard.entries[chat_id] = _Conversation()
+                    if len(shard.entries) > self._shard_capacity:
+                        evicted.append(self._evict_oldest(shard))
+            if conversation is not None:
+                conversation.touched_at = now
+                shard.entries.move_to_end(chat_id)
+                result = action(conversation)
+                if conversation.callback is None and not conversation.data:
+                    del shard.entries[chat_id]
+        self._notify(evicted)
+        return result
+
+    def _expire(self, shard: _Shard, now: float, limit: Optional[int]) -> List[Tuple[Hashable, Optional[Callable], str]]:
+        evicted = []
+        if self.ttl <= 0:
+            return evicted
+        while shard.entries and (limit is None or len(evicted) < limit):
+            chat_id, conversation = next(iter(shard.entries.items()))
+            if now - conversation.touched_at < self.ttl:
+                break
+            del shard.entries[chat_id]
+            evicted.append((chat_id, conversation.callback, EVICTED_EXPIRED))
+        return evicted
+
+    def _evict_oldest(self, shard: _Shard) -> Tuple[Hashable, Optional[Callable], str]:
+        chat_id, conversation = shard.entries.popitem(last=False)
+        return chat_id, conversation.callback, EVICTED_CAPACITY
+
+    def _notify(self, evicted: List[Tuple[Hashable, Optional[Callable], str]]):
+        if not evicted:
+            return
+        with self._counters_lock:
+            for _, _, reason in evicted:
+                if reason == EVICTED_EXPIRED:
+                    self.expirations += 1
+                else:
+                    self.evictions += 1
+        if self.on_evict is None:
+            return
+        for chat_id, callback, reason in evicted:
+            try:
+                self.on_evict(chat_id, callback, reason)
+            except Exception:
+                pass
+
+    def _sweep_forever(self, interval: float):
+        while True:
+            time.sleep(interval)
+            self.sweep()
@@ -0,0 +1,172 @@
+import ctypes
+import os
+import select
+import struct
+import sys
+import threading
+
+from typing import Iterable, Optional, Tuple
+
+
+# (device, inode, size, modification time in ns) of a file or None if the file does not exist
+FileSignature = Optional[Tuple[int, int, int, int]]
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def directory_signature(path: str) -> Tuple:
+    """
+    Returns the signatures of every file in a directory.
+
+    Args:
+        path (str): Path to the directory.
+
+    Returns:
+        Tuple: Sorted (name, FileSignature) pairs, empty if the directory does not exist.
+    """
+    try:
+        names = sorted(os.listdir(path))
+    except FileNotFoundError:
+        return ()
+    return tuple((name, file_signature(os.path.join(path, name))) for name in names)
+
+
+def file_signature(path: str) -> FileSignature:
+    """
+    Returns a cheap signature of a file that changes whenever the file is replaced or written.
+
+    Args:
+        path (str): Path to the file.
+
+    Returns:
+        FileSignature: The signature or None if the file does not exist.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class ChangeWatcher:
+    """
+    Tells whether any file of a set may have changed since the last call to mark_seen().
+
+    A watched path that is a directory reports any change of the files inside it.
+
+    On Linux an inotify watch on the files' directories is used when available: a
+    background thread sets a flag on every relevant event, so changed() is a plain
+    attribute read. Everywhere else (or if inotify can't be set up) changed() compares
+    stat() signatures of the files.
+    """
+    def __init__(self, paths: Iterable[str], use_inotify: bool = True):
+        """
+        Args:
+            paths (Iterable[str]): Files or directories to watch.
+            use_inotify (bool): Try to use inotify instead of polling stat().
+        """
+        self.paths = [os.path.abspath(path) for path in paths]
+        self._directories = {path for path in self.paths if os.path.isdir(path)}
+        self._signatures = [None] * len(self.paths)
+        self._dirty = True
+        self._fd: Optional[int] = None
+        self._wake_fds: Optional[Tuple[int, int]] = None
+        if use_inotify and sys.platform.startswith('linux'):
+            self._start_inotify()
+
+    @property
+    def uses_inotify(self) -> bool:
+        return self._fd is not None
+
+    def changed(self) -> bool:
+        """
+        Returns:
+            bool: False if none of the files has changed since the last mark_seen(), True otherwise.
+        """
+        if self._fd is not None:
+            return self._dirty
+        return self._dirty or any(self._signature(path) != signature for path, signature in zip(self.paths, self._signatures))
+
+    def mark_seen(self):
+        """
+        Records the current state of the files as seen.
+
+        Must be called before the files are read, so that a change made while they are
+        being read is reported by the next changed() call.
+        """
+        self._dirty = False
+        if self._fd is None:
+            self._signatures = [self._signature(path) for path in self.paths]
+
+    def close(self):
+        """Stops watching. changed() compares stat() signatures from now on."""
+        if self._wake_fds is not None:
+            # Wakes the event thread up, which closes the inotify descriptor
+            os.write(self._wake_fds[1], b'\0')
+
+    def _signature(self, path: str):
+        return directory_signature(path) if path in self._directories else file_signature(path)
+
+    def _start_inotify(self):
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(IN_CLOEXEC)
+            if fd < 0:
+                return
+            names = {}
+            for path in self.paths:
+                if path in self._directories:
+                    names[path] = None
+                    continue
+                directory, name = os.path.split(path)
+                if names.get(directory, ()) is not None:
+                    names.setdefault(directory, set()).add(name)
+            self._names = {}
+            for directory, directory_names in names.items():
+                wd = libc.inotify_add_watch(fd, directory.encode(), WATCH_MASK)
+                if wd < 0:
+                    os.close(fd)
+                    return
+                self._names[wd] = directory_names
+        except (OSError, AttributeError):
+            return
+
+        self._fd = fd
+        self._wake_fds = os.pipe()
+        threading.Thread(target=self._read_events, name='file-watch', daemon=True).start()
+
+    def _read_events(self):
+        while True:
+            try:
+                readable, _, _ = select.select([self._fd, self._wake_fds[0]], [], [])
+                if self._wake_fds[0] in readable:
+                    fd, self._fd, self._dirty = self._fd, None, True
+                    for descriptor in (fd, *self._wake_fds):
+                        os.close(descriptor)
+                    return
+                buffer = os.read(self._fd, 64 * 1024)
+            except OSError:
+                # Fall back to stat() signatures if the watch breaks
+                self._fd = None
+                self._dirty = True
+                return
+
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+                name = buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0').decode(errors='replace')
+                offset += EVENT_HEADER.size + length
+                names = self._names.get(wd, ())
+                if mask & IN_Q_OVERFLOW or names is None or name in names:
+                    self._dirty = True
@@ -0,0 +1,62 @@
+import json
+import os
+import tempfile
+
+from typing import Any
+
+
+def fsync_dir(dir_path: str):
+    """
+    Flushes a directory entry to disk so that a preceding rename survives a crash.
+
+    Args:
+        dir_path (str): The directory whose entries should be persisted.
+    """
+    try:
+        fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write_bytes(path: str, payload: bytes):
+    """
+    Atomically replaces a file with the given content.
+
+    The content is written to a temporary file in the same directory, flushed to disk
+    and then renamed over the destination, so readers either see the old or the new
+    file, never a partially written one.
+
+    Args:
+        path (str): The destination file path.
+        payload (bytes): The new content of the file.
+    """
+    dir_path = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=dir_path)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    fsync_dir(dir_path)
+
+
+def atomic_write_json(path: str, data: Any):
+    """
+    Atomically replaces a file with the JSON representation of the data.
+
+    Args:
+        path (str): The destination file path.
+        data (Any): JSON serializable data.
+    """
+    atomic_write_bytes(path, json.dumps(data).encode('utf-8'))
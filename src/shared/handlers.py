@@ -1,66 +1,50 @@
-from threading import Lock
+from typing import Callable, Hashable, Optional
+from shared import metrics
+from shared.conversation_store import ConversationStore
 
 
 class CHandler:
-    def __init__(self):
-        self.cancelled_handlers = {}
-        self.data_storage = {}
-        self.active_callbacks = {}
-        self.photo_lock = Lock()
+    """
+    Keeps the pending dialog step (callback) and dialog data of every chat.
+
+    The state lives in a ConversationStore: it is thread-safe, conversations idle for
+    longer than `ttl` seconds expire and at most `max_entries` conversations are kept.
+    `on_expire(chat_id, reason)` is called when a chat's pending dialog step is dropped.
+
+    The number of live conversations and of dropped ones are exported as metrics.
+    """
+    def __init__(self, ttl: float = 900, max_entries: int = 10000, on_expire: Optional[Callable[[Hashable, str], None]] = None):
+        self.on_expire = on_expire
+        self.store = ConversationStore(ttl=ttl, max_entries=max_entries, on_evict=self._on_evict)
+        metrics.gauge('conversations_live', 'Conversations with a pending dialog step or dialog data.').set_function(lambda: len(self.store))
+        metrics.counter('conversations_expired_total', 'Conversations dropped after being idle for too long.').set_function(lambda: self.store.expirations)
+        metrics.counter('conversations_evicted_total', 'Conversations dropped because the store was full.').set_function(lambda: self.store.evictions)
+
+    def _on_evict(self, chat_id, callback, reason):
+        if callback is not None and self.on_expire is not None:
+            self.on_expire(chat_id, reason)
 
     def store_data(self, chat_id, data_name, data):
-        try:
-            if not chat_id in self.data_storage:
-                self.data_storage[chat_id] = {}
-            self.data_storage[chat_id][data_name] = data
-        except Exception: pass
+        self.store.store_data(chat_id, data_name, data)
 
     def pop_data(self, chat_id, data_name):
-        try:
-            if not chat_id in self.data_storage.keys():
-                return None
-            if not data_name in self.data_storage[chat_id].keys():
-                return None
-            data = self.data_storage[chat_id][data_name]
-            del self.data_storage[chat_id][data_name]
-            return data
-        except Exception:
-            return None
+        return self.store.pop_data(chat_id, data_name)
 
     def safe_pop_data(self, chat_id, data_name):
-        try:
-            if not chat_id in self.data_storage.keys():
-                return None
-            if not data_name in self.data_storage[chat_id].keys():
-                return None
-            return self.data_storage[chat_id][data_name]
-        except Exception: pass
+        return self.store.get_data(chat_id, data_name)
 
     def add_callback(self, chat_id, callback):
-        try:
-            self.active_callbacks[chat_id] = callback
-        except Exception: pass
+        self.store.set_callback(chat_id, callback)
 
     def has_callback(self, chat_id):
-        try:
-            if not type(chat_id) == int: return
-            return chat_id in self.active_callbacks.keys()
-        except Exception: pass
+        if not type(chat_id) == int: return
+        return self.store.has_callback(chat_id)
 
     def get_callback(self, chat_id):
-        try:
-            with self.photo_lock:
-                if not chat_id in self.active_callbacks.keys():
-                    return lambda _: None
-
-                c = self.active_callbacks[chat_id]
-                del self.active_callbacks[chat_id]
-                return c
-        except Exception: pass
+        callback = self.store.pop_callback(chat_id)
+        if callback is None:
+            return lambda *_: None
+        return callback
 
     def remove_callback(self, chat_id):
-        try:
-            self.active_callbacks[chat_id] = None
-            del self.active_callbacks[chat_id]
-        except Exception: pass
-
+        self.store.remove_callback(chat_id)
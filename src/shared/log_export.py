@@ -0,0 +1,149 @@
+import gzip
+import os
+import re
+
+from datetime import date
+from typing import BinaryIO, Callable, Iterator, List, Optional, Tuple
+
+
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+
+# Records start with the asctime of the logging formatter: "YYYY-MM-DD HH:MM:SS,mmm - name - LEVEL - message"
+RECORD_PATTERN = re.compile(rb'^(\d{4}-\d{2}-\d{2}) \d{2}:\d{2}:\d{2},\d{3} - .*? - ([A-Z]+) - ')
+
+# Room left in a part for data still buffered by the compressor
+PART_SIZE_MARGIN = 1024 * 1024
+
+
+def log_files(log_file_path: str) -> List[str]:
+    """
+    Returns a log file and its rotated backups, oldest first.
+
+    Backups are named file.log.N.gz (compressed), file.log.N.pending (being compressed)
+    or file.log.N (plain, e.g. rotated by an older version of the logger).
+
+    Args:
+        log_file_path (str): Path to the current log file.
+
+    Returns:
+        List[str]: Existing files, from the highest backup number to the current file.
+    """
+    directory, name = os.path.split(os.path.abspath(log_file_path))
+    pattern = re.compile(re.escape(name) + r'\.(\d+)(\.gz|\.pending)?$')
+    backups = []
+    for entry in os.listdir(directory) if os.path.isdir(directory) else []:
+        match = pattern.match(entry)
+        if match:
+            backups.append((int(match.group(1)), os.path.join(directory, entry)))
+    files = [path for _, path in sorted(backups, reverse=True)]
+    if os.path.exists(log_file_path):
+        files.append(log_file_path)
+    return files
+
+
+class LogExport:
+    """
+    Streams log records from a log file and its backups into gzip compressed parts.
+
+    Records are filtered by day and minimum level while reading. Lines that don't start
+    with a timestamp (multi-line messages, tracebacks) belong to the preceding record.
+    Neither the input nor the output is ever held in memory as a whole: lines are read,
+    filtered and compressed one at a time, and a new part is started whenever the
+    current one approaches `part_size` bytes. Every part is a complete gzip file.
+    """
+    def __init__(self, log_file_path: str, start: Optional[date] = None, end: Optional[date] = None, min_level: str = 'DEBUG',
+                 part_size: int = 45 * 1024 * 1024):
+        """
+        Args:
+            log_file_path (str): Path to the current log file.
+            start (Optional[date]): First day to export, None for no lower bound.
+            end (Optional[date]): Last day to export (inclusive), None for no upper bound.
+            min_level (str): Lowest level exported.
+            part_size (int): Maximum size of a part in bytes.
+        """
+        self.log_file_path = log_file_path
+        self._start = start.isoformat().encode() if start else None
+        self._end = end.isoformat().encode() if end else None
+        self._min_level = LEVELS.index(min_level.upper())
+        self.part_size = max(part_size, 2 * PART_SIZE_MARGIN)
+        self.records = 0
+
+    def write_parts(self, out_dir: str, progress: Optional[Callable[[float], None]] = None) -> List[str]:
+        """
+        Exports the matching records.
+
+        Args:
+            out_dir (str): Directory the parts are written to.
+            progress (Optional[Callable[[float], None]]): Called with the fraction of input read so far.
+
+        Returns:
+            List[str]: Paths of the written parts, empty if no record matched.
+        """
+        name = os.path.basename(self.log_file_path)
+        parts: List[str] = []
+        raw: Optional[BinaryIO] = None
+        out: Optional[gzip.GzipFile] = None
+        try:
+            for line in self._lines(progress):
+                if out is not None and raw.tell() >= self.part_size - PART_SIZE_MARGIN:
+                    out.close()
+                    raw.close()
+                    out = None
+                if out is None:
+                    parts.append(os.path.join(out_dir, f'{name}.part{len(parts) + 1}.gz'))
+                    raw = open(parts[-1], 'wb')
+                    out = gzip.GzipFile(filename=name, mode='wb', fileobj=raw)
+                out.write(line)
+        finally:
+            if out is not None:
+                out.close()
+                raw.close()
+        return parts
+
+    def _lines(self, progress: Optional[Callable[[float], None]]) -> Iterator[bytes]:
+        files = self._files()
+        total = sum(size for _, size in files) or 1
+        done = 0
+        lines = 0
+        for path, size in files:
+            with open(path, 'rb') as raw:
+                f = gzip.GzipFile(fileobj=raw) if path.endswith('.gz') else raw
+                keep = False
+                for line in f:
+                    match = RECORD_PATTERN.match(line)
+                    if match:
+                        day, level = match.groups()
+                        if self._end is not None and day > self._end:
+                            # Files and records are in chronological order
+                            return
+                        keep = (self._start is None or day >= self._start) and self._level(level) >= self._min_level
+                        if keep:
+                            self.records += 1
+                    if keep:
+                        yield line
+                    lines += 1
+                    if progress is not None and lines % 4096 == 0:
+                        progress((done + raw.tell()) / total)
+            done += size
+            if progress is not None:
+                progress(done / total)
+
+    def _files(self) -> List[Tuple[str, int]]:
+        files = []
+        for path in log_files(self.log_file_path):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            # A file last written before the first exported day can't contain matching records
+            if self._start is not None and date.fromtimestamp(st.st_mtime).isoformat().encode() < self._start:
+                continue
+            files.append((path, st.st_size))
+        return files
+
+    @staticmethod
+    def _level(level: bytes) -> int:
+        try:
+            return LEVELS.index(level.decode())
+        except ValueError:
+            return len(LEVELS)
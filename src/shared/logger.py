@@ -1,15 +1,139 @@
+import atexit
+import gzip
 import logging
+import os
+import queue
+import shutil
+import threading
 
 from logging import Logger, handlers
+from typing import Dict, List, Optional
 
 
-def get_logger(logger_name: str, log_file_path: str, max_file_size=10000, backupCount=5) -> Logger:
+# Queue shared by every non-blocking logger and the single listener thread draining it
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_listener: Optional[handlers.QueueListener] = None
+_routes: Dict[str, List[logging.Handler]] = {}
+_listener_lock = threading.Lock()
+
+
+class _DeferredQueueHandler(handlers.QueueHandler):
+    """Queue handler that leaves formatting to the listener thread."""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge the arguments now, as they may be mutated by the caller afterwards
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+class _RoutingHandler(logging.Handler):
+    """Passes records taken from the shared queue to the handlers of the logger that created them."""
+    def handle(self, record: logging.LogRecord):
+        for handler in _routes.get(record.name, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+class GzipRotatingFileHandler(handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler that compresses rotated backups (file.log.1.gz, file.log.2.gz, ...).
+
+    Compression runs in a background thread. A rollover waits for the compression of
+    the previous backup to finish, so backups are never shifted while being written.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self._rotate
+        self._compression: Optional[threading.Thread] = None
+
+    def doRollover(self):
+        if self._compression is not None:
+            self._compression.join()
+        super().doRollover()
+
+    def _rotate(self, source: str, dest: str):
+        pending = dest[:-len('.gz')] + '.pending'
+        os.replace(source, pending)
+        self._compression = threading.Thread(target=self._compress, args=(pending, dest), name='log-compress', daemon=True)
+        self._compression.start()
+
+    @staticmethod
+    def _compress(source: str, dest: str):
+        try:
+            with open(source, 'rb') as f_in, gzip.open(dest + '.tmp', 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.replace(dest + '.tmp', dest)
+            os.remove(source)
+        except OSError:
+            # Keep the uncompressed backup rather than losing it
+            pass
+
+    def close(self):
+        if self._compression is not None:
+            self._compression.join()
+        super().close()
+
+
+def _start_listener():
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            _listener = handlers.QueueListener(_log_queue, _RoutingHandler())
+            _listener.start()
+            atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """
+    Writes out every queued log record and stops the listener thread.
+
+    It is registered with atexit, so it runs on a normal interpreter exit, including
+    the one after Updater.idle() has handled the SIGTERM sent by `docker stop`.
+    """
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        _listener = None
+        for route in _routes.values():
+            for handler in route:
+                handler.flush()
+                handler.close()
+
+
+def get_logger(logger_name: str, log_file_path: str, max_file_size=10*1024*1024, backupCount=5, non_blocking: Optional[bool] = None) -> Logger:
+    """
+    Creates a logger writing to a rotating file and to the console.
+
+    In non-blocking mode (default, disable with ASYNC_LOGGING=false) the logger only puts
+    records on a queue. A single listener thread shared by all loggers formats and writes
+    them, performs rotation and gzips rotated backups in the background.
+
+    Args:
+        logger_name (str): Name of the logger.
+        log_file_path (str): Path to the log file.
+        max_file_size (int): Size in bytes at which the file is rotated.
+        backupCount (int): Number of rotated backups to keep.
+        non_blocking (Optional[bool]): Overrides the ASYNC_LOGGING env variable.
+
+    Returns:
+        Logger: The configured logger.
+    """
+    if non_blocking is None:
+        non_blocking = os.environ.get('ASYNC_LOGGING', 'true').lower() != 'false'
+
     # Set up a specific logger with our desired output level
     logger = logging.getLogger(logger_name)
     logger.setLevel(logging.DEBUG)
 
     # Add the log message handler to the logger for file
-    file_handler = handlers.RotatingFileHandler(log_file_path, maxBytes=max_file_size, backupCount=backupCount, encoding='utf-8')
+    if non_blocking:
+        file_handler = GzipRotatingFileHandler(log_file_path, maxBytes=max_file_size, backupCount=backupCount, encoding='utf-8')
+    else:
+        file_handler = handlers.RotatingFileHandler(log_file_path, maxBytes=max_file_size, backupCount=backupCount, encoding='utf-8')
 
     # Create a log message handler for console
     console_handler = logging.StreamHandler()
@@ -22,6 +146,11 @@ def get_logger(logger_name: str, log_file_path: str, max_file_size=10000, backup
     console_handler.setFormatter(formatter)
 
     # Add handlers to the logger
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    if non_blocking:
+        _routes[logger_name] = [file_handler, console_handler]
+        logger.addHandler(_DeferredQueueHandler(_log_queue))
+        _start_listener()
+    else:
+        logger.addHandler(file_handler)
+        logger.addHandler(console_handler)
     return logger
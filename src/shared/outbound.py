@@ -0,0 +1,360 @@
+import html
+import itertools
+import threading
+import time
+import telegram
+
+from collections import deque
+from contextlib import contextmanager
+from logging import Logger
+from typing import Any, Callable, Deque, Dict, Hashable, Iterator, List, Optional
+from telegram.utils.helpers import DefaultValue
+from shared import metrics
+
+
+# Send priorities, lower first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_AUDIT = 1
+PRIORITY_LOGS = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_AUDIT: 'audit', PRIORITY_LOGS: 'logs'}
+
+MAX_MESSAGE_LENGTH = 4096
+MERGE_SEPARATOR = '\n\n'
+
+QUEUE_WAIT = metrics.histogram('outbound_queue_wait_seconds', 'Time Bot API requests waited for the rate limits.', ('priority',))
+RETRY_AFTER = metrics.counter('outbound_retry_after_total', 'RetryAfter (flood control) errors returned by Telegram.')
+MERGED_MESSAGES = metrics.counter('outbound_merged_messages_total', 'Messages merged into the previous message to the same chat.')
+
+_local = threading.local()
+
+
+@contextmanager
+def send_priority(priority: int) -> Iterator[None]:
+    """
+    Context manager setting the priority of the Bot API requests made by the current thread.
+
+    Args:
+        priority (int): PRIORITY_INTERACTIVE (the default), PRIORITY_AUDIT or PRIORITY_LOGS.
+    """
+    previous = getattr(_local, 'priority', PRIORITY_INTERACTIVE)
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+class TokenBucket:
+    """Allows `burst` requests at once and `rate` requests per second on average, a rate of 0 allows every request."""
+    def __init__(self, rate: float, burst: float):
+        if rate < 0:
+            raise ValueError(f'Invalid rate {rate}, it must be positive or 0 for no limit')
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if self.rate == 0:
+            self.tokens = self.burst
+            return
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """
+        Returns:
+            float: Seconds until a request is allowed, 0 if it is allowed now.
+        """
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        if self.rate > 0:
+            self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Request:
+    __slots__ = ('endpoint', 'data', 'priority', 'sequence', 'queued_at', 'attempts', 'granted', 'done', 'leader', 'result', 'error')
+
+    def __init__(self, endpoint: str, data: Dict[str, Any], priority: int, sequence: int):
+        self.endpoint = endpoint
+        self.data = data
+        self.priority = priority
+        self.sequence = sequence
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+        self.granted = threading.Event()
+        self.done = threading.Event()
+        # The request this one was merged into
+        self.leader: Optional['_Request'] = None
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class _Chat:
+    __slots__ = ('bucket', 'requests', 'in_flight', 'paused_until')
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.requests: Deque[_Request] = deque()
+        self.in_flight = False
+        self.paused_until = 0.0
+
+
+class OutboundScheduler:
+    """
+    Central scheduler of the Bot API requests sent to chats.
+
+    install() routes every request of a bot that targets a chat (messages, documents,
+    edits, ...) through the scheduler; other requests (getUpdates, answerCallbackQuery,
+    ...) are sent directly. Callers still block until their own request is sent and get
+    its result, but the scheduler decides when:
+
+    - Token buckets limit the requests globally and per chat, with a lower rate for
+      groups and channels (negative chat IDs), as Telegram's flood control does.
+    - Waiting requests are granted by priority (see send_priority()): interactive
+      replies before audit messages before log uploads, oldest first. Requests to the
+      same chat keep their order and only one of them is in flight at a time.
+    - A RetryAfter error pauses the chat for the given time and the request is retried,
+      at most `max_retries` times.
+    - Plain text messages waiting for the same chat are merged into one message when
+      they have the same options and fit in one message; every caller gets the result
+      of the merged message.
+
+    Should the scheduler thread fail, it fails open: the waiting requests and the
+    following ones are sent without rate limits, as after stop().
+    """
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3, group_rate: float = 20 / 60,
+                 group_burst: float = 5, max_retries: int = 3, logger: Optional[Logger] = None):
+        """
+        Args:
+            global_rate (float): Requests per second over all chats (also the burst), 0 for no limit.
+            chat_rate (float): Requests per second to a private chat, 0 for no limit.
+            chat_burst (float): Requests to a private chat allowed at once.
+            group_rate (float): Requests per second to a group or channel, 0 for no limit.
+            group_burst (float): Requests to a group or channel allowed at once.
+            max_retries (int): Retries of a request after RetryAfter errors.
+            logger (Optional[Logger]): Logger of the bot, reports a failure of the scheduler thread.
+
+        Raises:
+            ValueError: If a rate is negative.
+        """
+        for name, rate in (('global_rate', global_rate), ('chat_rate', chat_rate), ('group_rate', group_rate)):
+            if rate < 0:
+                raise ValueError(f'Invalid {name} {rate}, it must be positive or 0 for no limit')
+        self.logger = logger
+        self.chat_rate, self.chat_burst = chat_rate, chat_burst
+        self.group_rate, self.group_burst = group_rate, group_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[Hashable, _Chat] = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='outbound-scheduler', daemon=True)
+        metrics.gauge('outbound_queued_requests', 'Bot API requests waiting for the rate limits.').set_function(self.queued)
+
+    def queued(self) -> int:
+        with self._condition:
+            return sum(len(chat.requests) for chat in self._chats.values())
+
+    def install(self, bot: telegram.Bot):
+        """
+        Starts the scheduler and routes the requests of a bot through it.
+
+        Args:
+            bot (telegram.Bot): The bot, its requests are routed in place.
+        """
+        post = bot._post
+
+        def scheduled_post(endpoint: str, data: Dict = None, *args, **kwargs):
+            chat_id = (data or {}).get('chat_id')
+            if chat_id is None or self._stopped:
+                return post(endpoint, data, *args, **kwargs)
+            return self.send(endpoint, data, lambda request_data: post(endpoint, request_data, *args, **kwargs))
+
+        self._thread.start()
+        # object.__setattr__ skips PTB's warning about custom attributes on its objects
+        object.__setattr__(bot, '_post', scheduled_post)
+
+    def stop(self):
+        """Stops rate limiting: waiting requests and new ones are sent right away."""
+        with self._condition:
+            self._stopped = True
+            for chat in self._chats.values():
+                while chat.requests:
+                    chat.requests.popleft().granted.set()
+            self._condition.notify_all()
+
+    def send(self, endpoint: str, data: Dict[str, Any], post: Callable[[Dict[str, Any]], Any]) -> Any:
+        """
+        Send a request to a chat once the rate limits allow it.
+
+        Args:
+            endpoint (str): Bot API method.
+            data (Dict[str, Any]): Parameters of the request, with the chat_id.
+            post (Callable[[Dict[str, Any]], Any]): Sends the request with the given parameters.
+
+        Returns:
+            Any: The result of the request (of the merged request if it was merged).
+        """
+        request = _Request(endpoint, data, getattr(_local, 'priority', PRIORITY_INTERACTIVE), next(self._sequence))
+        self._enqueue(request, data['chat_id'])
+        while True:
+            request.granted.wait()
+            if request.leader is not None:
+                request.leader.done.wait()
+                if request.leader.error is not None:
+                    raise request.leader.error
+                return request.leader.result
+
+            QUEUE_WAIT.observe(time.monotonic() - request.queued_at, priority=PRIORITY_NAMES.get(request.priority, str(request.priority)))
+            try:
+                request.result = post(request.data)
+            except telegram.error.RetryAfter as e:
+                RETRY_AFTER.inc()
+                if request.attempts < self.max_retries and not self._stopped:
+                    request.attempts += 1
+                    request.granted.clear()
+                    self._retry(request, e.retry_after)
+                    continue
+                self._finish(request, e)
+                raise
+            except BaseException as e:
+                self._finish(request, e)
+                raise
+            self._finish(request)
+            return request.result
+
+    def _enqueue(self, request: _Request, chat_id: Hashable):
+        with self._condition:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                group = isinstance(chat_id, str) or chat_id < 0
+                bucket = TokenBucket(self.group_rate, self.group_burst) if group else TokenBucket(self.chat_rate, self.chat_burst)
+                chat = self._chats[chat_id] = _Chat(bucket)
+            chat.requests.append(request)
+            if self._stopped:
+                chat.requests.pop().granted.set()
+            self._condition.notify()
+
+    def _retry(self, request: _Request, retry_after: float):
+        with self._condition:
+            chat = self._chats[request.data['chat_id']]
+            chat.paused_until = time.monotonic() + retry_after
+            chat.in_flight = False
+            chat.requests.appendleft(request)
+            self._condition.notify()
+
+    def _finish(self, request: _Request, error: Optional[BaseException] = None):
+        request.error = error
+        request.done.set()
+        with self._condition:
+            chat = self._chats.get(request.data['chat_id'])
+            if chat is not None:
+                chat.in_flight = False
+            self._condition.notify()
+
+    def _run(self):
+        try:
+            with self._condition:
+                while not self._stopped:
+                    timeout = self._grant()
+                    self._condition.wait(timeout)
+        except Exception as e:
+            # Waiting callers would block forever, let them and the following requests through
+            if self.logger is not None:
+                self.logger.error(f'outbound.py:_run(). Scheduler failed, sending requests without rate limits. Exception: {e}')
+            self.stop()
+
+    def _grant(self) -> Optional[float]:
+        """Grants the requests the limits allow, returns the seconds until the next one may be granted (None if nothing waits)."""
+        while True:
+            now = time.monotonic()
+            waiting = [(chat.requests[0].priority, chat.requests[0].sequence, chat_id) for chat_id, chat in self._chats.items()
+                       if chat.requests and not chat.in_flight]
+            if not waiting:
+                self._forget_idle_chats(now)
+                return None
+
+            timeout = None
+            granted = False
+            global_wait = self._global.wait_time(now)
+            for _, _, chat_id in sorted(waiting):
+                chat = self._chats[chat_id]
+                wait = max(chat.paused_until - now, chat.bucket.wait_time(now), global_wait)
+                if wait > 0:
+                    timeout = wait if timeout is None else min(timeout, wait)
+                    if global_wait > 0:
+                        # Nothing can be sent before the global bucket refills
+                        break
+                    continue
+                self._global.take(now)
+                chat.bucket.take(now)
+                chat.in_flight = True
+                request = chat.requests.popleft()
+                self._merge_followers(request, chat)
+                request.granted.set()
+                granted = True
+                break
+            if not granted:
+                return timeout
+
+    def _merge_followers(self, leader: _Request, chat: _Chat):
+        if not _mergeable(leader):
+            return
+        texts = [_html_text(leader.data)]
+        length = len(texts[0])
+        followers: List[_Request] = []
+        for request in chat.requests:
+            if not _mergeable(request) or not _same_options(leader.data, request.data):
+                break
+            text = _html_text(request.data)
+            if length + len(MERGE_SEPARATOR) + len(text) > MAX_MESSAGE_LENGTH:
+                break
+            texts.append(text)
+            length += len(MERGE_SEPARATOR) + len(text)
+            followers.append(request)
+        if not followers:
+            return
+
+        leader.data = {**leader.data, 'text': MERGE_SEPARATOR.join(texts)}
+        if any(_parse_mode(request.data) == 'HTML' for request in [leader] + followers):
+            leader.data['parse_mode'] = 'HTML'
+        for request in followers:
+            chat.requests.popleft()
+            request.leader = leader
+            request.granted.set()
+        MERGED_MESSAGES.inc(len(followers))
+
+    def _forget_idle_chats(self, now: float):
+        idle = [chat_id for chat_id, chat in self._chats.items()
+                if not chat.in_flight and chat.paused_until <= now and chat.bucket.full(now)]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+
+def _parse_mode(data: Dict[str, Any]) -> Optional[str]:
+    return DefaultValue.get_value(data.get('parse_mode'))
+
+
+def _mergeable(request: _Request) -> bool:
+    """Plain text messages without entities, replies or media (HTML or unformatted text)."""
+    return (request.endpoint == 'sendMessage' and request.attempts == 0 and _parse_mode(request.data) in (None, 'HTML')
+            and not request.data.get('entities') and request.data.get('reply_to_message_id') is None)
+
+
+def _same_options(first: Dict[str, Any], second: Dict[str, Any]) -> bool:
+    keys = (set(first) | set(second)) - {'text', 'parse_mode'}
+    return all(DefaultValue.get_value(first.get(key)) == DefaultValue.get_value(second.get(key)) for key in keys)
+
+
+def _html_text(data: Dict[str, Any]) -> str:
+    text = str(data.get('text', ''))
+    return text if _parse_mode(data) == 'HTML' else html.escape(text)
@@ -0,0 +1,172 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+
+from collections import deque
+from functools import wraps
+from logging import Logger
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from telegram import Update
+
+
+def summarize_update(update: Optional[Update]) -> Dict[str, Any]:
+    """
+    Describe an update without its content: no message texts, names or callback arguments.
+
+    Args:
+        update (Optional[Update]): The update.
+
+    Returns:
+        Dict[str, Any]: IDs, kind and size of the update.
+    """
+    if update is None:
+        return {'kind': 'unknown'}
+    summary: Dict[str, Any] = {
+        'update_id': update.update_id,
+        'chat_id': update.effective_chat.id if update.effective_chat else None,
+        'chat_type': update.effective_chat.type if update.effective_chat else None,
+        'user_id': update.effective_user.id if update.effective_user else None,
+    }
+    message = update.effective_message
+    if update.callback_query is not None:
+        summary['kind'] = 'callback_query'
+        # Only the prefix, the arguments may contain participant names
+        summary['callback'] = (update.callback_query.data or '').split('|')[0]
+    elif message is not None and message.document is not None:
+        summary['kind'] = 'document'
+        summary['file_size'] = message.document.file_size
+    elif message is not None and message.text is not None:
+        if message.text.startswith('/'):
+            summary['kind'] = 'command'
+            summary['command'] = message.text.split()[0].split('@')[0]
+        else:
+            summary['kind'] = 'message'
+        summary['text_length'] = len(message.text)
+    else:
+        summary['kind'] = 'other'
+    return summary
+
+
+class SlowUpdateProfiler:
+    """
+    Opt-in profiling of update handlers.
+
+    When enabled (sample_rate > 0), every wrapped handler call is timed and the most
+    recent `recent` ones are kept for slowest(). A `sample_rate` fraction of the calls
+    runs under cProfile; if such a call takes longer than `threshold` seconds, its
+    profile (.prof, readable with pstats or snakeviz) and a text report with the
+    redacted update summary and the top functions are written to `directory`, which
+    keeps the newest `max_profiles` profiles.
+
+    Only the outermost wrapped call of an update is recorded (dialog callbacks called
+    by another handler are part of its timing), and only one update is profiled at a
+    time, as cProfile can't profile several threads at once.
+
+    When disabled, wrap() returns the handlers unchanged, so there is no overhead.
+    """
+    def __init__(self, directory: str, logger: Logger, sample_rate: float = 0.0, threshold: float = 0.5,
+                 max_profiles: int = 50, recent: int = 1000):
+        """
+        Args:
+            directory (str): Directory the profiles of slow updates are written to.
+            logger (Logger): Logger of the bot.
+            sample_rate (float): Fraction of the updates profiled, 0 disables profiling.
+            threshold (float): Seconds above which a profiled update is written to the directory.
+            max_profiles (int): Number of profiles kept in the directory.
+            recent (int): Number of recent updates slowest() chooses from.
+        """
+        self.directory = directory
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.max_profiles = max(1, max_profiles)
+        # (duration, finished at, handler, summary)
+        self._recent: Deque[Tuple[float, float, str, Dict[str, Any]]] = deque(maxlen=max(1, recent))
+        self._profiling = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    def wrap(self, func: Callable) -> Callable:
+        """
+        A decorator that times and samples the calls of an update handler taking (self, update, context, ...).
+
+        Args:
+            func (Callable): The handler to be wrapped.
+
+        Returns:
+            Callable: The wrapped handler, or the handler itself when profiling is disabled.
+        """
+        if not self.enabled:
+            return func
+
+        @wraps(func)
+        def wrapped(bot, update: Update, *args, **kwargs):
+            if getattr(self._local, 'active', False):
+                return func(bot, update, *args, **kwargs)
+
+            self._local.active = True
+            profile = None
+            if random.random() < self.sample_rate and self._profiling.acquire(blocking=False):
+                profile = cProfile.Profile()
+            started = time.perf_counter()
+            try:
+                if profile is None:
+                    return func(bot, update, *args, **kwargs)
+                return profile.runcall(func, bot, update, *args, **kwargs)
+            finally:
+                duration = time.perf_counter() - started
+                self._local.active = False
+                if profile is not None:
+                    self._profiling.release()
+                self._finish(func.__name__, update, duration, profile)
+        return wrapped
+
+    def slowest(self, n: int) -> List[Dict[str, Any]]:
+        """
+        Args:
+            n (int): Number of updates.
+
+        Returns:
+            List[Dict[str, Any]]: Summaries of the n slowest recent updates, slowest first.
+        """
+        recent = sorted(list(self._recent), key=lambda entry: entry[0], reverse=True)[:n]
+        return [{'duration': duration, 'time': finished, 'handler': handler, **summary} for duration, finished, handler, summary in recent]
+
+    def _finish(self, handler: str, update: Update, duration: float, profile: Optional[cProfile.Profile]):
+        summary = summarize_update(update if isinstance(update, Update) else None)
+        if profile is not None and duration >= self.threshold:
+            try:
+                summary['profile'] = self._save(handler, summary, duration, profile)
+            except OSError as e:
+                self.logger.error(f'profiling.py:_finish(). Failed to save the profile of a slow update. Exception: {e}')
+        self._recent.append((duration, time.time(), handler, summary))
+
+    def _save(self, handler: str, summary: Dict[str, Any], duration: float, profile: cProfile.Profile) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        name = f'{time.strftime("%Y%m%d-%H%M%S")}-{summary.get("update_id", 0)}-{handler}'
+        profile.dump_stats(os.path.join(self.directory, name + '.prof'))
+
+        stats_text = io.StringIO()
+        pstats.Stats(profile, stream=stats_text).sort_stats('cumulative').print_stats(40)
+        with open(os.path.join(self.directory, name + '.txt'), 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'handler': handler, 'duration': round(duration, 6), **summary}) + '\n\n')
+            f.write(stats_text.getvalue())
+        self.logger.info(f'profiling.py:_save(). {handler} took {duration:.3f}s, profile saved as {name}')
+
+        profiles = [os.path.join(self.directory, entry) for entry in os.listdir(self.directory) if entry.endswith('.prof')]
+        profiles.sort(key=os.path.getmtime)
+        for old in profiles[:-self.max_profiles]:
+            for path in (old, old[:-len('.prof')] + '.txt'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return name
@@ -0,0 +1,109 @@
+import signal
+import threading
+
+from logging import Logger
+from telegram.ext import Updater
+from shared.chat_dispatcher import ChatOrderedDispatcher
+from shared.checkpoint import UpdateCheckpoint
+from shared.metrics import MetricsServer, instrument_bot
+from shared.outbound import OutboundScheduler
+from shared.webhook import WebhookServer
+from shared.shared_env import UPDATE_MODE, WEBHOOK_LISTEN, WEBHOOK_SECRET_TOKEN, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, MAX_CONCURRENT_UPDATES,\
+    METRICS_PORT, METRICS_LISTEN, OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_GROUP_RATE, OUTBOUND_GROUP_BURST,\
+    OUTBOUND_MAX_RETRIES, UPDATE_CHECKPOINT_INTERVAL
+
+
+def run_updater(updater: Updater, logger: Logger, webhook_url: str = '', webhook_port: int = 8443, checkpoint_file: str = ''):
+    """
+    Receives updates with long polling or with a webhook and blocks until SIGINT/SIGTERM.
+
+    The mode is selected by the UPDATE_MODE env variable ('polling' or 'webhook').
+    In webhook mode a WebhookServer is started on webhook_port and registered with
+    Telegram at webhook_url, together with the WEBHOOK_SECRET_TOKEN.
+
+    Unless MAX_CONCURRENT_UPDATES is 0, updates are processed by a ChatOrderedDispatcher:
+    concurrently across chats and in order within a chat.
+
+    Unless METRICS_PORT is 0, the metrics (including the bot's API requests) are served
+    in the Prometheus text format on METRICS_LISTEN:METRICS_PORT/metrics.
+
+    Unless OUTBOUND_GLOBAL_RATE is 0, the bot's requests to chats go through an
+    OutboundScheduler that keeps them within Telegram's rate limits.
+
+    With a checkpoint_file, the ID of the last processed update is persisted (see
+    UpdateCheckpoint) and a restarted bot resumes after it instead of processing the
+    updates again.
+
+    Args:
+        updater (Updater): The bot's updater.
+        logger (Logger): Logger of the bot.
+        webhook_url (str): Public URL Telegram sends updates to.
+        webhook_port (int): Local port of the webhook server.
+        checkpoint_file (str): File of the update checkpoint, empty to disable it.
+    """
+    metrics_server = None
+    if METRICS_PORT > 0:
+        instrument_bot(updater.bot)
+        metrics_server = MetricsServer(METRICS_PORT, listen=METRICS_LISTEN)
+        metrics_server.start()
+        logger.info(f'runner.py:run_updater(). Serving metrics on {METRICS_LISTEN}:{metrics_server.port}/metrics')
+
+    scheduler = None
+    if OUTBOUND_GLOBAL_RATE > 0:
+        # Installed after instrument_bot(), so the API metrics measure the requests without the time spent waiting
+        scheduler = OutboundScheduler(OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE, chat_burst=OUTBOUND_CHAT_BURST,
+                                      group_rate=OUTBOUND_GROUP_RATE, group_burst=OUTBOUND_GROUP_BURST, max_retries=OUTBOUND_MAX_RETRIES,
+                                      logger=logger)
+        scheduler.install(updater.bot)
+
+    checkpoint = None
+    if checkpoint_file:
+        # Webhooks aren't delivered in order, so only the ledgers' deduplication is safe there
+        checkpoint = UpdateCheckpoint(checkpoint_file, logger, interval=UPDATE_CHECKPOINT_INTERVAL, skip_processed=UPDATE_MODE != 'webhook')
+        if checkpoint.last_processed is not None:
+            # Polling starts with this offset, which also confirms the processed updates to Telegram
+            updater.last_update_id = checkpoint.last_processed + 1
+            logger.info(f'runner.py:run_updater(). Resuming after update {checkpoint.last_processed}')
+
+    chat_dispatcher = None
+    if MAX_CONCURRENT_UPDATES > 0:
+        chat_dispatcher = ChatOrderedDispatcher(updater.dispatcher, logger, max_concurrency=MAX_CONCURRENT_UPDATES, checkpoint=checkpoint)
+        chat_dispatcher.install()
+    elif checkpoint is not None:
+        checkpoint.install(updater.dispatcher)
+    try:
+        if UPDATE_MODE == 'webhook':
+            _run_webhook(updater, logger, webhook_url, webhook_port)
+        else:
+            updater.start_polling()
+            updater.idle()
+    finally:
+        if chat_dispatcher is not None:
+            chat_dispatcher.stop()
+        if checkpoint is not None:
+            checkpoint.close()
+        if scheduler is not None:
+            scheduler.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+
+
+def _run_webhook(updater: Updater, logger: Logger, webhook_url: str, webhook_port: int):
+    if not webhook_url or not WEBHOOK_SECRET_TOKEN:
+        raise Exception('Webhook mode requires a webhook URL and WEBHOOK_SECRET_TOKEN')
+
+    server = WebhookServer(updater.dispatcher, WEBHOOK_LISTEN, webhook_port, WEBHOOK_SECRET_TOKEN, logger,
+                           workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE)
+    server.start()
+    updater.bot.set_webhook(url=webhook_url, api_kwargs={'secret_token': WEBHOOK_SECRET_TOKEN})
+    logger.info(f'runner.py:run_updater(). Receiving updates on port {server.port} with {WEBHOOK_WORKERS} workers')
+
+    stopped = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(sig, lambda *_: stopped.set())
+    while not stopped.wait(1):
+        pass
+
+    logger.info('runner.py:run_updater(). Stopping webhook server...')
+    server.stop()
+    updater.job_queue.stop()
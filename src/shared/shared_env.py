@@ -18,10 +18,58 @@ try:
     PGP_PASSPHRASE: str = os.environ.get('PGP_PASSPHRASE')
     USERNAME: str = os.environ.get('USERNAME')
     PGP_PASSPHRASE: str = os.environ.get('PGP_PASSPHRASE')
+    # Usernames the finance bot's user registry (data/users.json) is created with, it is managed with /add_user and /remove_user afterwards
     ALLOWED_USERS_FINANCE_BOT: List[str] = os.environ.get('ALLOWED_USERS_FINANCE_BOT').split(',')
+    # Optional: users of a new registry allowed to run the admin commands (e.g. /slowest), all ALLOWED_USERS_FINANCE_BOT by default
+    FINANCE_BOT_ADMINS: List[str] = [user for user in os.environ.get('FINANCE_BOT_ADMINS', '').split(',') if user] or ALLOWED_USERS_FINANCE_BOT
     FINANCE_BOT_PARTICIPANTS: List[str] = os.environ.get('FINANCE_BOT_PARTICIPANTS').split(',')
     FINANCE_LOGS_CHANNEL_ID: int = int(os.environ.get('FINANCE_LOGS_CHANNEL_ID'))
 
+    # Optional: how updates are received ('polling' or 'webhook') and webhook server settings
+    UPDATE_MODE: str = os.environ.get('UPDATE_MODE', 'polling').lower()
+    WEBHOOK_LISTEN: str = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+    WEBHOOK_SECRET_TOKEN: str = os.environ.get('WEBHOOK_SECRET_TOKEN', '')
+    WEBHOOK_WORKERS: int = int(os.environ.get('WEBHOOK_WORKERS', 4))
+    WEBHOOK_QUEUE_SIZE: int = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 100))
+    TWO_FA_BOT_WEBHOOK_URL: str = os.environ.get('TWO_FA_BOT_WEBHOOK_URL', '')
+    TWO_FA_BOT_WEBHOOK_PORT: int = int(os.environ.get('TWO_FA_BOT_WEBHOOK_PORT', 8443))
+    FINANCE_BOT_WEBHOOK_URL: str = os.environ.get('FINANCE_BOT_WEBHOOK_URL', '')
+    FINANCE_BOT_WEBHOOK_PORT: int = int(os.environ.get('FINANCE_BOT_WEBHOOK_PORT', 8443))
+
+    # Optional: number of updates processed at the same time (in order within a chat), 0 processes them one by one
+    MAX_CONCURRENT_UPDATES: int = int(os.environ.get('MAX_CONCURRENT_UPDATES', 16))
+
+    # Optional: seconds after which an unanswered dialog expires (0 keeps it forever) and maximum number of open dialogs
+    CONVERSATION_TTL: float = float(os.environ.get('CONVERSATION_TTL', 900))
+    CONVERSATION_MAX_ENTRIES: int = int(os.environ.get('CONVERSATION_MAX_ENTRIES', 10000))
+
+    # Optional: Bot API server to talk to instead of api.telegram.org, e.g. http://localhost:8081/bot for a local fake server
+    TELEGRAM_API_URL: str = os.environ.get('TELEGRAM_API_URL') or None
+
+    # Optional: local port serving the Prometheus metrics at /metrics (0 disables it) and the address it binds to
+    METRICS_PORT: int = int(os.environ.get('METRICS_PORT', 0))
+    METRICS_LISTEN: str = os.environ.get('METRICS_LISTEN', '127.0.0.1')
+
+    # Optional: minimum seconds between two writes of the checkpoint of the processed updates
+    UPDATE_CHECKPOINT_INTERVAL: float = float(os.environ.get('UPDATE_CHECKPOINT_INTERVAL', 1.0))
+
+    # Optional: limits of the outgoing Bot API requests in requests per second overall (0 disables the limits), per
+    # private chat and per group or channel (0 for no per-chat limit), requests allowed at once to a chat, and retries
+    # after flood control errors
+    OUTBOUND_GLOBAL_RATE: float = float(os.environ.get('OUTBOUND_GLOBAL_RATE', 30))
+    OUTBOUND_CHAT_RATE: float = float(os.environ.get('OUTBOUND_CHAT_RATE', 1))
+    OUTBOUND_CHAT_BURST: float = float(os.environ.get('OUTBOUND_CHAT_BURST', 3))
+    OUTBOUND_GROUP_RATE: float = float(os.environ.get('OUTBOUND_GROUP_RATE', 20 / 60))
+    OUTBOUND_GROUP_BURST: float = float(os.environ.get('OUTBOUND_GROUP_BURST', 5))
+    OUTBOUND_MAX_RETRIES: int = int(os.environ.get('OUTBOUND_MAX_RETRIES', 3))
+
+    # Optional: fraction of the updates run under the profiler (0 disables profiling), seconds above which a profiled
+    # update is saved to logs/profiles, number of saved profiles kept and number of recent updates /slowest chooses from
+    PROFILING_SAMPLE_RATE: float = float(os.environ.get('PROFILING_SAMPLE_RATE', 0))
+    PROFILING_THRESHOLD: float = float(os.environ.get('PROFILING_THRESHOLD', 0.5))
+    PROFILING_MAX_PROFILES: int = int(os.environ.get('PROFILING_MAX_PROFILES', 50))
+    PROFILING_RECENT_UPDATES: int = int(os.environ.get('PROFILING_RECENT_UPDATES', 1000))
+
     if DEVELOPEMENT_ENVIRONMENT:
         # 2FA bot
         TWO_FA_BOT_TOKEN: str = os.environ.get('TWO_FA_BOT_TOKEN_DEV')
@@ -0,0 +1,153 @@
+import hmac
+import json
+import queue
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import Logger
+from typing import Any, Optional
+from telegram import Update
+from telegram.ext import Dispatcher
+
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+MAX_BODY_SIZE = 1024 * 1024
+# Put on the update queue to stop a worker, never produced by a request
+_STOP = object()
+
+
+class WebhookServer:
+    """
+    Minimal HTTP endpoint receiving updates pushed by the Telegram Bot API.
+
+    Requests must carry the secret token configured with setWebhook. Accepted updates
+    are put on a bounded queue drained by a fixed number of worker threads, which pass
+    them to the dispatcher. When the queue is full the server answers 429 so that
+    Telegram retries the delivery later instead of the process buffering without limit.
+    """
+    def __init__(self, dispatcher: Dispatcher, listen: str, port: int, secret_token: str, logger: Logger,
+                 path: str = '/', workers: int = 4, queue_size: int = 100):
+        """
+        Args:
+            dispatcher (Dispatcher): Dispatcher processing the updates.
+            listen (str): Address to bind to.
+            port (int): Port to bind to.
+            secret_token (str): Expected value of the X-Telegram-Bot-Api-Secret-Token header.
+            logger (Logger): Logger of the bot.
+            path (str): URL path accepting updates.
+            workers (int): Number of threads processing updates.
+            queue_size (int): Number of accepted updates waiting for a worker before requests are rejected.
+        """
+        self.dispatcher = dispatcher
+        self.secret_token = secret_token
+        self.logger = logger
+        self.path = path
+        self.updates: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._workers = [threading.Thread(target=self._work, name=f'webhook-worker-{i}', daemon=True) for i in range(max(1, workers))]
+        self._httpd = ThreadingHTTPServer((listen, port), self._make_request_handler())
+        self._httpd.daemon_threads = True
+        self._server_thread = threading.Thread(target=self._httpd.serve_forever, name='webhook-server', daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self._httpd.server_address[1]
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+        self._server_thread.start()
+
+    def stop(self):
+        """Stops accepting requests and lets the workers finish the queued updates."""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        for _ in self._workers:
+            self.updates.put(_STOP)
+        for worker in self._workers:
+            worker.join()
+
+    def parse(self, payload: Any) -> Optional[Update]:
+        """
+        Args:
+            payload (Any): The JSON decoded request body.
+
+        Returns:
+            Optional[Update]: The update, None if the payload isn't a valid update.
+        """
+        if not isinstance(payload, dict):
+            return None
+        try:
+            return Update.de_json(payload, self.dispatcher.bot)
+        except Exception as e:
+            self.logger.warning(f'webhook.py:parse(). Rejected an invalid update: {e}')
+            return None
+
+    def accept(self, update: Update) -> bool:
+        """
+        Queues an update for processing.
+
+        Args:
+            update (Update): The update, see parse().
+
+        Returns:
+            bool: False if the queue is full.
+        """
+        try:
+            self.updates.put_nowait(update)
+        except queue.Full:
+            return False
+        return True
+
+    def _work(self):
+        while True:
+            update = self.updates.get()
+            if update is _STOP:
+                return
+            try:
+                self.dispatcher.process_update(update)
+            except Exception as e:
+                self.logger.error(f'webhook.py:_work(). Exception processing update {update.update_id}: {e}')
+
+    def _make_request_handler(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    return self._respond(404)
+                # Compared as bytes: compare_digest() raises TypeError for non-ASCII str
+                token = self.headers.get(SECRET_TOKEN_HEADER, '').encode('latin-1', 'replace')
+                if not hmac.compare_digest(token, server.secret_token.encode()):
+                    server.logger.warning(f'webhook.py:do_POST(). Rejected request with a wrong secret token from {self.client_address[0]}')
+                    return self._respond(403)
+
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                except ValueError:
+                    return self._respond(400)
+                if length <= 0 or length > MAX_BODY_SIZE:
+                    return self._respond(413 if length > 0 else 400)
+                try:
+                    payload = json.loads(self.rfile.read(length))
+                except ValueError:
+                    return self._respond(400)
+                update = server.parse(payload)
+                if update is None:
+                    return self._respond(400)
+
+                if not server.accept(update):
+                    server.logger.warning('webhook.py:do_POST(). Update queue is full, asking Telegram to retry')
+                    return self._respond(429, {'Retry-After': '1'})
+                return self._respond(200)
+
+            def _respond(self, status: int, headers: dict = None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
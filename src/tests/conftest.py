@@ -0,0 +1,32 @@
+import os
+import sys
+import tempfile
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# The FinanceBot modules read the env variables on import, the required ones get placeholder values
+TEST_ENV = {
+    'DEVELOPEMENT_ENVIRONMENT': 'true',
+    'PGP_PASSPHRASE': 'test',
+    'USERNAME': 'test',
+    'ALLOWED_USERS_FINANCE_BOT': 'test',
+    'FINANCE_BOT_PARTICIPANTS': 'alice,bob,carol',
+    'FINANCE_LOGS_CHANNEL_ID': '-1000000000000',
+    'FINANCE_BOT_TOKEN_DEV': '123:abc',
+    'FINANCE_BOT_LINK_DEV': 'test',
+    'FINANCE_BOT_TOKEN_PRODUCTION': '123:abc',
+    'FINANCE_BOT_LINK_PRODUCTION': 'test',
+    'TWO_FA_BOT_TOKEN_DEV': '123:abc',
+    'TWO_FA_BOT_LINK_DEV': 'test',
+    'TWO_FA_BOT_TOKEN_PRODUCTION': '123:abc',
+    'TWO_FA_BOT_LINK_PRODUCTION': 'test',
+}
+for name, value in TEST_ENV.items():
+    os.environ.setdefault(name, value)
+# The log listener thread would outlive pytest's captured output
+os.environ['ASYNC_LOGGING'] = 'false'
+os.environ['BASE_DIR'] = tempfile.mkdtemp(prefix='finance-bot-tests-')
+for directory in ('data', 'logs'):
+    os.makedirs(os.path.join(os.environ['BASE_DIR'], directory), exist_ok=True)
+
+sys.path[:0] = [os.path.join(SRC_DIR, 'FinanceBot'), SRC_DIR]
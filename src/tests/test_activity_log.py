@@ -0,0 +1,46 @@
+from activity_log import ActivityLog
+
+
+def entry(ts: float) -> dict:
+    return {'ts': ts, 'kind': 'loan', 'amounts': {'alice': 100}}
+
+
+def test_read_range_across_segments(tmp_path):
+    log = ActivityLog(str(tmp_path / 'activity'), segment_size=200, max_segments=100)
+    log.append([entry(float(ts)) for ts in range(100)])
+    assert len(log._segments) > 1
+    assert [e['ts'] for e in log.read_range(10, 20)] == [float(ts) for ts in range(10, 21)]
+    assert [e['ts'] for e in log.read_range(10.5, 11.5)] == [11.0]
+    assert list(log.read_range(200, 300)) == []
+    assert [e['ts'] for e in log.read_range(-5, 2)] == [0.0, 1.0, 2.0]
+
+
+def test_read_range_after_the_clock_went_back(tmp_path):
+    log = ActivityLog(str(tmp_path / 'activity'))
+    log.append([entry(ts) for ts in (1.0, 2.0, 5.0, 4.0, 6.0)])
+    # The entry of 4.0 is indexed at 5.0, the entries stay in the order they were appended
+    assert [e['ts'] for e in log.read_range(3, 5)] == [5.0, 4.0]
+    assert [e['ts'] for e in log.read_range(5.5, 10)] == [6.0]
+
+
+def test_read_range_after_reopening(tmp_path):
+    path = str(tmp_path / 'activity')
+    ActivityLog(path).append([entry(ts) for ts in (1.0, 3.0)])
+    log = ActivityLog(path)
+    log.append([entry(2.0)])
+    assert [e['ts'] for e in log.read_range(0, 10)] == [1.0, 3.0, 2.0]
+    assert [e['ts'] for e in log.read_range(2.5, 10)] == [3.0, 2.0]
+
+
+def test_history_of_a_period(tmp_path):
+    from types import SimpleNamespace
+    from datetime import date, datetime
+    from finance_bot import FinanceBot
+
+    log = ActivityLog(str(tmp_path / 'activity'))
+    days = [datetime(2026, 3, day, 12).timestamp() for day in (1, 2, 3)]
+    log.append([entry(ts) for ts in days])
+    ledger = SimpleNamespace(activity_log=log)
+    response = FinanceBot.history_period(ledger, date(2026, 3, 2), date(2026, 3, 3))
+    assert '2026-03-02 12:00' in response and '2026-03-03 12:00' in response
+    assert '2026-03-01' not in response.split('\n', 1)[1]
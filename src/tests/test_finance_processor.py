@@ -0,0 +1,41 @@
+import threading
+
+from finance_processor import FinanceProcessor
+from money import CENTS
+from storage import LedgerStorage
+
+
+def make_processor(tmp_path) -> FinanceProcessor:
+    storage = LedgerStorage(str(tmp_path / 'finance_info.json'), {}, snapshot_interval=5, change_detection='lock')
+    processor = FinanceProcessor(storage=storage, participants=[])
+    processor.add_participants(['alice', 'bob', 'carol'])
+    return processor
+
+
+def test_listeners_run_under_the_storage_lock(tmp_path):
+    processor = make_processor(tmp_path)
+    locked = []
+    processor.add_listener(lambda transactions: locked.append(processor.storage.lock.is_locked))
+    processor.process_loan('alice', 'bob', 10 * CENTS)
+    processor.process_balance_change(30 * CENTS)
+    assert locked == [True, True]
+    processor.close()
+
+
+def test_listeners_see_transactions_in_commit_order(tmp_path):
+    processor = make_processor(tmp_path)
+    timestamps = []
+    processor.add_listener(lambda transactions: timestamps.extend(transaction.timestamp for transaction in transactions))
+
+    def lend(i: int):
+        for _ in range(20):
+            processor.process_loan('alice', 'bob', (i + 1) * CENTS)
+
+    threads = [threading.Thread(target=lend, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(timestamps) == 80
+    assert timestamps == sorted(timestamps)
+    processor.close()
@@ -0,0 +1,60 @@
+from datetime import date
+
+import pytest
+
+from history import HistoryIndex, Transaction
+from ledger import CorruptJournal, Ledger
+
+
+def make_ledger(tmp_path) -> Ledger:
+    ledger = Ledger(str(tmp_path / 'finance_info.json'), {'alice': {'profits': 0, 'spent': 0}}, snapshot_interval=100)
+    ledger.load()
+    return ledger
+
+
+def test_torn_last_record_is_cut_off(tmp_path):
+    ledger = make_ledger(tmp_path)
+    ledger.append('set_profits', {'alice': {'profits': 100}})
+    with open(ledger.journal_path, 'ab') as f:
+        f.write(b'{"ts":1,"op":"set_pro')
+    ledger = make_ledger(tmp_path)
+    assert ledger.data['alice']['profits'] == 100
+    with open(ledger.journal_path, 'rb') as f:
+        assert f.read().endswith(b'\n')
+
+
+def test_corrupt_record_in_the_middle_keeps_the_journal(tmp_path):
+    ledger = make_ledger(tmp_path)
+    ledger.append('set_profits', {'alice': {'profits': 100}})
+    with open(ledger.journal_path, 'ab') as f:
+        f.write(b'garbage\n')
+    ledger.append('set_profits', {'alice': {'profits': 200}})
+    with open(ledger.journal_path, 'rb') as f:
+        journal = f.read()
+
+    with pytest.raises(CorruptJournal):
+        make_ledger(tmp_path)
+    with open(ledger.journal_path, 'rb') as f:
+        assert f.read() == journal
+
+
+def test_history_index_corrupt_record_in_the_middle_keeps_the_journal(tmp_path):
+    path = str(tmp_path / 'history_index.json')
+    index = HistoryIndex(path)
+    index.add([Transaction(1e9, 'loan', {'alice': 100})])
+    with open(index.journal_path, 'ab') as f:
+        f.write(b'garbage\n')
+    index.add([Transaction(1e9, 'loan', {'alice': 100})])
+    with open(index.journal_path, 'rb') as f:
+        journal = f.read()
+
+    with pytest.raises(CorruptJournal):
+        HistoryIndex(path)
+    with open(index.journal_path, 'rb') as f:
+        assert f.read() == journal
+
+    # A torn last line is still discarded
+    with open(index.journal_path, 'wb') as f:
+        f.write(journal.split(b'garbage\n')[0] + b'{"days"')
+    day = date.fromtimestamp(1e9)
+    assert HistoryIndex(path).report(day, day)['alice']['loan'] == {'sum': 100, 'count': 1}
@@ -0,0 +1,59 @@
+import threading
+import time
+
+import pytest
+
+from shared.outbound import OutboundScheduler, TokenBucket
+
+
+def send_all(scheduler: OutboundScheduler, chat_id: int, count: int):
+    sent = []
+    threads = [threading.Thread(target=lambda i=i: sent.append(scheduler.send('sendPhoto', {'chat_id': chat_id}, lambda data: i)))
+               for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return sent
+
+
+def test_zero_rate_is_unlimited():
+    bucket = TokenBucket(0, 1)
+    for _ in range(10):
+        assert bucket.wait_time(0.0) == 0.0
+        bucket.take(0.0)
+
+
+def test_negative_rate_is_rejected():
+    with pytest.raises(ValueError):
+        OutboundScheduler(chat_rate=-1)
+
+
+def test_zero_chat_and_group_rates_send_everything():
+    scheduler = OutboundScheduler(global_rate=1000, chat_rate=0, chat_burst=1, group_rate=0, group_burst=1)
+    scheduler._thread.start()
+    try:
+        assert len(send_all(scheduler, 42, 5)) == 5
+        assert len(send_all(scheduler, -100, 5)) == 5
+    finally:
+        scheduler.stop()
+
+
+def test_failed_scheduler_releases_requests(monkeypatch):
+    scheduler = OutboundScheduler(global_rate=1000)
+
+    def fail():
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(scheduler, '_grant', fail)
+    sent = []
+    waiting = threading.Thread(target=lambda: sent.extend(send_all(scheduler, 42, 3)))
+    waiting.start()
+    while scheduler.queued() < 3:
+        time.sleep(0.01)
+    # The requests are waiting when the scheduler fails
+    scheduler._thread.start()
+    waiting.join(5)
+    assert sorted(sent) == [0, 1, 2]
+    # The following ones aren't rate limited anymore
+    assert len(send_all(scheduler, 42, 3)) == 3
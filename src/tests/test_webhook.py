@@ -0,0 +1,117 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+
+import pytest
+from telegram.ext import CommandHandler, Updater
+
+from shared.webhook import SECRET_TOKEN_HEADER, WebhookServer
+
+
+TOKEN = '123:abc'
+SECRET = 'secret'
+
+
+class FakeBotApi:
+    """Local stand-in for the Bot API server (TELEGRAM_API_URL) recording the messages sent."""
+    RESULTS = {'getMe': {'id': 123, 'is_bot': True, 'first_name': 'Bot', 'username': 'test_bot'}}
+
+    def __init__(self):
+        self.sent = []
+        self.called = threading.Event()
+        api = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                params = json.loads(body) if body else {}
+                if method == 'sendMessage':
+                    api.sent.append(params)
+                    api.called.set()
+                    result = {'message_id': 1, 'date': 0, 'chat': {'id': params['chat_id'], 'type': 'private'}}
+                else:
+                    result = api.RESULTS.get(method, True)
+                payload = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), RequestHandler)
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self._httpd.server_address[1]}/bot'
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture
+def api():
+    api = FakeBotApi()
+    yield api
+    api.close()
+
+
+@pytest.fixture
+def webhook(api):
+    # Same Updater setup as the bots, with TELEGRAM_API_URL pointing at the fake server
+    updater = Updater(TOKEN, base_url=api.url)
+    updater.dispatcher.add_handler(CommandHandler('start', lambda update, context: context.bot.send_message(update.effective_chat.id, 'hi')))
+    server = WebhookServer(updater.dispatcher, '127.0.0.1', 0, SECRET, getLogger('test_webhook'), workers=1)
+    server.start()
+    yield server
+    server.stop()
+
+
+def post(server: WebhookServer, body: bytes, secret: str = SECRET, headers: dict = None) -> int:
+    request = urllib.request.Request(f'http://127.0.0.1:{server.port}/', data=body, method='POST',
+                                     headers={SECRET_TOKEN_HEADER: secret, 'Content-Type': 'application/json', **(headers or {})})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def start_update(update_id: int = 1, chat_id: int = 42) -> bytes:
+    return json.dumps({'update_id': update_id, 'message': {
+        'message_id': 1, 'date': 0, 'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        'chat': {'id': chat_id, 'type': 'private'}, 'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Alice'}}}).encode()
+
+
+def test_start_sends_message(webhook, api):
+    assert post(webhook, start_update()) == 200
+    assert api.called.wait(5)
+    assert int(api.sent[0]['chat_id']) == 42
+
+
+def test_wrong_secret_is_forbidden(webhook, api):
+    assert post(webhook, start_update(), secret='wrong') == 403
+    assert post(webhook, start_update(), secret='sécret') == 403
+    assert api.sent == []
+
+
+@pytest.mark.parametrize('body', [b'null', b'[1]', b'"x"', b'{}', b'{"update_id": "x", "message": 1}', b'not json'])
+def test_malformed_body_is_rejected(webhook, body):
+    assert post(webhook, body) == 400
+
+
+def test_malformed_content_length_is_rejected(webhook):
+    assert post(webhook, b'{}', headers={'Content-Length': 'abc'}) == 400
+
+
+def test_workers_survive_malformed_bodies(webhook, api):
+    for _ in range(3):
+        post(webhook, b'null')
+    assert post(webhook, start_update()) == 200
+    assert api.called.wait(5)